@@ -0,0 +1,145 @@
+import os
+import time
+import json
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+import torch
+
+from fastcsr_model_infer import LevelsetPredictor
+from brain_finalsurfs_model_infer import BrainFinalsurfsPredictor
+from preprocess_cache import PreprocessCache, preprocess_subject
+from inference_budget import INFERENCE_BUDGETS, get_budget
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='FastCSR: compare inference budget presets against the default one')
+    parser.add_argument('--sd', help='Subjects dir of an already processed subject (e.g. the example data/)')
+    parser.add_argument('--sid', help='Subject ID, needs mri/orig.mgz and mri/filled.mgz')
+    parser.add_argument('--synthetic', default=False, action='store_true',
+                        help='Use a synthetic ellipsoid phantom instead of a subject')
+    parser.add_argument('--model-path', required=True, help='The Model path of lh_model.pth / rh_model.pth')
+    parser.add_argument('--budgets', nargs='+', default=[i for i in INFERENCE_BUDGETS if i != 'default'],
+                        choices=list(INFERENCE_BUDGETS.keys()), help='Presets to compare with default')
+    parser.add_argument('--models', nargs='+', default=['lh', 'rh', 'brain_finalsurfs'],
+                        choices=['lh', 'rh', 'brain_finalsurfs'])
+    parser.add_argument('--max_levelset_mae', type=float, default=0.05,
+                        help='tolerance of the mean absolute levelset difference inside the |levelset| < 3 band')
+    parser.add_argument('--min_levelset_dice', type=float, default=0.99,
+                        help='tolerance of the Dice of the levelset < 0 region')
+    parser.add_argument('--max_finalsurfs_mae', type=float, default=1.0,
+                        help='tolerance of the mean absolute brain.finalsurfs intensity difference inside the brain')
+    parser.add_argument('--json', help='Write the metrics to this json file')
+    args = parser.parse_args()
+    if not args.synthetic and (args.sd is None or args.sid is None):
+        raise ValueError('Set --sd and --sid, or use --synthetic')
+    return args
+
+
+def make_phantom(subj_dir: Path, shape=(256, 256, 256)):
+    """
+    Conformed (1mm, 256^3) ellipsoid phantom: mri/orig.mgz and mri/filled.mgz
+    """
+    (subj_dir / 'mri').mkdir(parents=True, exist_ok=True)
+    affine = np.array([[-1, 0, 0, 128], [0, 0, 1, -128], [0, -1, 0, 128], [0, 0, 0, 1]], dtype=np.float32)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, i) for i in shape], indexing='ij'))
+    radius = np.sqrt((grid[0] / 0.55) ** 2 + (grid[1] / 0.65) ** 2 + (grid[2] / 0.5) ** 2)
+    rng = np.random.default_rng(0)
+
+    orig = np.zeros(shape, dtype=np.float32)
+    orig[radius < 1] = 70  # gray matter
+    orig[radius < 0.8] = 110  # white matter
+    orig += rng.normal(0, 3, shape) * (radius < 1.05)
+    orig = np.clip(orig, 0, 255).astype(np.uint8)
+    nib.save(nib.MGHImage(orig, affine), str(subj_dir / 'mri' / 'orig.mgz'))
+
+    filled = np.zeros(shape, dtype=np.uint8)
+    wm = radius < 0.8
+    filled[wm & (grid[0] < 0)] = 255
+    filled[wm & (grid[0] >= 0)] = 127
+    nib.save(nib.MGHImage(filled, affine), str(subj_dir / 'mri' / 'filled.mgz'))
+
+
+def predict_array(model, data, properties, budget, tmp_dir: Path):
+    output_file = tmp_dir / 'pred.nii.gz'
+    tic = time.time()
+    model.predict(data, properties, str(output_file), budget)
+    seconds = time.time() - tic
+    return np.asarray(nib.load(str(output_file)).dataobj, dtype=np.float32), seconds
+
+
+def levelset_metrics(pred, ref):
+    band = np.abs(ref) < 3
+    inside_pred, inside_ref = pred < 0, ref < 0
+    dice = 2 * np.sum(inside_pred & inside_ref) / max(np.sum(inside_pred) + np.sum(inside_ref), 1)
+    return {
+        'mae_band': float(np.abs(pred - ref)[band].mean()) if band.any() else 0.,
+        'max_abs': float(np.abs(pred - ref).max()),
+        'dice_inside': float(dice),
+    }
+
+
+def finalsurfs_metrics(pred, ref):
+    brain = ref > 0
+    return {
+        'mae_brain': float(np.abs(pred - ref)[brain].mean()) if brain.any() else 0.,
+        'max_abs': float(np.abs(pred - ref).max()),
+    }
+
+
+def check_budget(args, subj_dir: Path, tmp_dir: Path):
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    fastcsr_path = Path(os.path.split(os.path.abspath(__file__))[0])
+    cache = PreprocessCache()
+    sid = subj_dir.name
+
+    results = dict()
+    passed = True
+    for name in args.models:
+        if name == 'brain_finalsurfs':
+            model = BrainFinalsurfsPredictor(device=device, model_path=fastcsr_path / 'model')
+            source_files = [subj_dir / 'mri' / 'orig.mgz']
+        else:
+            model = LevelsetPredictor(hemi=name, device=device, model_path=Path(args.model_path))
+            source_files = [subj_dir / 'mri' / 'orig.mgz', subj_dir / 'mri' / 'filled.mgz']
+        data, properties = preprocess_subject(model, source_files, cache, tmp_dir / 'input', sid)
+
+        ref, ref_seconds = predict_array(model, data, properties, get_budget('default'), tmp_dir)
+        results[name] = {'default': {'seconds': ref_seconds}}
+        print(f'[{name}] default: {ref_seconds:.1f}s')
+        for budget_name in args.budgets:
+            pred, seconds = predict_array(model, data, properties, get_budget(budget_name), tmp_dir)
+            if name == 'brain_finalsurfs':
+                metrics = finalsurfs_metrics(pred, ref)
+                ok = metrics['mae_brain'] <= args.max_finalsurfs_mae
+            else:
+                metrics = levelset_metrics(pred, ref)
+                ok = metrics['mae_band'] <= args.max_levelset_mae and metrics['dice_inside'] >= args.min_levelset_dice
+            metrics['seconds'] = seconds
+            metrics['speedup'] = ref_seconds / seconds
+            metrics['ok'] = bool(ok)
+            results[name][budget_name] = metrics
+            passed = passed and (ok or budget_name == 'accurate')  # accurate 比 default 更准，差异不作为失败
+            print(f'[{name}] {budget_name}: ' + ', '.join(f'{k}={v:.4f}' if isinstance(v, float) else f'{k}={v}'
+                                                          for k, v in metrics.items()))
+    return results, passed
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        if args.synthetic:
+            subj_dir = tmp_dir / 'phantom'
+            make_phantom(subj_dir)
+        else:
+            subj_dir = Path(args.sd) / args.sid
+        results, passed = check_budget(args, subj_dir, tmp_dir)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not passed:
+        exit(1)
@@ -0,0 +1,93 @@
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+from scipy.ndimage import binary_fill_holes, binary_dilation
+
+from morphology import label_mask, roi_morphology
+
+LH_LABELS = [2, 4, 5, 10, 11, 12, 13, 17, 18, 26, 28, 30, 31]
+RH_LABELS = [41, 43, 44, 49, 50, 51, 52, 53, 54, 58, 60, 62, 63]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='FastCSR: check the ROI morphology against the full-volume one')
+    parser.add_argument('--sd', help='Subjects dir of an already processed subject (e.g. the example data/)')
+    parser.add_argument('--sid', help='Subject ID, needs mri/aseg.presurf.mgz and mri/brainmask.mgz')
+    parser.add_argument('--synthetic', default=False, action='store_true',
+                        help='Use random blobs (including masks touching the volume border) instead of a subject')
+    args = parser.parse_args()
+    if not args.synthetic and (args.sd is None or args.sid is None):
+        raise ValueError('Set --sd and --sid, or use --synthetic')
+    return args
+
+
+# 原实现：整个体积上的逐 label mask 与迭代膨胀
+def full_aseg_mask(aseg_np, labels):
+    aseg_mask = np.zeros(aseg_np.shape, bool)
+    for idx in labels:
+        aseg_mask = aseg_mask | (aseg_np == idx)
+    aseg_mask = binary_dilation(aseg_mask, iterations=6)
+    return binary_fill_holes(aseg_mask)
+
+
+def full_brainmask(aseg_np):
+    brain_mask = aseg_np.astype(bool)
+    brain_mask = binary_fill_holes(brain_mask)
+    brain_mask = binary_dilation(brain_mask, iterations=5)
+    return binary_fill_holes(brain_mask)
+
+
+def make_synthetic(shape=(128, 128, 128), seed=0):
+    """
+    Label volumes with random hollow blobs, one of them cut by the volume border
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(i) for i in shape], indexing='ij'))
+    volumes = list()
+    for center in [(64, 64, 64), (5, 64, 120), (0, 0, 0)]:
+        radius = np.sqrt(((grid - np.array(center)[:, None, None, None]) ** 2).sum(0))
+        aseg_np = np.zeros(shape, dtype=np.float32)
+        shell = (radius < 30) & (radius > 20)
+        aseg_np[shell] = rng.choice(LH_LABELS + RH_LABELS + [0, 7, 77], size=shell.sum())
+        volumes.append(aseg_np)
+    return volumes
+
+
+def check(aseg_np, brainmask_np=None):
+    ok = True
+    for name, reference, roi in [
+        ('brainmask', lambda: full_brainmask(aseg_np),
+         lambda: roi_morphology(aseg_np.astype(bool), dilation=5, fill_before=True)),
+        ('lh aseg_mask', lambda: full_aseg_mask(aseg_np, LH_LABELS),
+         lambda: roi_morphology(label_mask(aseg_np, LH_LABELS), dilation=6)),
+        ('rh aseg_mask', lambda: full_aseg_mask(aseg_np, RH_LABELS),
+         lambda: roi_morphology(label_mask(aseg_np, RH_LABELS), dilation=6)),
+    ] + ([] if brainmask_np is None else [
+        ('brain_mask', lambda: binary_fill_holes(brainmask_np > 0), lambda: roi_morphology(brainmask_np > 0)),
+    ]):
+        tic = time.time()
+        expected = reference()
+        full_seconds = time.time() - tic
+        tic = time.time()
+        result = roi()
+        roi_seconds = time.time() - tic
+        diff = int(np.sum(expected != result))
+        ok = ok and diff == 0
+        print(f'{name}: {diff} different voxels, full {full_seconds:.2f}s, roi {roi_seconds:.2f}s')
+    return ok
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.synthetic:
+        passed = all([check(aseg_np) for aseg_np in make_synthetic()])
+    else:
+        import ants
+        mri_dir = Path(args.sd) / args.sid / 'mri'
+        aseg = ants.iMath_get_largest_component(ants.image_read(str(mri_dir / 'aseg.presurf.mgz')))
+        brainmask = ants.image_read(str(mri_dir / 'brainmask.mgz'))
+        passed = check(aseg.numpy(), brainmask.numpy())
+    if not passed:
+        exit(1)
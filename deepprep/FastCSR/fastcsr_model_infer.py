@@ -13,11 +13,17 @@ from nnunet.preprocessing.preprocessing import GenericPreprocessor
 import SimpleITK as sitk
 import ants
 
+from inference_service import run_remote
+from preprocess_cache import get_subject_cache, preprocess_subject
+from inference_budget import get_budget, add_budget_args, get_budget_from_args, predict_3D_budget
+
 
 class LevelsetPredictor(object):
     def __init__(self, hemi, device, model_path: Path = Path('model')):
         self.hemi = hemi
         self.device = device
+        # 原实现中 predict_3D 的镜像设置
+        self.default_mirror_axes = (0, 1, 2)
         if self.hemi == 'lh':
             self.model_file = model_path / 'lh_model.pth'
         elif self.hemi == 'rh':
@@ -54,12 +60,11 @@ class LevelsetPredictor(object):
                                dropout_op_kwargs,
                                net_nonlin, net_nonlin_kwargs, False, False, final_nonlin, InitWeights_He(1e-2),
                                net_num_pool_op_kernel_sizes, net_conv_kernel_sizes, False, True, True)
-        network.to(device)
+        network.to(self.device)
         return network
 
-    # 模型前传
-    def infer(self, input_files, levelset_file):
-        # preprocess
+    # 模型输入预处理（crop + resample + normalize），结果可在同一 plans 的模型之间复用
+    def preprocess(self, input_files):
         normalization_schemes = self.plans['normalization_schemes']
         use_mask_for_norm = self.plans['use_mask_for_norm']
         transpose_forward = self.plans['transpose_forward']
@@ -68,35 +73,43 @@ class LevelsetPredictor(object):
         preprocessor = GenericPreprocessor(normalization_schemes, use_mask_for_norm, transpose_forward,
                                            intensity_properties)
         data, seg, properties = preprocessor.preprocess_test_case(input_files, current_spacing)
+        return data, properties
 
-        all_in_gpu = False
-        pad_border_mode = 'constant'
-        pad_kwargs = {'constant_values': 0}
+    # 模型前传
+    def infer(self, input_files, levelset_file, budget=None):
+        data, properties = self.preprocess(input_files)
+        self.predict(data, properties, levelset_file, budget)
+
+    def predict_array(self, data, properties, budget=None):
+        """
+        return: 原始图像大小的预测结果 (float32)，轴顺序与 sitk.GetArrayFromImage 相同
+        """
+        # budget: 推理开销（镜像 TTA / 滑窗步长 / patch 批大小），None 时与原实现一致，见 inference_budget.py
+        if budget is None:
+            budget = get_budget('default')
         patch_size = self.plans['plans_per_stage'][0]['patch_size']
-        mirror_axes = (0, 1, 2)
         # model infer
-        pred = self.network.predict_3D(data, do_mirroring=True, mirror_axes=mirror_axes,
-                                       use_sliding_window=True, step_size=0.5,
-                                       patch_size=patch_size, regions_class_order=None,
-                                       use_gaussian=True, pad_border_mode=pad_border_mode,
-                                       pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu, verbose=True,
-                                       mixed_precision=True)[1]
+        pred = predict_3D_budget(self.network, data, patch_size, budget, default_mirror_axes=self.default_mirror_axes)
 
         shape_original_before_cropping = properties['original_size_of_raw_data']
         bbox = properties['crop_bbox']
-        levelset_np = np.zeros(shape_original_before_cropping)
+        levelset_np = np.zeros(shape_original_before_cropping, dtype=np.float32)
         levelset_np[bbox[0][0]:bbox[0][1], bbox[1][0]:bbox[1][1], bbox[2][0]:bbox[2][1]] = pred[0]
-        levelset_itk = sitk.GetImageFromArray(levelset_np.astype(np.float32))
+        return levelset_np
+
+    def predict(self, data, properties, levelset_file, budget=None):
+        levelset_np = self.predict_array(data, properties, budget)
+        levelset_itk = sitk.GetImageFromArray(levelset_np)
         levelset_itk.SetSpacing(properties['itk_spacing'])
         levelset_itk.SetOrigin(properties['itk_origin'])
         levelset_itk.SetDirection(properties['itk_direction'])
         sitk.WriteImage(levelset_itk, levelset_file)
 
     # 调用入口
-    def process(self, input_files, fastcsr_subjects_dir, subj, hemi):
+    def process(self, input_files, fastcsr_subjects_dir, subj, hemi, budget=None):
         # levelset为模型预测结果
         levelset_file = fastcsr_subjects_dir / subj / 'mri' / f'{hemi}_levelset.nii.gz'
-        self.infer(input_files, str(levelset_file))
+        self.infer(input_files, str(levelset_file), budget)
 
 
 # 依赖文件：
@@ -133,16 +146,25 @@ if __name__ == '__main__':
     parser.add_argument('--subj', required=True)
     parser.add_argument('--hemi', required=True, choices=['lh', 'rh'])
     parser.add_argument('--suffix', default='orig.nofix', choices=['orig.nofix', 'orig'])
+    parser.add_argument('--service-socket', default=os.environ.get('FASTCSR_SOCKET'),
+                        help='Unix socket of a running inference_service.py, otherwise run the model in this process')
+    parser.add_argument('--preprocess-cache', default='on', choices=['on', 'off'],
+                        help='Share the preprocessed model input with the other hemisphere via $subj/tmp/preprocess_cache')
+    add_budget_args(parser)
     args = parser.parse_args()
     fastcsr_subjects_dir = Path(args.fastcsr_subjects_dir)
     subj = args.subj
     hemi = args.hemi
 
+    budget = get_budget_from_args(args)
+
+    # 推理服务已加载模型时直接由服务完成
+    if run_remote(args.service_socket, 'levelset', fastcsr_subjects_dir, subj, hemi, budget=budget):
+        exit(0)
+
     # 模型输入文件存储临时目录
     input_path = fastcsr_subjects_dir / subj / 'tmp' / f'{hemi}_input'
     os.makedirs(input_path, exist_ok=True)
-    # 准备深度学习模型输入
-    convert_data(fastcsr_subjects_dir, input_path, subj)
 
     # 深度学习模型运行设备
     if torch.cuda.is_available():
@@ -152,8 +174,18 @@ if __name__ == '__main__':
     # 模型初始化
     model_path = Path(args.model_path)
     levelset_model = LevelsetPredictor(hemi=hemi, device=device, model_path=model_path)
-    # 输入文件
-    input_files = sorted(glob.glob(str(input_path / '*.nii.gz')))
-    # FactCSR处理过程
-    levelset_model.process(input_files, fastcsr_subjects_dir, subj, hemi)
-    shutil.rmtree(input_path)
+    if args.preprocess_cache == 'on':
+        # lh/rh 的输入与预处理参数相同，预处理结果只计算一次
+        source_files = [fastcsr_subjects_dir / subj / 'mri' / 'orig.mgz', fastcsr_subjects_dir / subj / 'mri' / 'filled.mgz']
+        data, properties = preprocess_subject(levelset_model, source_files, get_subject_cache(fastcsr_subjects_dir / subj),
+                                              input_path, subj)
+        levelset_file = fastcsr_subjects_dir / subj / 'mri' / f'{hemi}_levelset.nii.gz'
+        levelset_model.predict(data, properties, str(levelset_file), budget)
+    else:
+        # 准备深度学习模型输入
+        convert_data(fastcsr_subjects_dir, input_path, subj)
+        # 输入文件
+        input_files = sorted(glob.glob(str(input_path / '*.nii.gz')))
+        # FactCSR处理过程
+        levelset_model.process(input_files, fastcsr_subjects_dir, subj, hemi, budget)
+    shutil.rmtree(input_path, ignore_errors=True)
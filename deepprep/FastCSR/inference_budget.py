@@ -0,0 +1,140 @@
+"""
+Inference budget of the FastCSR regression networks (levelset, brain_finalsurfs).
+
+A budget controls the cost of the nnUNet sliding-window prediction:
+- mirror_axes: test-time mirroring axes, () disables TTA, (0, 1, 2) is 8x TTA;
+  None keeps the model's own default (levelset mirrors all axes, brain_finalsurfs none)
+- step_size:   sliding window step as a fraction of the patch size (smaller = more overlap)
+- batch_size:  number of patches per forward pass
+
+'default' reproduces the original predict_3D call exactly. Use check_budget.py to
+compare the other presets against it before switching.
+"""
+import contextlib
+from itertools import combinations, product
+
+import numpy as np
+
+INFERENCE_BUDGETS = {
+    'fast': {'mirror_axes': (), 'step_size': 1.0, 'batch_size': 4},
+    'default': {'mirror_axes': None, 'step_size': 0.5, 'batch_size': 1},
+    'accurate': {'mirror_axes': (0, 1, 2), 'step_size': 0.33, 'batch_size': 1},
+}
+
+
+def parse_mirror_axes(text):
+    """
+    'none' -> (), '0,1,2' -> (0, 1, 2)
+    """
+    if text is None:
+        return None
+    if text.lower() == 'none':
+        return tuple()
+    return tuple(sorted(int(i) for i in text.split(',')))
+
+
+def add_budget_args(parser):
+    parser.add_argument('--budget', default='default', choices=list(INFERENCE_BUDGETS.keys()),
+                        help='Inference budget preset (mirroring TTA / sliding window overlap / patch batching)')
+    parser.add_argument('--mirror-axes', type=parse_mirror_axes, help="Override the preset mirror axes, e.g. '0,1,2' or 'none'")
+    parser.add_argument('--step-size', type=float, help='Override the preset sliding window step size (0, 1]')
+    parser.add_argument('--batch-size', type=int, help='Override the preset number of patches per forward pass')
+
+
+def get_budget(name='default', mirror_axes=None, step_size=None, batch_size=None):
+    budget = dict(INFERENCE_BUDGETS[name])
+    if mirror_axes is not None:
+        budget['mirror_axes'] = mirror_axes
+    if step_size is not None:
+        budget['step_size'] = step_size
+    if batch_size is not None:
+        budget['batch_size'] = batch_size
+    if not 0 < budget['step_size'] <= 1:
+        raise ValueError(f"step_size must be in (0, 1], got {budget['step_size']}")
+    if budget['batch_size'] < 1:
+        raise ValueError(f"batch_size must be >= 1, got {budget['batch_size']}")
+    return budget
+
+
+def get_budget_from_args(args):
+    return get_budget(args.budget, args.mirror_axes, args.step_size, args.batch_size)
+
+
+def predict_sliding_window_batched(network, x, patch_size, step_size, mirror_axes, batch_size, mixed_precision=True):
+    """
+    Same result as Generic_UNet._internal_predict_3D_3Dconv_tiled with a gaussian
+    importance map, but batch_size patches (and all their mirrored copies) per forward pass.
+    x: (c, x, y, z) preprocessed data
+    return: (num_classes, x, y, z) float32
+    """
+    import torch
+    from batchgenerators.augmentations.utils import pad_nd_image
+
+    device = next(network.parameters()).device
+    patch_size = tuple(patch_size)
+    data, slicer = pad_nd_image(x, patch_size, 'constant', {'constant_values': 0}, True, None)
+    steps = network._compute_steps_for_sliding_window(patch_size, data.shape[1:], step_size)
+    tiles = list(product(*steps))
+
+    if len(tiles) > 1:
+        gaussian = network._get_gaussian(patch_size, sigma_scale=1. / 8)
+    else:
+        gaussian = np.ones(patch_size, dtype=np.float32)
+    gaussian_torch = torch.from_numpy(gaussian).to(device)
+
+    aggregated_results = np.zeros([network.num_classes] + list(data.shape[1:]), dtype=np.float32)
+    aggregated_nb_of_predictions = np.zeros(data.shape[1:], dtype=np.float32)
+
+    # 所有镜像组合（包括不翻转），对应 (b, c, x, y, z) 中的维度 2, 3, 4
+    flips = [tuple(axis + 2 for axis in axes)
+             for r in range(len(mirror_axes) + 1) for axes in combinations(sorted(mirror_axes), r)]
+
+    if mixed_precision and device.type == 'cuda':
+        context = torch.cuda.amp.autocast
+    else:
+        context = contextlib.nullcontext
+
+    with context(), torch.no_grad():
+        for start in range(0, len(tiles), batch_size):
+            slices = [tuple(slice(t, t + p) for t, p in zip(tile, patch_size)) for tile in tiles[start:start + batch_size]]
+            batch = torch.from_numpy(np.stack([data[(slice(None),) + s] for s in slices])).to(device)
+
+            pred = torch.zeros((len(slices), network.num_classes) + patch_size, dtype=torch.float, device=device)
+            for dims in flips:
+                if len(dims) > 0:
+                    pred += torch.flip(network.inference_apply_nonlin(network(torch.flip(batch, dims))), dims).float()
+                else:
+                    pred += network.inference_apply_nonlin(network(batch)).float()
+            pred = (pred / len(flips) * gaussian_torch).cpu().numpy()
+
+            for s, predicted_patch in zip(slices, pred):
+                aggregated_results[(slice(None),) + s] += predicted_patch
+                aggregated_nb_of_predictions[s] += gaussian
+
+    # 去掉为满足 patch 大小而做的 padding
+    slicer = tuple(slicer[1:])
+    aggregated_results = aggregated_results[(slice(None),) + slicer]
+    aggregated_results /= aggregated_nb_of_predictions[slicer]
+    return aggregated_results
+
+
+def predict_3D_budget(network, data, patch_size, budget, default_mirror_axes=(0, 1, 2)):
+    """
+    Sliding window prediction of a FastCSR regression network under an inference budget.
+    return: (num_classes, x, y, z) float32
+    """
+    mirror_axes = budget['mirror_axes']
+    if mirror_axes is None:
+        mirror_axes = default_mirror_axes
+
+    if budget['batch_size'] == 1:
+        # 与原实现相同的 nnUNet 调用
+        return network.predict_3D(data, do_mirroring=len(mirror_axes) > 0,
+                                  mirror_axes=mirror_axes if len(mirror_axes) > 0 else (0, 1, 2),
+                                  use_sliding_window=True, step_size=budget['step_size'],
+                                  patch_size=patch_size, regions_class_order=None,
+                                  use_gaussian=True, pad_border_mode='constant',
+                                  pad_kwargs={'constant_values': 0}, all_in_gpu=False, verbose=True,
+                                  mixed_precision=True)[1]
+    return predict_sliding_window_batched(network, data, patch_size, budget['step_size'], mirror_axes,
+                                          budget['batch_size'])
@@ -0,0 +1,401 @@
+"""
+Long-lived FastCSR inference service.
+
+All FastCSR networks (filled / aseg_presurf nnUNet segmentation, lh/rh levelset
+regression, brain_finalsurfs regression) are loaded once and kept in memory.
+Requests arrive as one JSON line over a Unix socket, e.g.
+
+    {"task": "levelset", "subjects_dir": "/data", "sid": "sub-001", "hemi": "lh"}
+
+and the service writes the same output files as the standalone entry points.
+The nnUNet preprocessing result (crop + resample + normalize) is cached in
+memory by the source files and the preprocessing plans (see preprocess_cache.py),
+so models sharing plans reuse it.
+
+Start:  python3 inference_service.py --model-path <model>
+Client: pipeline.py / fastcsr_model_infer.py / brain_finalsurfs_model_infer.py
+        with --service-socket (or $FASTCSR_SOCKET); without a running service
+        they fall back to in-process execution. A request the service has accepted
+        but not answered within REQUEST_TIMEOUT fails the stage: the service still
+        runs it and writes its outputs, a fallback would write them a second time.
+
+The socket is created in a per-user directory ($XDG_RUNTIME_DIR, otherwise
+<tmp>/fastcsr-<uid> with mode 0700) unless --socket / $FASTCSR_SOCKET is set,
+and is only accessible by the user who started the service (mode 0600).
+"""
+import os
+import sys
+import json
+import stat
+import socket
+import shutil
+import argparse
+import logging
+import threading
+import socketserver
+import tempfile
+import traceback
+from pathlib import Path
+
+import numpy as np
+import ants
+
+from preprocess_cache import PreprocessCache, preprocess_subject
+
+TASKS = ['filled', 'aseg_presurf', 'levelset', 'brain_finalsurfs']
+
+# nnUNet task id of the segmentation models, same as the nnUNet_predict commands in pipeline.py
+SEGMENTATION_TASK_ID = {'filled': 601, 'aseg_presurf': 602}
+
+# 单个请求的最长等待时间（秒），包括在 model lock 前排队的时间；超时后该 stage 失败
+REQUEST_TIMEOUT = 3600
+
+
+def get_runtime_dir():
+    """
+    Per-user directory of the socket: $XDG_RUNTIME_DIR, otherwise <tmp>/fastcsr-<uid> with mode 0700
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return Path(runtime_dir)
+    runtime_dir = Path(tempfile.gettempdir()) / f'fastcsr-{os.getuid()}'
+    runtime_dir.mkdir(mode=0o700, exist_ok=True)
+    # 共享的 tmp 目录中可能已被其他用户抢先创建
+    st = runtime_dir.lstat()
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f'{runtime_dir} must be a directory of the current user with mode 0700')
+    return runtime_dir
+
+
+def get_default_socket():
+    socket_file = os.environ.get('FASTCSR_SOCKET')
+    if socket_file:
+        return socket_file
+    return str(get_runtime_dir() / 'fastcsr.sock')
+
+
+# ------------------------------------------ client ------------------------------------------
+def request_service(socket_file, request, timeout=REQUEST_TIMEOUT):
+    """
+    Send one request to the service.
+    return: response dict, None if the service is not running or went away before answering
+    raise: TimeoutError if the service accepted the request but did not answer within timeout seconds
+    """
+    if socket_file is None or not os.path.exists(socket_file):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(str(socket_file))
+            sock.settimeout(timeout)
+            sock.sendall((json.dumps(request) + '\n').encode())
+            with sock.makefile('r') as f:
+                line = f.readline()
+        except socket.timeout:
+            # 服务仍在运行这个请求并会写出结果，调用方不能再在本进程中写同样的文件
+            raise TimeoutError(f'FastCSR service did not answer within {timeout}s: {request}') from None
+        except (ConnectionError, FileNotFoundError):
+            return None
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def run_remote(socket_file, task, subjects_dir, sid, hemi=None, budget=None):
+    """
+    Run a FastCSR task on the service.
+    budget: inference budget of the regression networks, see inference_budget.py
+    return: True if the service produced the outputs, False if the caller should run in-process
+    raise: TimeoutError as request_service, the stage fails instead of running in-process
+    """
+    request = {'task': task, 'subjects_dir': str(subjects_dir), 'sid': sid, 'hemi': hemi, 'budget': budget}
+    response = request_service(socket_file, request)
+    if response is None:
+        return False
+    if response['status'] != 'ok':
+        logging.error(f'FastCSR service failed on {task} {sid} {hemi or ""}: {response.get("msg")}')
+        return False
+    return True
+
+
+# ------------------------------------------ models ------------------------------------------
+class SegmentationPredictor(object):
+    """
+    In-process equivalent of
+    nnUNet_predict -m 3d_fullres -tr nnUNetTrainerV2 -t <task_id> -chk final
+    """
+
+    def __init__(self, task_id, checkpoint='final', trainer='nnUNetTrainerV2', plans_identifier='nnUNetPlansv2.1'):
+        from nnunet.paths import network_training_output_dir
+        from nnunet.utilities.task_name_id_conversion import convert_id_to_task_name
+        from nnunet.training.model_restore import load_model_and_checkpoint_files
+
+        self.model_folder = os.path.join(network_training_output_dir, '3d_fullres', convert_id_to_task_name(task_id),
+                                         f'{trainer}__{plans_identifier}')
+        self.trainer, self.params = load_model_and_checkpoint_files(self.model_folder, None, mixed_precision=True,
+                                                                    checkpoint_name=checkpoint)
+        self.plans = self.trainer.plans
+        self.stage = self.trainer.stage
+        self.preprocessor_name = self.plans.get('preprocessor_name', 'GenericPreprocessor')
+
+    def preprocess(self, input_files):
+        d, _, properties = self.trainer.preprocess_patient(input_files)
+        return d, properties
+
+    def predict_softmax(self, data):
+        # ensemble of all folds, with mirroring as nnUNet_predict does by default
+        softmax = list()
+        for params in self.params:
+            self.trainer.load_checkpoint_ram(params, False)
+            softmax.append(self.trainer.predict_preprocessed_data_return_seg_and_softmax(
+                data, do_mirroring=True, mirror_axes=self.trainer.data_aug_params['mirror_axes'],
+                use_sliding_window=True, step_size=0.5, use_gaussian=True, all_in_gpu=False,
+                mixed_precision=True)[1][None])
+        softmax = np.vstack(softmax).mean(0)
+
+        transpose_backward = self.plans.get('transpose_backward')
+        if transpose_backward is not None:
+            softmax = softmax.transpose([0] + [i + 1 for i in transpose_backward])
+        return softmax
+
+    def get_postprocessing(self):
+        from nnunet.postprocessing.connected_components import load_postprocessing
+
+        pp_file = os.path.join(self.model_folder, 'postprocessing.json')
+        if os.path.isfile(pp_file):
+            return load_postprocessing(pp_file)
+        return None
+
+    def predict(self, data, properties, seg_file):
+        from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
+        from nnunet.postprocessing.connected_components import load_remove_save
+
+        softmax = self.predict_softmax(data)
+        export_params = self.plans.get('segmentation_export_params', dict())
+        save_segmentation_nifti_from_softmax(softmax, seg_file, properties,
+                                             order=export_params.get('interpolation_order', 1),
+                                             force_separate_z=export_params.get('force_separate_z'),
+                                             interpolation_order_z=export_params.get('interpolation_order_z', 0))
+
+        postprocessing = self.get_postprocessing()
+        if postprocessing is not None:
+            for_which_classes, min_valid_obj_size = postprocessing
+            load_remove_save(seg_file, seg_file, for_which_classes, min_valid_obj_size)
+
+    def predict_array(self, data, properties):
+        """
+        Same segmentation as predict, without the nifti round trip.
+        return: uint8 label array of the original image size, axes as sitk.GetArrayFromImage
+        """
+        from nnunet.preprocessing.preprocessing import get_do_separate_z, get_lowres_axis, resample_data_or_seg
+        from nnunet.postprocessing.connected_components import remove_all_but_the_largest_connected_component
+
+        softmax = self.predict_softmax(data)
+        export_params = self.plans.get('segmentation_export_params', dict())
+
+        # save_segmentation_nifti_from_softmax: resample back to the spacing before preprocessing
+        shape_after_cropping = properties['size_after_cropping']
+        if np.any(np.array(softmax.shape[1:]) != np.array(shape_after_cropping)):
+            force_separate_z = export_params.get('force_separate_z')
+            if force_separate_z is None:
+                if get_do_separate_z(properties['original_spacing']):
+                    lowres_axis = get_lowres_axis(properties['original_spacing'])
+                elif get_do_separate_z(properties['spacing_after_resampling']):
+                    lowres_axis = get_lowres_axis(properties['spacing_after_resampling'])
+                else:
+                    lowres_axis = None
+            else:
+                lowres_axis = get_lowres_axis(properties['original_spacing']) if force_separate_z else None
+            if lowres_axis is not None and len(lowres_axis) != 1:
+                lowres_axis = None
+            softmax = resample_data_or_seg(softmax, shape_after_cropping, is_seg=False, axis=lowres_axis,
+                                           order=export_params.get('interpolation_order', 1),
+                                           do_separate_z=lowres_axis is not None,
+                                           order_z=export_params.get('interpolation_order_z', 0))
+
+        seg_cropped = softmax.argmax(0)
+        shape_original_before_cropping = properties['original_size_of_raw_data']
+        bbox = properties['crop_bbox']
+        seg = np.zeros(shape_original_before_cropping, dtype=np.uint8)
+        upper = [min(bbox[c][0] + seg_cropped.shape[c], shape_original_before_cropping[c]) for c in range(3)]
+        seg[bbox[0][0]:upper[0], bbox[1][0]:upper[1], bbox[2][0]:upper[2]] = seg_cropped
+
+        postprocessing = self.get_postprocessing()
+        if postprocessing is not None:
+            for_which_classes, min_valid_obj_size = postprocessing
+            volume_per_voxel = float(np.prod(properties['itk_spacing'], dtype=np.float64))
+            seg = remove_all_but_the_largest_connected_component(seg, for_which_classes, volume_per_voxel,
+                                                                 min_valid_obj_size)[0]
+        return seg
+
+
+def get_device():
+    import torch
+    if torch.cuda.is_available():
+        return torch.device('cuda')
+    return torch.device('cpu')
+
+
+class FastCSRModels(object):
+    """
+    All FastCSR networks of one process, loaded on first use (or by preload) and never released.
+    """
+
+    names = ['filled', 'aseg_presurf', 'levelset_lh', 'levelset_rh', 'brain_finalsurfs']
+
+    def __init__(self, model_path: Path, brain_finalsurfs_model_path: Path = None):
+        self.model_path = Path(model_path)
+        if brain_finalsurfs_model_path is None:
+            brain_finalsurfs_model_path = Path(os.path.split(os.path.abspath(__file__))[0]) / 'model'
+        self.brain_finalsurfs_model_path = Path(brain_finalsurfs_model_path)
+        self.models = dict()
+        self.model_locks = {name: threading.Lock() for name in self.names}
+        self._lock = threading.Lock()
+
+    def load(self, name):
+        if name in SEGMENTATION_TASK_ID:
+            return SegmentationPredictor(SEGMENTATION_TASK_ID[name])
+        elif name.startswith('levelset_'):
+            from fastcsr_model_infer import LevelsetPredictor
+            return LevelsetPredictor(hemi=name.split('_')[1], device=get_device(), model_path=self.model_path)
+        elif name == 'brain_finalsurfs':
+            from brain_finalsurfs_model_infer import BrainFinalsurfsPredictor
+            return BrainFinalsurfsPredictor(device=get_device(), model_path=self.brain_finalsurfs_model_path)
+        raise KeyError(name)
+
+    def get(self, name):
+        with self._lock:
+            if name not in self.models:
+                logging.info(f'load model: {name}')
+                self.models[name] = self.load(name)
+            return self.models[name]
+
+    def preload(self, names=None):
+        for name in names or self.names:
+            self.get(name)
+
+
+# ------------------------------------------ service ------------------------------------------
+class FastCSRService(object):
+    def __init__(self, models: FastCSRModels, cache: PreprocessCache):
+        self.models = models
+        self.cache = cache
+
+    def run_model(self, name, source_files, tmp_path: Path, sid, output_file, budget=None):
+        model = self.models.get(name)
+        data, properties = preprocess_subject(model, source_files, self.cache, tmp_path / 'tmp_input', sid)
+        with self.models.model_locks[name]:
+            if budget is None:
+                model.predict(data, properties, str(output_file))
+            else:
+                model.predict(data, properties, str(output_file), budget)
+
+    def run(self, task, subjects_dir, sid, hemi=None, budget=None):
+        from pipeline import convert_filled, convert_aseg_presurf
+
+        subj_dir = Path(subjects_dir) / sid
+        mri_dir = subj_dir / 'mri'
+        orig_file = mri_dir / 'orig.mgz'
+        tmp_path = subj_dir / 'tmp' / f'service_{task}' if hemi is None else subj_dir / 'tmp' / f'service_{task}_{hemi}'
+        output_path = tmp_path / 'tmp_output'
+        output_path.mkdir(parents=True, exist_ok=True)
+        try:
+            if task == 'filled':
+                seg_file = output_path / f'{sid}.nii.gz'
+                self.run_model('filled', [orig_file], tmp_path, sid, seg_file)
+                convert_filled(seg_file, mri_dir / 'filled.mgz')
+            elif task == 'aseg_presurf':
+                seg_file = output_path / f'{sid}.nii.gz'
+                self.run_model('aseg_presurf', [orig_file], tmp_path, sid, seg_file)
+                convert_aseg_presurf(seg_file, mri_dir / 'aseg.presurf.mgz')
+            elif task == 'levelset':
+                if hemi not in ['lh', 'rh']:
+                    raise ValueError(f'hemi parameter error: {hemi}')
+                self.run_model(f'levelset_{hemi}', [orig_file, mri_dir / 'filled.mgz'], tmp_path, sid,
+                               mri_dir / f'{hemi}_levelset.nii.gz', budget)
+            elif task == 'brain_finalsurfs':
+                brain_finalsurfs_file = output_path / 'brain_finalsurfs.nii.gz'
+                self.run_model('brain_finalsurfs', [orig_file], tmp_path, sid, brain_finalsurfs_file, budget)
+                brain_finalsurfs = ants.image_read(str(brain_finalsurfs_file))
+                ants.image_write(brain_finalsurfs, str(mri_dir / 'brain.finalsurfs.mgz'))
+            else:
+                raise ValueError(f'unknown task: {task}, choose from {TASKS}')
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            if request.get('task') == 'ping':
+                response = {'status': 'ok'}
+            else:
+                logging.info(f'request: {request}')
+                budget = request.get('budget')
+                if budget is not None and budget.get('mirror_axes') is not None:
+                    budget['mirror_axes'] = tuple(budget['mirror_axes'])  # json 中为 list
+                self.server.service.run(request['task'], request['subjects_dir'], request['sid'],
+                                        request.get('hemi'), budget)
+                response = {'status': 'ok'}
+                logging.info(f'done: {request}')
+        except Exception as e:
+            traceback.print_exc()
+            response = {'status': 'error', 'msg': repr(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class FastCSRServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_file, service: FastCSRService):
+        self.service = service
+        super().__init__(str(socket_file), RequestHandler)
+
+    def server_bind(self):
+        # socket 只允许当前用户连接，bind 时即以 0600 创建
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='FastCSR inference service: keeps all FastCSR models in memory')
+    parser.add_argument('--socket', help='Unix socket to listen on, '
+                                         'default is $FASTCSR_SOCKET or fastcsr.sock in the per-user runtime dir')
+    parser.add_argument('--model-path', required=True, help='The Model path')
+    parser.add_argument('--brain-finalsurfs-model-path', help='Directory of brain_finalsurfs_model.pth, '
+                                                              'default is FastCSR/model')
+    parser.add_argument('--cache-size', type=int, default=4, help='Number of preprocessed cases kept in memory')
+    parser.add_argument('--preload', default=False, action='store_true',
+                        help='Load all models at startup instead of on first request')
+    args = parser.parse_args()
+    if args.socket is None:
+        args.socket = get_default_socket()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s %(message)s', stream=sys.stdout)
+    # nnunet.paths 在 import 时读取 RESULTS_FOLDER
+    if os.environ.get('RESULTS_FOLDER') is None:
+        os.environ['RESULTS_FOLDER'] = os.path.join(args.model_path, 'nnUNet_trained_models')
+
+    models = FastCSRModels(Path(args.model_path), args.brain_finalsurfs_model_path)
+    if args.preload:
+        models.preload()
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    with FastCSRServer(args.socket, FastCSRService(models, PreprocessCache(max_items=args.cache_size))) as server:
+        logging.info(f'FastCSR service listening on {args.socket}')
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(args.socket)
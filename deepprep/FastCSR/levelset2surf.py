@@ -3,30 +3,43 @@ import argparse
 from pathlib import Path
 from collections import OrderedDict
 import nighres
-import tempfile
 import nibabel as nib
-from scipy.ndimage import binary_fill_holes, binary_dilation
 import ants
 import numpy as np
 
+from morphology import label_mask, roi_morphology
+
+
+def ants_to_nifti(img):
+    """
+    ants image (LPS) -> nibabel Nifti1Image (RAS)，数据不经过磁盘
+    """
+    affine = np.eye(4)
+    affine[:3, :3] = np.asarray(img.direction) @ np.diag(img.spacing)
+    affine[:3, 3] = img.origin
+    affine = np.diag([-1, -1, 1, 1]) @ affine
+    return nib.Nifti1Image(img.numpy(), affine)
+
 
 # 从模型预测得到的levelset文件重建出surface
 def levelset2surf(fastcsr_subjects_dir, subj, hemi, suffix):
     print(f'subject: {subj}, hemi: {hemi}')
     os.makedirs(fastcsr_subjects_dir / subj / 'surf', exist_ok=True)
     orig_file = fastcsr_subjects_dir / subj / 'mri' / 'orig.mgz'
+    brainmask = ants.image_read(str(fastcsr_subjects_dir / subj / 'mri' / 'brainmask.mgz'))
+    aseg = ants.image_read(str(fastcsr_subjects_dir / subj / 'mri' / 'aseg.presurf.mgz'))
+    levelset = ants.image_read(str(fastcsr_subjects_dir / subj / 'mri' / f'{hemi}_levelset.nii.gz'))
+    surf_file = fastcsr_subjects_dir / subj / 'surf' / f'{hemi}.{suffix}'
+    levelset_to_surface(levelset, brainmask, aseg, orig_file, hemi, surf_file)
 
+
+# levelset/brainmask/aseg 为内存中的 ants image，只写出最终的 surface 文件
+def levelset_to_surface(levelset, brainmask, aseg, orig_file, hemi, surf_file):
     # 计算mask，对模型预测的levelset进行后处理，以增强结果稳健性
-    brainmask_file = fastcsr_subjects_dir / subj / 'mri' / 'brainmask.mgz'
-    brainmask = ants.image_read((str(brainmask_file)))
     brainmask_np = brainmask.numpy()
 
-    brain_mask = brainmask_np > 0
-    brain_mask = binary_fill_holes(brain_mask)
-
-    aseg_file = fastcsr_subjects_dir / subj / 'mri' / 'aseg.presurf.mgz'
+    brain_mask = roi_morphology(brainmask_np > 0)
 
-    aseg = ants.image_read(str(aseg_file))
     aseg_np = aseg.numpy()
 
     if hemi == 'lh':
@@ -34,30 +47,22 @@ def levelset2surf(fastcsr_subjects_dir, subj, hemi, suffix):
     else:
         brainmask_aseg_idx = [41, 43, 44, 49, 50, 51, 52, 53, 54, 58, 60, 62, 63]
 
-    aseg_mask = np.zeros(aseg_np.shape, bool)
-    for idx in brainmask_aseg_idx:
-        aseg_mask = aseg_mask | (aseg_np == idx)
-
-    aseg_mask = binary_dilation(aseg_mask, iterations=6)
-    aseg_mask = binary_fill_holes(aseg_mask)
+    # 只在 label 的 bounding box 内做膨胀与填洞，结果与整个体积上计算相同
+    aseg_mask = roi_morphology(label_mask(aseg_np, brainmask_aseg_idx), dilation=6)
     mask_np = brain_mask & aseg_mask
 
-    levelset = ants.image_read(str(fastcsr_subjects_dir / subj / 'mri' / f'{hemi}_levelset.nii.gz'))
     levelset_np = levelset.numpy()
 
     levelset_fix_np = np.ones_like(levelset_np)
     levelset_fix_np[mask_np] = levelset_np[mask_np]
     levelset_fix_np = levelset_fix_np * 3
     levelset_fix = ants.from_numpy(levelset_fix_np, levelset.origin, levelset.spacing, levelset.direction)
-    temp_file = tempfile.mktemp(suffix='.nii.gz')
-    ants.image_write(levelset_fix, temp_file)
 
     # 使用nighres进行surface重建
-    img = nighres.io.load_volume(temp_file)
+    img = ants_to_nifti(levelset_fix)
     tc_ret = nighres.shape.topology_correction(img, 'signed_distance_function',
                                                propagation='background->object',
                                                connectivity='6/18')
-    os.remove(temp_file)
     l2m_ret = nighres.surface.levelset_to_mesh(tc_ret['corrected'], connectivity='6/18')
     print()
 
@@ -86,8 +91,6 @@ def levelset2surf(fastcsr_subjects_dir, subj, hemi, suffix):
     volume_info['zras'] = vox2ras[:3, 2].astype(np.float64)
     volume_info['cras'] = norm_nib.header.get('Pxyz_c').astype(np.float64)
 
-    # ？h.orig.nofix文件保存路径
-    surf_file = fastcsr_subjects_dir / subj / 'surf' / f'{hemi}.{suffix}'
     nib.freesurfer.write_geometry(surf_file, points_ras, faces, volume_info=volume_info)
 
 
@@ -5,13 +5,20 @@ import argparse
 import shutil
 from pathlib import Path
 from multiprocessing import Process, Lock
+from concurrent.futures import ThreadPoolExecutor
+import time
 import logging
 import subprocess
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import numpy as np
 import sh
 import ants
-from scipy.ndimage import binary_fill_holes, binary_dilation
+
+from inference_service import run_remote
+from morphology import roi_morphology
+from inference_budget import INFERENCE_BUDGETS, get_budget
 
 
 def set_environ(freesurfer_home, jvm_home, model_path):
@@ -46,6 +53,15 @@ def parse_args():
     parser.add_argument('--freesurfer-home', help="The FreeSurfer Home path")
     parser.add_argument('--jvm-home', help="The JVM Home path")
     parser.add_argument('--model-path', help="The Model path")
+    parser.add_argument('--service-socket', default=os.environ.get('FASTCSR_SOCKET'),
+                        help="Unix socket of a running inference_service.py; "
+                             "model inference runs in this process when the service is not available")
+    parser.add_argument('--budget', default='default', choices=list(INFERENCE_BUDGETS.keys()),
+                        help="Inference budget preset of the levelset and brain_finalsurfs models, see inference_budget.py")
+    parser.add_argument('--inprocess', default=False, action='store_true',
+                        help="Run all stages in this process and pass the intermediate images in memory, "
+                             "see pipeline_inprocess.py")
+    parser.add_argument('--timing-json', help="Also write the per-stage timing summary to this json file")
     args = parser.parse_args()
     if args.sd is None:
         raise ValueError('Subjects dir need to set via $SUBJECTS_DIR environment or --sd parameter')
@@ -106,10 +122,52 @@ def log_msg(msg, lock, level):
             logging.error(msg)
 
 
+# 各阶段耗时（秒），按执行顺序
+STAGE_TIMES = OrderedDict()
+
+
+@contextmanager
+def timed(stage):
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_TIMES[stage] = STAGE_TIMES.get(stage, 0) + time.perf_counter() - tic
+
+
+def log_timing(json_file=None):
+    logging.info('-------------------------------Stage timing---------------------------------------')
+    for stage, seconds in STAGE_TIMES.items():
+        logging.info(f'{stage}: {seconds:.2f}s')
+    logging.info(f'total: {sum(STAGE_TIMES.values()):.2f}s')
+    if json_file is not None:
+        with open(json_file, 'w') as f:
+            json.dump(STAGE_TIMES, f, indent=2)
+
+
+def filled_from_seg(filled):
+    # convert segmentation label to FreeSurfer filled label
+    filled_np = filled.numpy()
+    filled_np[filled_np == 1] = 127
+    filled_np[filled_np == 2] = 255
+    return ants.from_numpy(filled_np, filled.origin, filled.spacing, filled.direction)
+
+
+def convert_filled(seg_file, filled_file):
+    filled_pred = filled_from_seg(ants.image_read(str(seg_file)))
+    ants.image_write(filled_pred, str(filled_file))
+
+
 def create_filled(args, lock=None):
-    # prepare input
     subj_dir = Path(args.sd) / args.sid
+    if run_remote(args.service_socket, 'filled', args.sd, args.sid):
+        msg = 'Filled segmentation model inference completed.'
+        log_msg(msg, lock, logging.INFO)
+        msg = 'The mri/filled.mgz file has been generated.'
+        log_msg(msg, lock, logging.INFO)
+        return
 
+    # prepare input
     input_path = subj_dir / 'tmp' / 'filled' / 'tmp_input'
     output_path = subj_dir / 'tmp' / 'filled' / 'tmp_output'
     input_path.mkdir(parents=True, exist_ok=True)
@@ -127,22 +185,39 @@ def create_filled(args, lock=None):
         msg = 'Filled segmentation model inference failed.'
         log_msg(msg, lock, logging.ERROR)
         exit(-1)
-    # convert segmentation label to FreeSurfer filled label
-    filled = ants.image_read(str(output_path / f'{args.sid}.nii.gz'))
-    filled_np = filled.numpy()
-    filled_np[filled_np == 1] = 127
-    filled_np[filled_np == 2] = 255
-    filled_pred = ants.from_numpy(filled_np, filled.origin, filled.spacing, filled.direction)
-    ants.image_write(filled_pred, str(subj_dir / 'mri' / 'filled.mgz'))
+    convert_filled(output_path / f'{args.sid}.nii.gz', subj_dir / 'mri' / 'filled.mgz')
     shutil.rmtree(subj_dir / 'tmp' / 'filled')
     msg = 'The mri/filled.mgz file has been generated.'
     log_msg(msg, lock, logging.INFO)
 
 
+def aseg_presurf_from_seg(aseg_presurf):
+    # convert segmentation label to FreeSurfer aseg.presurf label
+    aseg_presurf_np = aseg_presurf.numpy()
+    fastcsr_path = Path(os.path.split(__file__)[0])
+    with open(fastcsr_path / 'model' / 'aseg_label_trans.json') as jf:
+        label2aseg = json.load(jf)['label2aseg']
+    aseg_pred_np = np.zeros_like(aseg_presurf_np)
+    for label in label2aseg:
+        aseg_pred_np[aseg_presurf_np == int(label)] = label2aseg[label]
+    return ants.from_numpy(aseg_pred_np, aseg_presurf.origin, aseg_presurf.spacing, aseg_presurf.direction)
+
+
+def convert_aseg_presurf(seg_file, aseg_presurf_file):
+    aseg_presurf_pred = aseg_presurf_from_seg(ants.image_read(str(seg_file)))
+    ants.image_write(aseg_presurf_pred, str(aseg_presurf_file))
+
+
 def create_aseg_presurf(args, lock=None):
-    # prepare input
     subj_dir = Path(args.sd) / args.sid
+    if run_remote(args.service_socket, 'aseg_presurf', args.sd, args.sid):
+        msg = 'Aseg_presurf segmentation model inference completed.'
+        log_msg(msg, lock, logging.INFO)
+        msg = 'The mri/aseg.presurf.mgz file has been generated.'
+        log_msg(msg, lock, logging.INFO)
+        return
 
+    # prepare input
     input_path = subj_dir / 'tmp' / 'aseg_presurf' / 'tmp_input'
     output_path = subj_dir / 'tmp' / 'aseg_presurf' / 'tmp_output'
     input_path.mkdir(parents=True, exist_ok=True)
@@ -160,52 +235,66 @@ def create_aseg_presurf(args, lock=None):
         msg = 'Aseg_presurf segmentation model inference failed.'
         log_msg(msg, lock, logging.ERROR)
         exit(-1)
-    # convert segmentation label to FreeSurfer aseg.presurf label
-    aseg_presurf = ants.image_read(str(output_path / f'{args.sid}.nii.gz'))
-    aseg_presurf_np = aseg_presurf.numpy()
-    fastcsr_path = Path(os.path.split(__file__)[0])
-    with open(fastcsr_path / 'model' / 'aseg_label_trans.json') as jf:
-        label2aseg = json.load(jf)['label2aseg']
-    aseg_pred_np = np.zeros_like(aseg_presurf_np)
-    for label in label2aseg:
-        aseg_pred_np[aseg_presurf_np == int(label)] = label2aseg[label]
-    aseg_presurf_pred = ants.from_numpy(aseg_pred_np, aseg_presurf.origin, aseg_presurf.spacing,
-                                        aseg_presurf.direction)
-    ants.image_write(aseg_presurf_pred, str(subj_dir / 'mri' / 'aseg.presurf.mgz'))
+    convert_aseg_presurf(output_path / f'{args.sid}.nii.gz', subj_dir / 'mri' / 'aseg.presurf.mgz')
     shutil.rmtree(subj_dir / 'tmp' / 'aseg_presurf')
     msg = 'The mri/aseg.presurf.mgz file has been generated.'
     log_msg(msg, lock, logging.INFO)
 
 
-def create_brainmask(args, lock=None):
-    subj_dir = Path(args.sd) / args.sid
-    aseg_presurf = ants.image_read(str(subj_dir / 'mri' / 'aseg.presurf.mgz'))
+def brainmask_from_aseg(aseg_presurf):
     aseg_presurf = ants.iMath_get_largest_component(aseg_presurf)
     aseg_presurf_np = aseg_presurf.numpy()
-    brain_mask = aseg_presurf_np.astype(bool)
-    brain_mask = binary_fill_holes(brain_mask)
-    brain_mask = binary_dilation(brain_mask, iterations=5)
-    brain_mask = binary_fill_holes(brain_mask)
+    # 在 aseg 的 bounding box 内做填洞 + 膨胀 + 填洞，结果与整个体积上计算相同
+    brain_mask = roi_morphology(aseg_presurf_np.astype(bool), dilation=5, fill_before=True)
     brain_mask = brain_mask.astype(np.float32)
-    brainmask = ants.from_numpy(brain_mask, aseg_presurf.origin, aseg_presurf.spacing, aseg_presurf.direction)
+    return ants.from_numpy(brain_mask, aseg_presurf.origin, aseg_presurf.spacing, aseg_presurf.direction)
+
+
+def create_brainmask(args, lock=None):
+    subj_dir = Path(args.sd) / args.sid
+    aseg_presurf = ants.image_read(str(subj_dir / 'mri' / 'aseg.presurf.mgz'))
+    brainmask = brainmask_from_aseg(aseg_presurf)
     ants.image_write(brainmask, str(subj_dir / 'mri' / 'brainmask.mgz'))
     msg = 'The mri/brainmask.mgz file has been generated.'
     log_msg(msg, lock, logging.INFO)
 
 
+def create_levelset_remote(args):
+    """
+    return: hemispheres the service did not produce, to be run in this process
+    raise: TimeoutError if the service has not answered a hemisphere in time, it may still write the output
+    """
+    hemis = ['lh', 'rh']
+    budget = get_budget(args.budget)
+
+    def run(hemi):
+        return run_remote(args.service_socket, 'levelset', args.sd, args.sid, hemi, budget)
+
+    if args.parallel_scheduling:
+        with ThreadPoolExecutor(max_workers=len(hemis)) as executor:
+            rets = list(executor.map(run, hemis))
+    else:
+        rets = [run(hemi) for hemi in hemis]
+    return [hemi for hemi, ret in zip(hemis, rets) if not ret]
+
+
 def create_levelset(args, lock=None):
+    hemis = create_levelset_remote(args)
+    if len(hemis) == 0:
+        msg = 'Levelset model regression inference completed.'
+        log_msg(msg, lock, logging.INFO)
+        return
+
     fastcsr_path = Path(os.path.split(__file__)[0])
     cmd_pool = list()
-    cmd = f"python3 {fastcsr_path / 'fastcsr_model_infer.py'} --fastcsr_subjects_dir {args.sd} --subj {args.sid} --hemi lh --model-path {args.model_path}".split()
-    cmd_pool.append(cmd)
-    cmd = f"python3 {fastcsr_path / 'fastcsr_model_infer.py'} --fastcsr_subjects_dir {args.sd} --subj {args.sid} --hemi rh --model-path {args.model_path}".split()
-    cmd_pool.append(cmd)
+    for hemi in hemis:
+        cmd = f"python3 {fastcsr_path / 'fastcsr_model_infer.py'} --fastcsr_subjects_dir {args.sd} --subj {args.sid} --hemi {hemi} --model-path {args.model_path} --budget {args.budget}".split()
+        # 服务已失败，子进程不再请求服务
+        cmd_pool.append(cmd + ['--service-socket', ''])
     if args.parallel_scheduling:
-        lh_process = subprocess.Popen(cmd_pool[0], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-        rh_process = subprocess.Popen(cmd_pool[1], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-        lh_retcode = lh_process.wait()
-        rh_retcode = rh_process.wait()
-        if lh_retcode != 0 or rh_retcode != 0:
+        processes = [subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) for cmd in cmd_pool]
+        retcodes = [process.wait() for process in processes]
+        if any(retcode != 0 for retcode in retcodes):
             msg = 'Levelset regression model inference failed.'
             log_msg(msg, lock, logging.ERROR)
             exit(-1)
@@ -248,8 +337,13 @@ def levelset2surf(args, lock=None, surfix='orig'):
 
 
 def create_brain_finalsurfs(args, lock=None):
+    if run_remote(args.service_socket, 'brain_finalsurfs', args.sd, args.sid, budget=get_budget(args.budget)):
+        msg = 'Brain_finalsurfs regression model inference completed.'
+        log_msg(msg, lock, logging.INFO)
+        return
+
     fastcsr_path = Path(os.path.split(__file__)[0])
-    cmd = f"python3 {fastcsr_path / 'brain_finalsurfs_model_infer.py'} --fastcsr_subjects_dir {args.sd} --subj {args.sid}".split()
+    cmd = f"python3 {fastcsr_path / 'brain_finalsurfs_model_infer.py'} --fastcsr_subjects_dir {args.sd} --subj {args.sid} --budget {args.budget}".split()
     ret = subprocess.run(cmd, stdout=subprocess.DEVNULL)
     if ret.returncode == 0:
         msg = 'Brain_finalsurfs regression model inference completed.'
@@ -260,17 +354,21 @@ def create_brain_finalsurfs(args, lock=None):
         exit(-1)
 
 
-def create_wm(args, lock=None):
-    subj_dir = Path(args.sd) / args.sid
-    filled = ants.image_read(str(subj_dir / 'mri' / 'filled.mgz'))
-    aseg_presurf = ants.image_read(str(subj_dir / 'mri' / 'aseg.presurf.mgz'))
+def wm_from_filled_aseg(filled, aseg_presurf):
     filled_np = filled.numpy()
     aseg_presurf_np = aseg_presurf.numpy()
     wm_np = np.ones_like(filled_np)
     wm_np[filled_np == 127] = 255
     wm_np[filled_np == 255] = 255
     wm_np[aseg_presurf_np == 13] = 255
-    wm = ants.from_numpy(wm_np, filled.origin, filled.spacing, filled.direction)
+    return ants.from_numpy(wm_np, filled.origin, filled.spacing, filled.direction)
+
+
+def create_wm(args, lock=None):
+    subj_dir = Path(args.sd) / args.sid
+    filled = ants.image_read(str(subj_dir / 'mri' / 'filled.mgz'))
+    aseg_presurf = ants.image_read(str(subj_dir / 'mri' / 'aseg.presurf.mgz'))
+    wm = wm_from_filled_aseg(filled, aseg_presurf)
     ants.image_write(wm, str(subj_dir / 'mri' / 'wm.mgz'))
     msg = 'The mri/wm.mgz file has been generated.'
     log_msg(msg, lock, logging.INFO)
@@ -369,6 +467,8 @@ def parallel_scheduling(args):
     if brain_finalsurfs_process is not None:
         brain_finalsurfs_process.join()
         brain_finalsurfs_process.close()
+    # levelset and brain_finalsurfs models are done, the shared preprocessed inputs are no longer needed
+    shutil.rmtree(subj_dir / 'tmp' / 'preprocess_cache', ignore_errors=True)
 
     # optimizing surface
     logging.info('---------------------------Surface optimization-----------------------------------')
@@ -380,49 +480,59 @@ def serial_scheduling(args):
     # make sure the mri/filled.mgz file has been created
     logging.info('-----------------------Generate mri/filled.mgz file-------------------------------')
     if not os.path.exists(subj_dir / 'mri' / 'filled.mgz'):
-        create_filled(args)
+        with timed('filled'):
+            create_filled(args)
     else:
         logging.info('The mri/filled.mgz file already exists, skip this step.')
 
     # make sure the mri/aseg.presurf.mgz file has been created
     logging.info('--------------------Generate mri/aseg.presurf.mgz file----------------------------')
     if not os.path.exists(subj_dir / 'mri' / 'aseg.presurf.mgz'):
-        create_aseg_presurf(args)
+        with timed('aseg_presurf'):
+            create_aseg_presurf(args)
     else:
         logging.info('The mri/aseg.presurf.mgz file already exists, skip this step.')
 
     # make sure the mri/brainmask.mgz file has been created
     logging.info('---------------------Generate mri/brainmask.mgz file------------------------------')
     if not os.path.exists(subj_dir / 'mri' / 'brainmask.mgz'):
-        create_brainmask(args)
+        with timed('brainmask'):
+            create_brainmask(args)
     else:
         logging.info('The mri/brainmask.mgz file already exists, skip this step.')
 
     # make sure the mri/wm.mgz file has been created
     logging.info('-------------------------Generate mri/wm.mgz file---------------------------------')
     if not os.path.exists(subj_dir / 'mri' / 'wm.mgz'):
-        create_wm(args)
+        with timed('wm'):
+            create_wm(args)
     else:
         logging.info('The mri/wm.mgz file already exists, skip this step.')
 
     logging.info('-------------------Generate mri/?h_levelset.nii.gz file---------------------------')
-    create_levelset(args)
+    with timed('levelset'):
+        create_levelset(args)
 
     # make sure the mri/brain.finalsurfs.mgz file has been created
     logging.info('-------------------Generate mri/brain.finalsurfs.mgz file-------------------------')
     if not os.path.exists(subj_dir / 'mri' / 'brain.finalsurfs.mgz'):
-        create_brain_finalsurfs(args)
+        with timed('brain_finalsurfs'):
+            create_brain_finalsurfs(args)
     else:
         logging.info('The mri/brain.finalsurfs.mgz file already exists, skip this step.')
 
     # create surface
     logging.info('------------------------Generate surf/?h.orig file--------------------------------')
-    levelset2surf(args)
+    with timed('levelset2surf'):
+        levelset2surf(args)
+    shutil.rmtree(subj_dir / 'tmp' / 'preprocess_cache', ignore_errors=True)
 
     # optimizing surface
     if args.optimizing_surface:
         logging.info('---------------------------Surface optimization-----------------------------------')
-        create_white_surface(args)
+        with timed('white surface'):
+            create_white_surface(args)
+    log_timing(args.timing_json)
 
 
 if __name__ == '__main__':
@@ -446,7 +556,10 @@ if __name__ == '__main__':
     else:
         logging.info('The mri/orig.mgz file already exists, skip this step.')
 
-    if args.parallel_scheduling:
+    if args.inprocess:
+        from pipeline_inprocess import inprocess_scheduling
+        inprocess_scheduling(args)
+    elif args.parallel_scheduling:
         parallel_scheduling(args)
     else:
         serial_scheduling(args)
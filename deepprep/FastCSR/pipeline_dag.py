@@ -0,0 +1,135 @@
+"""
+FastCSR for many subjects on one machine with the resource-aware DAG executor (scheduler.py).
+
+The stages and their dependencies are those of pipeline.py parallel_scheduling;
+each stage declares what it costs, and the stages of all subjects share the
+CPUs, memory and GPUs given on the command line.
+
+  python3 pipeline_dag.py --sd ./data --sid sub-001 sub-002 sub-003 --cpus 16 --memory-gb 64 --gpus 1
+"""
+import os
+import shutil
+import argparse
+import logging
+from pathlib import Path
+from functools import partial
+from multiprocessing import Lock
+
+import sh
+
+from pipeline import (set_environ, config_logging, create_filled, create_aseg_presurf, create_brainmask, create_wm,
+                      create_levelset, create_brain_finalsurfs, levelset2surf, create_white_surface)
+from inference_budget import INFERENCE_BUDGETS
+from scheduler import Stage, DAGExecutor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='FastCSR: schedule the stages of many subjects on the local resources')
+    parser.add_argument('--sid', required=True, nargs='+', help='Subject IDs inside $SUBJECTS_DIR')
+    parser.add_argument('--t1', nargs='+', help='T1 files of the subjects that do not exist yet, in --sid order')
+    parser.add_argument('--sd', default=os.environ.get('SUBJECTS_DIR'),
+                        help='Output directory $SUBJECTS_DIR (pass via environment or here)')
+    parser.add_argument('--optimizing_surface', default='on', choices=['on', 'off'],
+                        help='Whether to enable optimizing the white surface position')
+    parser.add_argument('--pial', default=False, action='store_true', help="Whether to generate pial surface")
+    parser.add_argument('--cpus', type=int, default=os.cpu_count(), help='CPUs available to the stages')
+    parser.add_argument('--memory-gb', type=float, help='Memory available to the stages, default is the total memory')
+    parser.add_argument('--gpus', type=int, default=0,
+                        help='GPUs available to the stages, each model stage gets one via CUDA_VISIBLE_DEVICES')
+    parser.add_argument('--trace', help='Timeline trace json file, default is $SUBJECTS_DIR/fastcsr_trace.json')
+
+    parser.add_argument('--freesurfer-home', help="The FreeSurfer Home path")
+    parser.add_argument('--jvm-home', help="The JVM Home path")
+    parser.add_argument('--model-path', help="The Model path")
+    parser.add_argument('--service-socket', default=os.environ.get('FASTCSR_SOCKET'),
+                        help="Unix socket of a running inference_service.py")
+    parser.add_argument('--budget', default='default', choices=list(INFERENCE_BUDGETS.keys()),
+                        help="Inference budget preset of the levelset and brain_finalsurfs models")
+    args = parser.parse_args()
+    if args.sd is None:
+        raise ValueError('Subjects dir need to set via $SUBJECTS_DIR environment or --sd parameter')
+    os.environ['SUBJECTS_DIR'] = args.sd
+    if args.t1 is not None and len(args.t1) != len(args.sid):
+        raise ValueError('--t1 needs one file per --sid')
+    args.optimizing_surface = args.optimizing_surface == 'on'
+    if args.trace is None:
+        args.trace = os.path.join(args.sd, 'fastcsr_trace.json')
+    return args
+
+
+def subject_args(args, sid, t1=None):
+    subj_args = argparse.Namespace(**vars(args))
+    subj_args.sid = sid
+    subj_args.t1 = t1
+    # 左右半球在 stage 内部并行，stage 的资源按两个进程计
+    subj_args.parallel_scheduling = True
+    return subj_args
+
+
+def create_orig(args):
+    subj_dir = Path(args.sd) / args.sid
+    if not os.path.exists(subj_dir):
+        if args.t1 is None:
+            raise ValueError(f'{subj_dir} is not exists and --t1 is None, please check.')
+        sh.recon_all('-s', args.sid, '-i', args.t1, '-motioncor')
+    else:
+        sh.recon_all('-s', args.sid, '-motioncor')
+
+
+def remove_preprocess_cache(args):
+    shutil.rmtree(Path(args.sd) / args.sid / 'tmp' / 'preprocess_cache', ignore_errors=True)
+
+
+def fastcsr_stages(args, lock=None):
+    """
+    Stage graph of one subject. cpus / memory_gb / gpus are per stage (both hemispheres for the ?h stages),
+    estimate_s is only used to start the longest chains first.
+    """
+    mri_dir = Path(args.sd) / args.sid / 'mri'
+
+    def exists(*file_names):
+        return lambda: all(os.path.exists(mri_dir / i) for i in file_names)
+
+    stages = [
+        Stage('orig', partial(create_orig, args), cpus=1, memory_gb=2, skip=exists('orig.mgz'), estimate_s=120),
+        Stage('filled', partial(create_filled, args, lock), ['orig'], cpus=2, memory_gb=8, gpus=1,
+              skip=exists('filled.mgz'), estimate_s=60),
+        Stage('aseg_presurf', partial(create_aseg_presurf, args, lock), ['orig'], cpus=2, memory_gb=8, gpus=1,
+              skip=exists('aseg.presurf.mgz'), estimate_s=60),
+        Stage('brainmask', partial(create_brainmask, args, lock), ['aseg_presurf'], cpus=1, memory_gb=2,
+              skip=exists('brainmask.mgz'), estimate_s=10),
+        Stage('wm', partial(create_wm, args, lock), ['filled', 'aseg_presurf'], cpus=1, memory_gb=2,
+              skip=exists('wm.mgz'), estimate_s=5),
+        Stage('levelset', partial(create_levelset, args, lock), ['filled'], cpus=2, memory_gb=8, gpus=1,
+              estimate_s=60),
+        Stage('brain_finalsurfs', partial(create_brain_finalsurfs, args, lock), ['orig'], cpus=1, memory_gb=4,
+              gpus=1, skip=exists('brain.finalsurfs.mgz'), estimate_s=30),
+        Stage('levelset2surf', partial(levelset2surf, args, lock), ['levelset', 'brainmask', 'aseg_presurf'],
+              cpus=2, memory_gb=6, estimate_s=120),
+        Stage('remove_preprocess_cache', partial(remove_preprocess_cache, args), ['levelset', 'brain_finalsurfs'],
+              cpus=0, memory_gb=0, estimate_s=0),
+    ]
+    if args.optimizing_surface:
+        stages.append(Stage('white_surface', partial(create_white_surface, args, lock),
+                            ['levelset2surf', 'brain_finalsurfs', 'wm', 'filled'], cpus=2, memory_gb=4,
+                            estimate_s=300))
+    return stages
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_environ(args.freesurfer_home, args.jvm_home, args.model_path)
+    config_logging()
+    lock = Lock()
+
+    executor = DAGExecutor(cpus=args.cpus, memory_gb=args.memory_gb, gpus=args.gpus)
+    for i, sid in enumerate(args.sid):
+        t1 = None if args.t1 is None else args.t1[i]
+        executor.add_subject(sid, fastcsr_stages(subject_args(args, sid, t1), lock))
+    failed = executor.run()
+    executor.write_trace(args.trace)
+    for sid in args.sid:
+        logging.info(f'[{sid}] critical path: ' + ' -> '.join(executor.critical_path(sid)))
+    if failed:
+        logging.error('failed stages: ' + ', '.join(f'{sid}/{stage}' for sid, stage in failed))
+        exit(1)
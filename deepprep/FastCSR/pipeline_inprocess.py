@@ -0,0 +1,128 @@
+"""
+In-process FastCSR pipeline: the stages hand ants images to each other in memory.
+
+The disk pipeline (pipeline.py serial/parallel scheduling) converts every
+intermediate result to nii.gz / mgz and reads it back in the next stage
+(nnUNet inputs and outputs, filled, aseg.presurf, brainmask, wm,
+?h_levelset.nii.gz, the nighres input). Here all models run in this process,
+nnUNet preprocessing reads the ants images directly and only the final files
+are written:
+
+- mri/filled.mgz, mri/aseg.presurf.mgz, surf/?h.orig
+- with --optimizing_surface on, also the inputs of mris_make_surfaces /
+  recon-all: mri/brainmask.mgz, mri/wm.mgz, mri/brain.finalsurfs.mgz
+
+Run with ``pipeline.py --inprocess``; the per-stage timing summary lists the
+read / write stages separately, compare it with ``--parallel_scheduling off``.
+"""
+import os
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+import ants
+
+from pipeline import (timed, log_timing, filled_from_seg, aseg_presurf_from_seg, brainmask_from_aseg,
+                      wm_from_filled_aseg, create_white_surface)
+from levelset2surf import levelset_to_surface
+from preprocess_cache import PreprocessCache, get_plans_key, preprocess_images
+from inference_service import FastCSRModels
+from inference_budget import get_budget
+
+
+def from_sitk_array(arr, like):
+    """
+    array in sitk.GetArrayFromImage axis order -> ants image on the grid of like, as ants.image_read of the nii.gz would give
+    """
+    return ants.from_numpy(arr.transpose(2, 1, 0).astype(np.float32), like.origin, like.spacing, like.direction)
+
+
+class InprocessPipeline(object):
+    def __init__(self, args):
+        self.args = args
+        self.subj_dir = Path(args.sd) / args.sid
+        self.mri_dir = self.subj_dir / 'mri'
+        self.models = FastCSRModels(Path(args.model_path))
+        self.budget = get_budget(args.budget)
+        # lh / rh levelset models use the same plans: their inputs are preprocessed once
+        self.cache = PreprocessCache()
+
+    def preprocess(self, model, name, images):
+        """
+        name: identifies the images within this subject, e.g. 'orig' or 'orig+filled'
+        """
+        key = hashlib.sha1(f'{name}:{get_plans_key(model)}'.encode()).hexdigest()
+        return self.cache.get(key, lambda: preprocess_images(model, images))
+
+    def segment(self, task, orig):
+        model = self.models.get(task)
+        data, properties = self.preprocess(model, 'orig', [orig])
+        return from_sitk_array(model.predict_array(data, properties), orig)
+
+    def regress(self, name, input_name, images, orig):
+        model = self.models.get(name)
+        data, properties = self.preprocess(model, input_name, images)
+        return from_sitk_array(model.predict_array(data, properties, self.budget), orig)
+
+    def read_or_segment(self, task, file_name, from_seg, orig):
+        output_file = self.mri_dir / file_name
+        if os.path.exists(output_file):
+            logging.info(f'The mri/{file_name} file already exists, skip this step.')
+            with timed(f'read {file_name}'):
+                return ants.image_read(str(output_file))
+        with timed(task):
+            img = from_seg(self.segment(task, orig))
+        with timed(f'write {file_name}'):
+            ants.image_write(img, str(output_file))
+        logging.info(f'The mri/{file_name} file has been generated.')
+        return img
+
+    def run(self):
+        args = self.args
+        with timed('read orig.mgz'):
+            orig = ants.image_read(str(self.mri_dir / 'orig.mgz'))
+
+        logging.info('-----------------------Generate mri/filled.mgz file-------------------------------')
+        filled = self.read_or_segment('filled', 'filled.mgz', filled_from_seg, orig)
+        logging.info('--------------------Generate mri/aseg.presurf.mgz file----------------------------')
+        aseg_presurf = self.read_or_segment('aseg_presurf', 'aseg.presurf.mgz', aseg_presurf_from_seg, orig)
+
+        with timed('brainmask'):
+            brainmask = brainmask_from_aseg(aseg_presurf)
+
+        logging.info('------------------------Generate surf/?h.orig file--------------------------------')
+        os.makedirs(self.subj_dir / 'surf', exist_ok=True)
+        # nighres 的 JVM 不能在多个线程中同时使用，两个半球依次处理
+        for hemi in ['lh', 'rh']:
+            with timed(f'levelset {hemi}'):
+                levelset = self.regress(f'levelset_{hemi}', 'orig+filled', [orig, filled], orig)
+            with timed(f'levelset2surf {hemi}'):
+                levelset_to_surface(levelset, brainmask, aseg_presurf, self.mri_dir / 'orig.mgz', hemi,
+                                    self.subj_dir / 'surf' / f'{hemi}.orig')
+        logging.info('Surface generation completed.')
+
+        if args.optimizing_surface:
+            logging.info('-------------------Generate mri/brain.finalsurfs.mgz file-------------------------')
+            brain_finalsurfs_file = self.mri_dir / 'brain.finalsurfs.mgz'
+            if not os.path.exists(brain_finalsurfs_file):
+                with timed('brain_finalsurfs'):
+                    brain_finalsurfs = self.regress('brain_finalsurfs', 'orig', [orig], orig)
+                with timed('write brain.finalsurfs.mgz'):
+                    ants.image_write(brain_finalsurfs, str(brain_finalsurfs_file))
+            else:
+                logging.info('The mri/brain.finalsurfs.mgz file already exists, skip this step.')
+            with timed('wm'):
+                wm = wm_from_filled_aseg(filled, aseg_presurf)
+            with timed('write brainmask.mgz, wm.mgz'):
+                ants.image_write(brainmask, str(self.mri_dir / 'brainmask.mgz'))
+                ants.image_write(wm, str(self.mri_dir / 'wm.mgz'))
+
+            logging.info('---------------------------Surface optimization-----------------------------------')
+            with timed('white surface'):
+                create_white_surface(args)
+
+
+def inprocess_scheduling(args):
+    InprocessPipeline(args).run()
+    log_timing(args.timing_json)
@@ -0,0 +1,203 @@
+"""
+Shared nnUNet preprocessing for the FastCSR predictors of one subject.
+
+GenericPreprocessor.preprocess_test_case (crop + resample + normalize) only
+depends on the input images and a few plans entries, so its result is
+computed once and shared:
+
+- in memory (LRU) between predictors living in the same process
+  (inference_service.py);
+- on disk as ``<key>.npy`` + ``<key>.pkl`` in the subject tmp dir, opened
+  with np.load(mmap_mode='r'), between predictors running as separate
+  processes (lh / rh fastcsr_model_infer.py, brain_finalsurfs_model_infer.py).
+  A file lock makes concurrent processes compute a key only once.
+"""
+import os
+import json
+import fcntl
+import pickle
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+import numpy as np
+import ants
+
+
+def get_plans_key(model):
+    """
+    The preprocessor and the plans entries it depends on.
+    """
+    plans = model.plans
+    stage = getattr(model, 'stage', 0)
+    key = {
+        'preprocessor': getattr(model, 'preprocessor_name', 'GenericPreprocessor'),
+        'normalization_schemes': plans['normalization_schemes'],
+        'use_mask_for_norm': plans['use_mask_for_norm'],
+        'transpose_forward': plans['transpose_forward'],
+        'current_spacing': plans['plans_per_stage'][stage]['current_spacing'],
+    }
+    # intensity properties are only used by the CT normalization
+    if 'CT' in str(plans['normalization_schemes']):
+        key['intensityproperties'] = plans['dataset_properties']['intensityproperties']
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_preprocess_key(model, source_files):
+    """
+    Key of a preprocessed case: the source files (path, mtime, size) and the plans key.
+    """
+    sources = [(str(f), os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in source_files]
+    return hashlib.sha1(json.dumps([sources, get_plans_key(model)]).encode()).hexdigest()
+
+
+def convert_inputs(source_files, tmp_path: Path, sid):
+    """
+    mgz -> nnUNet input files {sid}_0000.nii.gz, {sid}_0001.nii.gz, ...
+    """
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    input_files = list()
+    for i, source_file in enumerate(source_files):
+        input_file = tmp_path / f'{sid}_{i:04d}.nii.gz'
+        ants.image_write(ants.image_read(str(source_file)), str(input_file))
+        input_files.append(str(input_file))
+    return input_files
+
+
+class PreprocessCache(object):
+    """
+    Preprocessed cases (data, properties): in-memory LRU, optionally backed by memory-mapped npy files in cache_dir.
+    """
+
+    def __init__(self, cache_dir=None, max_items=4):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, value):
+        with self._lock:
+            self.items[key] = value
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+        return value
+
+    def _read(self, key):
+        data_file = self.cache_dir / f'{key}.npy'
+        properties_file = self.cache_dir / f'{key}.pkl'
+        if not (data_file.exists() and properties_file.exists()):
+            return None
+        with open(properties_file, 'rb') as f:
+            properties = pickle.load(f)
+        return np.load(data_file, mmap_mode='r'), properties
+
+    def _write(self, key, data, properties):
+        # 先写临时文件再 rename，其他进程不会读到写了一半的文件
+        tmp_data_file = self.cache_dir / f'{key}.{os.getpid()}.tmp.npy'
+        np.save(tmp_data_file, data)
+        tmp_properties_file = self.cache_dir / f'{key}.{os.getpid()}.tmp.pkl'
+        with open(tmp_properties_file, 'wb') as f:
+            pickle.dump(properties, f)
+        tmp_properties_file.replace(self.cache_dir / f'{key}.pkl')
+        tmp_data_file.replace(self.cache_dir / f'{key}.npy')
+
+    def get(self, key, compute):
+        """
+        compute: () -> (data, properties), called only when no process has the key yet
+        """
+        with self._lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        if self.cache_dir is None:
+            return self._remember(key, compute())
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_dir / f'{key}.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                value = self._read(key)
+                if value is None:
+                    data, properties = compute()
+                    self._write(key, data, properties)
+                    value = self._read(key)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return self._remember(key, value)
+
+
+def get_subject_cache(subj_dir: Path):
+    return PreprocessCache(Path(subj_dir) / 'tmp' / 'preprocess_cache')
+
+
+def preprocess_subject(model, source_files, cache: PreprocessCache, tmp_path: Path, sid):
+    """
+    Preprocessed (data, properties) of source_files (mgz) for model, computed at most once per cache.
+    """
+
+    def compute():
+        input_files = convert_inputs(source_files, tmp_path, sid)
+        return model.preprocess(input_files)
+
+    return cache.get(get_preprocess_key(model, source_files), compute)
+
+
+def ants_to_sitk(img):
+    """
+    ants image -> SimpleITK image with the same voxels and geometry as writing it to nii.gz and sitk.ReadImage
+    """
+    import SimpleITK as sitk
+
+    img_itk = sitk.GetImageFromArray(img.numpy().transpose(2, 1, 0))
+    img_itk.SetOrigin(img.origin)
+    img_itk.SetSpacing(img.spacing)
+    img_itk.SetDirection(np.asarray(img.direction).flatten().tolist())
+    return img_itk
+
+
+def get_preprocessor(model):
+    from nnunet.preprocessing.preprocessing import GenericPreprocessor
+
+    preprocessor_name = getattr(model, 'preprocessor_name', 'GenericPreprocessor')
+    if preprocessor_name == 'GenericPreprocessor':
+        preprocessor_class = GenericPreprocessor
+    else:
+        import nnunet
+        from nnunet.training.model_restore import recursive_find_python_class
+        preprocessor_class = recursive_find_python_class([os.path.join(nnunet.__path__[0], 'preprocessing')],
+                                                         preprocessor_name, current_module='nnunet.preprocessing')
+    plans = model.plans
+    return preprocessor_class(plans['normalization_schemes'], plans['use_mask_for_norm'], plans['transpose_forward'],
+                              plans['dataset_properties']['intensityproperties'])
+
+
+def preprocess_images(model, images):
+    """
+    GenericPreprocessor.preprocess_test_case on in-memory ants images instead of nii.gz files
+    (same steps as nnunet load_case_from_list_of_files + ImageCropper.crop + resample_and_normalize).
+    """
+    from nnunet.preprocessing.cropping import ImageCropper
+
+    images_itk = [ants_to_sitk(img) for img in images]
+    properties = OrderedDict()
+    properties['original_size_of_raw_data'] = np.array(images_itk[0].GetSize())[[2, 1, 0]]
+    properties['original_spacing'] = np.array(images_itk[0].GetSpacing())[[2, 1, 0]]
+    properties['list_of_data_files'] = list()
+    properties['seg_file'] = None
+    properties['itk_origin'] = images_itk[0].GetOrigin()
+    properties['itk_spacing'] = images_itk[0].GetSpacing()
+    properties['itk_direction'] = images_itk[0].GetDirection()
+
+    import SimpleITK as sitk
+    data = np.vstack([sitk.GetArrayFromImage(img)[None] for img in images_itk]).astype(np.float32)
+    data, seg, properties = ImageCropper.crop(data, properties, None)
+
+    preprocessor = get_preprocessor(model)
+    transpose_forward = model.plans['transpose_forward']
+    data = data.transpose((0, *[i + 1 for i in transpose_forward]))
+    seg = seg.transpose((0, *[i + 1 for i in transpose_forward]))
+    current_spacing = model.plans['plans_per_stage'][getattr(model, 'stage', 0)]['current_spacing']
+    data, seg, properties = preprocessor.resample_and_normalize(data, current_spacing, properties, seg,
+                                                                force_separate_z=None)
+    return data.astype(np.float32), properties
@@ -0,0 +1,264 @@
+"""
+Local resource-aware DAG executor.
+
+Stages declare their dependencies (by name, within the same subject) and their
+CPU / memory / GPU cost. The executor runs the stages of many subjects as
+separate processes, packing as many ready stages as fit into the available
+resources. Among the ready stages the ones with the longest estimated remaining
+path to the end of their subject go first, so the critical path starts early.
+
+Every run is recorded in a timeline trace (Chrome trace event format, open it
+in chrome://tracing or https://ui.perfetto.dev) together with the critical path
+of each subject.
+"""
+import os
+import json
+import time
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import OrderedDict
+
+PENDING, RUNNING, DONE, SKIPPED, FAILED, CANCELLED = 'pending', 'running', 'done', 'skipped', 'failed', 'cancelled'
+
+
+class Stage(object):
+    """
+    func: () -> None, run in a child process, fails by raising or exiting with a non-zero code
+    skip: () -> bool, checked when the stage becomes ready, True if its outputs already exist
+    estimate_s: expected duration, only used to prioritize the ready stages
+    """
+
+    def __init__(self, name, func, deps=(), cpus=1, memory_gb=1., gpus=0, skip=None, estimate_s=60.):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+        self.gpus = gpus
+        self.skip = skip
+        self.estimate_s = estimate_s
+
+
+class Task(object):
+    def __init__(self, subject, stage: Stage, order):
+        self.subject = subject
+        self.stage = stage
+        self.order = order
+        self.state = PENDING
+        self.priority = 0.
+        self.cpus = stage.cpus
+        self.memory_gb = stage.memory_gb
+        self.gpus = stage.gpus
+        self.gpu_ids = list()
+        self.process = None
+        self.ready_at = None
+        self.start = None
+        self.end = None
+        self.lane = None
+
+    @property
+    def key(self):
+        return self.subject, self.stage.name
+
+
+def get_total_memory_gb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+
+def _run_stage(func, gpu_ids):
+    if gpu_ids is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(str(i) for i in gpu_ids)
+    func()
+
+
+class DAGExecutor(object):
+    def __init__(self, cpus=None, memory_gb=None, gpus=0, poll_interval=1.):
+        self.cpus = cpus or os.cpu_count()
+        self.memory_gb = memory_gb or get_total_memory_gb()
+        self.gpus = gpus
+        self.poll_interval = poll_interval
+        self.tasks = OrderedDict()
+        self._t0 = None
+
+    def add(self, subject, stage: Stage):
+        task = Task(subject, stage, len(self.tasks))
+        # 超过总资源的 stage 按总资源计，在资源全部空闲时单独运行
+        task.cpus = min(stage.cpus, self.cpus)
+        task.memory_gb = min(stage.memory_gb, self.memory_gb)
+        task.gpus = min(stage.gpus, self.gpus)
+        if task.key in self.tasks:
+            raise ValueError(f'duplicate stage: {task.key}')
+        self.tasks[task.key] = task
+
+    def add_subject(self, subject, stages):
+        for stage in stages:
+            self.add(subject, stage)
+
+    def _deps(self, task):
+        return [self.tasks[(task.subject, dep)] for dep in task.stage.deps]
+
+    def _check_graph(self):
+        for task in self.tasks.values():
+            for dep in task.stage.deps:
+                if (task.subject, dep) not in self.tasks:
+                    raise ValueError(f'{task.key} depends on unknown stage {dep}')
+        # upward rank: 该 stage 到本 subject 结束的最长预计路径，同时检测环
+        dependants = {key: list() for key in self.tasks}
+        for task in self.tasks.values():
+            for dep in self._deps(task):
+                dependants[dep.key].append(task)
+        visiting = set()
+
+        def rank(task):
+            if task.priority > 0:
+                return task.priority
+            if task.key in visiting:
+                raise ValueError(f'dependency cycle at {task.key}')
+            visiting.add(task.key)
+            task.priority = task.stage.estimate_s + max([rank(i) for i in dependants[task.key]], default=0.)
+            visiting.discard(task.key)
+            return task.priority
+
+        for task in self.tasks.values():
+            rank(task)
+
+    def _now(self):
+        return time.perf_counter() - self._t0
+
+    def _ready(self):
+        ready = list()
+        for task in self.tasks.values():
+            if task.state != PENDING:
+                continue
+            deps = self._deps(task)
+            if any(dep.state in [FAILED, CANCELLED] for dep in deps):
+                task.state = CANCELLED
+                logging.error(f'[{task.subject}] {task.stage.name}: cancelled, a dependency failed')
+                # 级联取消需要重新扫描
+                return self._ready()
+            if all(dep.state in [DONE, SKIPPED] for dep in deps):
+                if task.ready_at is None:
+                    task.ready_at = self._now()
+                ready.append(task)
+        return sorted(ready, key=lambda t: (-t.priority, t.order))
+
+    def _start(self, task, free, lanes):
+        task.gpu_ids = free['gpu_ids'][:task.gpus]
+        free['gpu_ids'] = free['gpu_ids'][task.gpus:]
+        free['cpus'] -= task.cpus
+        free['memory_gb'] -= task.memory_gb
+        # lane: trace 中的一行，同一时刻每行最多一个 stage
+        task.lane = lanes.index(None) if None in lanes else len(lanes)
+        if task.lane == len(lanes):
+            lanes.append(None)
+        lanes[task.lane] = task
+        task.process = multiprocessing.Process(target=_run_stage,
+                                               args=(task.stage.func, task.gpu_ids if self.gpus > 0 else None))
+        task.start = self._now()
+        task.process.start()
+        task.state = RUNNING
+        logging.info(f'[{task.subject}] {task.stage.name}: started (cpus={task.cpus}, memory={task.memory_gb:g}GB, '
+                     f'gpus={task.gpu_ids})')
+
+    def _finish(self, task, free, lanes):
+        task.process.join()
+        task.end = self._now()
+        task.state = DONE if task.process.exitcode == 0 else FAILED
+        task.process.close()
+        task.process = None
+        free['cpus'] += task.cpus
+        free['memory_gb'] += task.memory_gb
+        free['gpu_ids'] = sorted(free['gpu_ids'] + task.gpu_ids)
+        lanes[task.lane] = None
+        if task.state == DONE:
+            logging.info(f'[{task.subject}] {task.stage.name}: completed in {task.end - task.start:.1f}s')
+        else:
+            logging.error(f'[{task.subject}] {task.stage.name}: failed after {task.end - task.start:.1f}s')
+
+    def run(self):
+        """
+        return: failed or cancelled (subject, stage) keys
+        """
+        self._check_graph()
+        self._t0 = time.perf_counter()
+        free = {'cpus': self.cpus, 'memory_gb': self.memory_gb, 'gpu_ids': list(range(self.gpus))}
+        lanes = list()
+        running = list()
+        while True:
+            progress = False
+            for task in self._ready():
+                if task.stage.skip is not None and task.stage.skip():
+                    task.state = SKIPPED
+                    task.start = task.end = self._now()
+                    progress = True
+                    logging.info(f'[{task.subject}] {task.stage.name}: outputs already exist, skip this step.')
+                    continue
+                fits = (task.cpus <= free['cpus'] and task.memory_gb <= free['memory_gb'] + 1e-6
+                        and task.gpus <= len(free['gpu_ids']))
+                if fits:
+                    self._start(task, free, lanes)
+                    running.append(task)
+            if progress:
+                # skip 之后可能有新的 stage 就绪
+                continue
+            if not running:
+                break
+            sentinels = wait([task.process.sentinel for task in running], timeout=self.poll_interval)
+            for task in [task for task in running if task.process.sentinel in sentinels]:
+                running.remove(task)
+                self._finish(task, free, lanes)
+        return [task.key for task in self.tasks.values() if task.state in [FAILED, CANCELLED]]
+
+    def critical_path(self, subject):
+        """
+        The chain of stages that determined when the subject finished: starting from its last stage,
+        repeatedly the dependency that finished last.
+        """
+        tasks = [task for task in self.tasks.values() if task.subject == subject and task.end is not None]
+        if not tasks:
+            return list()
+        task = max(tasks, key=lambda t: t.end)
+        path = [task]
+        while True:
+            deps = [dep for dep in self._deps(task) if dep.end is not None]
+            if not deps:
+                break
+            task = max(deps, key=lambda t: t.end)
+            path.append(task)
+        return [task.stage.name for task in reversed(path)]
+
+    def subjects(self):
+        return list(OrderedDict.fromkeys(task.subject for task in self.tasks.values()))
+
+    def trace(self):
+        events = list()
+        subjects = self.subjects()
+        for task in self.tasks.values():
+            if task.start is None:
+                continue
+            events.append({
+                'name': task.stage.name, 'cat': task.state, 'ph': 'X', 'pid': 0, 'tid': task.lane or 0,
+                'ts': int(task.start * 1e6), 'dur': int((task.end - task.start) * 1e6),
+                'args': {'subject': task.subject, 'state': task.state, 'wait_s': task.start - task.ready_at,
+                         'cpus': task.cpus,
+                         'memory_gb': task.memory_gb, 'gpu_ids': task.gpu_ids},
+            })
+            # 每个 subject 一个进程行，便于按 subject 查看
+            events.append(dict(events[-1], pid=subjects.index(task.subject) + 1, tid=0))
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': 0, 'args': {'name': 'slots'}})
+        for i, subject in enumerate(subjects):
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': i + 1, 'args': {'name': subject}})
+        ends = [task.end for task in self.tasks.values() if task.end is not None]
+        other_data = {
+            'resources': {'cpus': self.cpus, 'memory_gb': self.memory_gb, 'gpus': self.gpus},
+            'makespan_s': max(ends, default=0.),
+            'critical_path': {subject: self.critical_path(subject) for subject in subjects},
+        }
+        return {'traceEvents': events, 'otherData': other_data}
+
+    def write_trace(self, trace_file):
+        os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+        with open(trace_file, 'w') as f:
+            json.dump(self.trace(), f, indent=1)
+        logging.info(f'timeline trace >>> {trace_file}')
@@ -0,0 +1,128 @@
+import os
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import nibabel as nib
+from scipy.spatial import ConvexHull
+
+from predict import get_config, predict
+from predict_batch import predict_batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SUGAR: compare predict_batch against predict.py per subject '
+                                                 'on synthetic subjects')
+    parser.add_argument('--hemi', help="which hemisphere")
+    parser.add_argument('--fsd', default=os.environ.get('FREESURFER_HOME'),
+                        help='$FREESURFER_HOME of the fsaverage fixed surfaces (pass via environment or here)')
+    parser.add_argument('--model_path', required=True, help='The path of model')
+    parser.add_argument('--subjects', type=int, default=3, help='number of synthetic subjects')
+    parser.add_argument('--n_vertex', type=int, default=40000, help='vertices of the synthetic native sphere')
+    parser.add_argument('--threads', type=int, default=max(1, os.cpu_count() // 2),
+                        help='torch threads of one hemisphere, the same in both runs')
+    parser.add_argument('--prefetch', type=int, default=1, help='--prefetch of predict_batch')
+    parser.add_argument('--writers', type=int, default=2, help='--writers of predict_batch')
+    parser.add_argument('--max_diff', type=float, default=1e-4,
+                        help='tolerance of the max vertex distance between the two sphere.reg (mm)')
+
+    args = parser.parse_args()
+    args_dict = vars(args)
+    args_dict['hemi'] = ['lh', 'rh'] if args.hemi is None else [args.hemi]
+    if args.fsd is None:
+        args_dict['fsd'] = '/usr/local/freesurfer'
+    return argparse.Namespace(**args_dict)
+
+
+def fibonacci_sphere(n_vertex, rng, radius=100):
+    index = np.arange(n_vertex) + 0.5
+    phi = np.arccos(1 - 2 * index / n_vertex)
+    theta = np.pi * (1 + 5 ** 0.5) * index + rng.uniform(0, 2 * np.pi)
+    return radius * np.stack([np.cos(theta) * np.sin(phi), np.sin(theta) * np.sin(phi), np.cos(phi)], axis=1)
+
+
+def smooth_field(xyz, rng, n_waves=12, scale=1.0):
+    """
+    sum of random low-frequency waves on the unit sphere, as a stand-in of sulc / curv
+    """
+    unit = xyz / np.linalg.norm(xyz, axis=1, keepdims=True)
+    directions = rng.normal(size=(n_waves, 3))
+    frequencies = rng.uniform(1, 6, size=n_waves)
+    phases = rng.uniform(0, 2 * np.pi, size=n_waves)
+    field = np.cos(unit @ directions.T * frequencies + phases).sum(axis=1)
+    return (scale * field / np.abs(field).max()).astype(np.float32)
+
+
+def make_subject(subj_dir, hemis, n_vertex, seed):
+    """
+    surf/?h.sphere, ?h.sulc, ?h.curv of a synthetic subject, the inputs read by read_moving_surf
+    """
+    rng = np.random.default_rng(seed)
+    surf_dir = os.path.join(subj_dir, 'surf')
+    os.makedirs(surf_dir, exist_ok=True)
+    for hemi in hemis:
+        xyz = fibonacci_sphere(n_vertex, rng)
+        faces = ConvexHull(xyz).simplices.astype(np.int32)
+        # 与 FreeSurfer 相同，法向朝外
+        normals = np.cross(xyz[faces[:, 1]] - xyz[faces[:, 0]], xyz[faces[:, 2]] - xyz[faces[:, 0]])
+        inward = np.sum(normals * xyz[faces[:, 0]], axis=1) < 0
+        faces[inward] = faces[inward][:, ::-1]
+        nib.freesurfer.write_geometry(os.path.join(surf_dir, f'{hemi}.sphere'), xyz, faces)
+        nib.freesurfer.write_morph_data(os.path.join(surf_dir, f'{hemi}.sulc'), smooth_field(xyz, rng, scale=10))
+        nib.freesurfer.write_morph_data(os.path.join(surf_dir, f'{hemi}.curv'), smooth_field(xyz, rng, 24, 0.5))
+
+
+def run_single(args, sd, sid):
+    single_args = argparse.Namespace(hemi=args.hemi, sid=sid, sd=sd, fsd=args.fsd, model_path=args.model_path,
+                                     device='cpu', parallel='serial', threads=args.threads, precision='fp32',
+                                     save_intermediate=False)
+    predict(single_args, get_config(single_args))
+
+
+def run_batch(args, subject_dirs):
+    batch_args = argparse.Namespace(subject_dirs=subject_dirs, hemi=args.hemi, fsd=args.fsd,
+                                    model_path=args.model_path, device='cpu',
+                                    threads=args.threads * len(args.hemi), prefetch=args.prefetch,
+                                    writers=args.writers, precision='fp32', save_intermediate=False)
+    return predict_batch(batch_args)
+
+
+def check_batch(args):
+    passed = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        single_sd = os.path.join(tmp_dir, 'single')
+        batch_sd = os.path.join(tmp_dir, 'batch')
+        sids = [f'sub-{i + 1:02d}' for i in range(args.subjects)]
+        for i, sid in enumerate(sids):
+            make_subject(os.path.join(single_sd, sid), args.hemi, args.n_vertex, seed=i)
+            shutil.copytree(os.path.join(single_sd, sid), os.path.join(batch_sd, sid))
+
+        for sid in sids:
+            run_single(args, single_sd, sid)
+        failed = run_batch(args, [os.path.join(batch_sd, sid) for sid in sids])
+        if failed:
+            print(f'predict_batch failed subjects: {failed} FAIL')
+            passed = False
+
+        for sid in sids:
+            for hemi in args.hemi:
+                single_file = os.path.join(single_sd, sid, 'surf', f'{hemi}.sphere.reg')
+                batch_file = os.path.join(batch_sd, sid, 'surf', f'{hemi}.sphere.reg')
+                if not os.path.exists(batch_file):
+                    print(f'[{sid} {hemi}] no sphere.reg from predict_batch FAIL')
+                    passed = False
+                    continue
+                xyz_single, faces_single = nib.freesurfer.read_geometry(single_file)
+                xyz_batch, faces_batch = nib.freesurfer.read_geometry(batch_file)
+                diff = float(np.linalg.norm(xyz_batch - xyz_single, axis=1).max())
+                ok = np.array_equal(faces_single, faces_batch) and diff <= args.max_diff
+                passed = passed and ok
+                print(f'[{sid} {hemi}] max vertex distance: {diff:.2e} (tolerance {args.max_diff}) '
+                      f'{"OK" if ok else "FAIL"}')
+    return passed
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not check_batch(args):
+        exit(1)
@@ -0,0 +1,119 @@
+import os
+import copy
+import argparse
+import tempfile
+import numpy as np
+import torch
+
+from predict import get_config, register_hemisphere
+from model_registry import ModelRegistry
+from utils.telemetry import telemetry
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SUGAR: compare bf16 CPU inference against fp32 on one subject')
+    parser.add_argument('--hemi', help="which hemisphere")
+    parser.add_argument('--sid', required=True, help='Subject ID for directory inside $SUBJECTS_DIR')
+    parser.add_argument('--fsd', default=os.environ.get('FREESURFER_HOME'),
+                        help='Output directory $FREESURFER_HOME (pass via environment or here)')
+    parser.add_argument('--sd', default=os.environ.get('SUBJECTS_DIR'),
+                        help='Output directory $SUBJECTS_DIR (pass via environment or here)')
+    parser.add_argument('--model_path', required=True, help='The path of model')
+    parser.add_argument('--precision', default='bf16', choices=['bf16', 'auto'], help='precision to check')
+    parser.add_argument('--max_mean_deg', type=float, default=0.1,
+                        help='tolerance of the mean angular displacement between the two sphere.reg (degree)')
+    parser.add_argument('--max_p99_deg', type=float, default=0.5,
+                        help='tolerance of the 99th percentile angular displacement (degree)')
+    parser.add_argument('--max_distortion_diff', type=float, default=0.01,
+                        help='tolerance of the mean |log2 areal distortion| difference')
+    parser.add_argument('--max_negative_diff', type=int, default=10,
+                        help='tolerance of the difference in negative area triangles')
+
+    args = parser.parse_args()
+    if args.sd is None:
+        raise ValueError('Subjects dir need to set via $SUBJECTS_DIR environment or --sd parameter')
+    args_dict = vars(args)
+    args_dict['hemi'] = ['lh', 'rh'] if args.hemi is None else [args.hemi]
+    if args.fsd is None:
+        args_dict['fsd'] = '/usr/local/freesurfer'
+    args_dict['device'] = 'cpu'
+    return argparse.Namespace(**args_dict)
+
+
+def triangle_area(xyz, faces):
+    v0, v1, v2 = xyz[faces[:, 0]], xyz[faces[:, 1]], xyz[faces[:, 2]]
+    cross = np.cross(v1 - v0, v2 - v0)
+    area = np.linalg.norm(cross, axis=1) / 2
+    # 与 negative_area 相同：法向与顶点方向相反即为负面积
+    area[np.sum(cross * v0, axis=1) < 0] *= -1
+    return area
+
+
+def distortion_metrics(xyz_native, xyz_reg, faces):
+    """
+    sphere.reg 相对 native sphere 的面积畸变
+    """
+    area_native = np.abs(triangle_area(xyz_native, faces))
+    area_reg = triangle_area(xyz_reg, faces)
+    log_distortion = np.log2(np.maximum(np.abs(area_reg), 1e-12) / np.maximum(area_native, 1e-12))
+    return {
+        'mean_abs_log2_distortion': float(np.mean(np.abs(log_distortion))),
+        'negative_area': int(np.sum(area_reg < 0)),
+    }
+
+
+def angular_displacement(xyz_a, xyz_b):
+    a = xyz_a / np.linalg.norm(xyz_a, axis=1, keepdims=True)
+    b = xyz_b / np.linalg.norm(xyz_b, axis=1, keepdims=True)
+    return np.degrees(np.arccos(np.clip(np.sum(a * b, axis=1), -1, 1)))
+
+
+def run(args, config, registry, hemi, precision, out_dir):
+    config = copy.copy(config)
+    config['precision'] = precision
+    config['dir_predict_result'] = out_dir  # 不覆盖被试目录下的 sphere.reg
+    # 两种精度的阶段耗时分别记录在 fp32/... 与 bf16/... 下，便于对比加速比
+    with telemetry.context(hemi=hemi), telemetry.stage(precision):
+        state = register_hemisphere(config, hemi, registry)
+    return state
+
+
+def check_precision(args):
+    torch.set_num_threads(os.cpu_count())
+    config = get_config(args)
+    registry = ModelRegistry(args.model_path, 'cpu')
+    registry.preload(args.hemi)
+
+    passed = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for hemi in args.hemi:
+            state_fp32 = run(args, config, registry, hemi, 'fp32', os.path.join(tmp_dir, 'fp32'))
+            state_check = run(args, config, registry, hemi, args.precision, os.path.join(tmp_dir, args.precision))
+
+            xyz_native = state_fp32['native']['xyz']
+            faces = state_fp32['native']['faces']
+            metrics_fp32 = distortion_metrics(xyz_native, state_fp32['xyz_reg'], faces)
+            metrics_check = distortion_metrics(xyz_native, state_check['xyz_reg'], faces)
+            displacement = angular_displacement(state_fp32['xyz_reg'], state_check['xyz_reg'])
+
+            checks = {
+                'mean_deg': (float(displacement.mean()), args.max_mean_deg),
+                'p99_deg': (float(np.percentile(displacement, 99)), args.max_p99_deg),
+                'distortion_diff': (abs(metrics_check['mean_abs_log2_distortion'] -
+                                        metrics_fp32['mean_abs_log2_distortion']), args.max_distortion_diff),
+                'negative_diff': (abs(metrics_check['negative_area'] - metrics_fp32['negative_area']),
+                                  args.max_negative_diff),
+            }
+            print(f'[{hemi}] fp32: {metrics_fp32}  {args.precision}: {metrics_check}')
+            for name, (value, tolerance) in checks.items():
+                ok = value <= tolerance
+                passed = passed and ok
+                print(f'[{hemi}] {name}: {value:.4f} (tolerance {tolerance}) {"OK" if ok else "FAIL"}')
+    telemetry.print_summary()
+    return passed
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not check_precision(args):
+        exit(1)
@@ -1,10 +1,16 @@
 import os.path
+import threading
 
 import numpy as np
 import torch
 from torch.utils.data import Dataset
 from nibabel.freesurfer import read_morph_data, read_geometry, read_annot
 
+# fixed（fsaverage）侧的特征与被试无关，进程内只读取、归一化一次
+fixed_cache = dict()
+fixed_cache_lock = threading.Lock()
+fixed_cache_dir = os.environ.get('SUGAR_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'sugar'))
+
 
 def normalize(data, norm_method='SD', mean=None, std=None, mi=None, ma=None):
     """
@@ -55,11 +61,83 @@ def data_random_rotate(sulc, curv, xyz):
 
 
 
+def read_fixed(dir_fixed, ico_level, lrh, normalize_type):
+    surf_dir = os.path.join(dir_fixed, ico_level, 'surf')
+    sulc_fixed = read_morph_data(os.path.join(surf_dir, f'{lrh}.sulc')).astype(np.float32)
+    curv_fixed = read_morph_data(os.path.join(surf_dir, f'{lrh}.curv')).astype(np.float32)
+    xyz_fixed, faces_fixed = read_geometry(os.path.join(surf_dir, f'{lrh}.sphere'))
+    xyz_fixed = xyz_fixed.astype(np.float32) / 100
+    faces_fixed = faces_fixed.astype(int)
+
+    if normalize_type == 'PriorMinMax':
+        sulc_fixed *= 10
+    sulc_data_min = -12
+    sulc_data_max = 14
+    sulc_fixed = normalize(sulc_fixed, normalize_type, mi=sulc_data_min, ma=sulc_data_max)
+    curv_data_min = -1.3
+    curv_data_max = 1.0
+    curv_fixed = normalize(curv_fixed, normalize_type, mi=curv_data_min, ma=curv_data_max)
+
+    seg_fixed, seg_color_fixed, seg_name_fixed = read_annot(os.path.join(dir_fixed, ico_level, 'label', f'{lrh}.aparc.annot'))
+    seg_fixed = seg_fixed.astype(int)
+    return [sulc_fixed, curv_fixed, xyz_fixed, faces_fixed, seg_fixed]
+
+
+def get_fixed_source_files(dir_fixed, ico_level, lrh):
+    return [os.path.join(dir_fixed, ico_level, 'surf', f'{lrh}.sulc'),
+            os.path.join(dir_fixed, ico_level, 'surf', f'{lrh}.curv'),
+            os.path.join(dir_fixed, ico_level, 'surf', f'{lrh}.sphere'),
+            os.path.join(dir_fixed, ico_level, 'label', f'{lrh}.aparc.annot')]
+
+
+def load_fixed(dir_fixed, ico_level, lrh, normalize_type, cache_dir=None):
+    """
+    读取已归一化的 fixed 特征 [sulc, curv, xyz, faces, seg]
+    进程内缓存 + 每个 ico_level/半球 一个 npz 磁盘缓存（源文件 mtime 变化时重新生成）
+    """
+    key = (os.path.abspath(dir_fixed), ico_level, lrh, normalize_type)
+    with fixed_cache_lock:
+        if key in fixed_cache:
+            return fixed_cache[key]
+
+        if cache_dir is None:
+            cache_dir = fixed_cache_dir
+        source_mtimes = np.array([os.path.getmtime(f) for f in get_fixed_source_files(dir_fixed, ico_level, lrh)])
+        cache_file = os.path.join(cache_dir, f'{lrh}.{ico_level}.{normalize_type}.fixed.npz')
+
+        fixed = None
+        if os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as cache:
+                    if str(cache['dir_fixed']) == key[0] and np.array_equal(cache['source_mtimes'], source_mtimes):
+                        fixed = [cache['sulc'], cache['curv'], cache['xyz'], cache['faces'], cache['seg']]
+            except (OSError, KeyError, ValueError):
+                fixed = None
+
+        if fixed is None:
+            fixed = read_fixed(dir_fixed, ico_level, lrh, normalize_type)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_file = f'{cache_file}.{os.getpid()}.tmp.npz'
+                np.savez(tmp_file, sulc=fixed[0], curv=fixed[1], xyz=fixed[2], faces=fixed[3], seg=fixed[4],
+                         dir_fixed=key[0], source_mtimes=source_mtimes)
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                print(f'fixed cache not saved: {e}')
+
+        fixed_cache[key] = fixed
+        return fixed
+
+
 class SphericalDataset(Dataset):
     def __init__(self,  dir_fixed=None, dir_result=None,
                  lrh='lh', feature='sulc', norm_type='SD',
                  ico_levels=None,
-                 seg=False, is_train=True, is_da=False, is_rigid=False):
+                 seg=False, is_train=True, is_da=False, is_rigid=False, movings=None):
+        """
+        movings: {ico_level: {'sulc', 'curv', 'xyz', 'faces'}} 内存中已插值的 moving 数据，
+                 为 None 时从 dir_result 读取插值后的文件
+        """
         self.dir_fixed = dir_fixed
         self.dir_result = dir_result
         self.lrh = lrh
@@ -76,6 +154,7 @@ class SphericalDataset(Dataset):
         self.is_train = is_train
         self.is_rigid = is_rigid
         self.is_da = is_da
+        self.movings = movings
 
     def get_fixed(self):
         normalize_type = self.norm_type
@@ -83,25 +162,7 @@ class SphericalDataset(Dataset):
         if self.fixed is None:
             fixed = list()
             for ico_level in self.ico_levels:
-                dir_fixed = self.dir_fixed
-                sulc_fixed = read_morph_data(os.path.join(dir_fixed, ico_level, 'surf', f'{self.lrh}.sulc')).astype(np.float32)
-                curv_fixed = read_morph_data(os.path.join(dir_fixed, ico_level, 'surf', f'{self.lrh}.curv')).astype(np.float32)
-                xyz_fixed, faces_fixed = read_geometry(os.path.join(dir_fixed, ico_level, 'surf', f'{self.lrh}.sphere'))
-                xyz_fixed = xyz_fixed.astype(np.float32) / 100
-                faces_fixed = faces_fixed.astype(int)
-
-                if normalize_type == 'PriorMinMax':
-                    sulc_fixed *= 10
-                sulc_data_min = -12
-                sulc_data_max = 14
-                sulc_fixed = normalize(sulc_fixed, normalize_type, mi=sulc_data_min, ma=sulc_data_max)
-                curv_data_min = -1.3
-                curv_data_max = 1.0
-                curv_fixed = normalize(curv_fixed, normalize_type, mi=curv_data_min, ma=curv_data_max)
-
-                seg_fixed, seg_color_fixed, seg_name_fixed = read_annot(os.path.join(dir_fixed, ico_level, 'label', f'{self.lrh}.aparc.annot'))
-                seg_fixed = seg_fixed.astype(int)
-                fixed.append([sulc_fixed, curv_fixed, xyz_fixed, faces_fixed, seg_fixed])
+                fixed.append(load_fixed(self.dir_fixed, ico_level, self.lrh, normalize_type))
             self.fixed = fixed
         return self.fixed
 
@@ -115,14 +176,20 @@ class SphericalDataset(Dataset):
         else:
             data_type = 'rigid'
 
-        sulc_moving_interp = os.path.join(sub_dir_result, f'{self.lrh}.{data_type}.interp_{ico_level}.sulc')
-        curv_moving_interp = os.path.join(sub_dir_result, f'{self.lrh}.{data_type}.interp_{ico_level}.curv')
-        sphere_moving_file = os.path.join(sub_dir_result, f'{self.lrh}.{data_type}.interp_{ico_level}.sphere')
+        if self.movings is not None:
+            moving = self.movings[ico_level]
+            sulc_moving = moving['sulc'].astype(np.float32)
+            curv_moving = moving['curv'].astype(np.float32)
+            xyz_moving, faces_moving = moving['xyz'], moving['faces']
+        else:
+            sulc_moving_interp = os.path.join(sub_dir_result, f'{self.lrh}.{data_type}.interp_{ico_level}.sulc')
+            curv_moving_interp = os.path.join(sub_dir_result, f'{self.lrh}.{data_type}.interp_{ico_level}.curv')
+            sphere_moving_file = os.path.join(sub_dir_result, f'{self.lrh}.{data_type}.interp_{ico_level}.sphere')
 
-        sulc_moving = read_morph_data(sulc_moving_interp).astype(np.float32)
-        curv_moving = read_morph_data(curv_moving_interp).astype(np.float32)
+            sulc_moving = read_morph_data(sulc_moving_interp).astype(np.float32)
+            curv_moving = read_morph_data(curv_moving_interp).astype(np.float32)
 
-        xyz_moving, faces_moving = read_geometry(sphere_moving_file)
+            xyz_moving, faces_moving = read_geometry(sphere_moving_file)
         xyz_moving = xyz_moving.astype(np.float32) / 100
         faces_moving = faces_moving.astype(int)
 
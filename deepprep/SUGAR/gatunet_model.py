@@ -27,14 +27,35 @@ def xyz_to_lon_lat(xyz):
 
 
 def get_coordinates_feature(xyz):
+    # 与 xyz_to_lon_lat 相同的计算，但留在 xyz 所在设备上，避免 GPU->CPU->GPU
     xyz = xyz / torch.norm(xyz, dim=1, keepdim=True)
-    theta_phi = xyz_to_lon_lat(xyz)
-    theta_phi[:, 0] = theta_phi[:, 0] / np.pi
-    theta_phi[:, 1] = theta_phi[:, 1] / (2 * np.pi) + 0.5
-    theta_phi = torch.from_numpy(theta_phi)
+    x, y, z = xyz[:, [0]], xyz[:, [1]], xyz[:, [2]]
+    phi = torch.atan2(y, x)  # [−π,π]
+    theta = torch.atan2(torch.sqrt(x ** 2 + y ** 2), z)  # [0,π]
+    theta_phi = torch.cat([theta / np.pi, phi / (2 * np.pi) + 0.5], dim=1)
     return theta_phi
 
 
+def cpu_bf16_supported():
+    """
+    CPU 是否有原生 bf16 指令（AVX512-BF16 / AMX）
+    """
+    try:
+        return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+    except AttributeError:
+        return False
+
+
+def inference_autocast(device, precision='fp32'):
+    """
+    CPU 推理的混合精度上下文
+    precision: 'fp32' | 'bf16' | 'auto'（CPU 支持原生 bf16 时使用 bf16）；GPU 上始终为 fp32
+    """
+    device_type = torch.device(device).type
+    enabled = device_type == 'cpu' and (precision == 'bf16' or (precision == 'auto' and cpu_bf16_supported()))
+    return torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=enabled)
+
+
 class Embedding(nn.Module):
     def __init__(self, in_channels, N_freqs, logscale=True):
         """
@@ -230,7 +251,7 @@ class GatUNet(nn.Module):
 
     def forward(self, x, xyz_moving, face=None):
         if self.theta_phi is None:
-            self.theta_phi = get_coordinates_feature(xyz_moving).to(x.device)
+            self.theta_phi = get_coordinates_feature(xyz_moving.to(x.device))
             self.p_e = self.pe(self.theta_phi)
         if self.en is None:
             self.en = get_en_torch(xyz_moving)
@@ -273,9 +294,12 @@ class GatUNet(nn.Module):
         if no_pe:
             edge_feature = None
         euler_angle = self.output_encoding(x, edge_index, edge_attr=edge_feature)
-        if self.rigid:
-            euler_angle = torch.mean(euler_angle, dim=0, keepdim=True)
-        xyz_moved = apply_rotate_matrix(euler_angle, xyz_moving, norm=True, en=self.en, face=face)
+        # 网络部分可以在 bf16 autocast 下运行，旋转与插值始终用 fp32
+        euler_angle = euler_angle.float()
+        with torch.autocast(device_type=euler_angle.device.type, enabled=False):
+            if self.rigid:
+                euler_angle = torch.mean(euler_angle, dim=0, keepdim=True)
+            xyz_moved = apply_rotate_matrix(euler_angle, xyz_moving, norm=True, en=self.en, face=face)
         return xyz_moved, euler_angle
 
 
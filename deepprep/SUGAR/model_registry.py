@@ -0,0 +1,42 @@
+import os
+import threading
+
+from sphere_registrate_norigid_multi_level_multi_fixed_predict import load_models
+
+rigid_ico_levels = ['fsaverage6']
+norigid_ico_levels = ['fsaverage3', 'fsaverage4', 'fsaverage5', 'fsaverage6']
+
+
+def get_model_files(model_path, hemi, is_rigid):
+    if is_rigid:
+        return [os.path.join(model_path, ico_level, f'{hemi}_Rigid_904_{ico_level}.model')
+                for ico_level in rigid_ico_levels]
+    else:
+        return [os.path.join(model_path, ico_level, f'{hemi}_NoRigid_904_{ico_level}.model')
+                for ico_level in norigid_ico_levels]
+
+
+class ModelRegistry:
+    """
+    所有阶段（rigid fsaverage6, norigid fsaverage3-6）的模型只加载一次，按 (hemi, is_rigid) 取用。
+    模型与被试无关，可在多个半球/被试之间复用。
+    """
+
+    def __init__(self, model_path, device):
+        self.model_path = model_path
+        self.device = device
+        self._models = dict()
+        self._lock = threading.Lock()
+
+    def preload(self, hemis):
+        for hemi in hemis:
+            for is_rigid in (True, False):
+                self.get(hemi, is_rigid)
+
+    def get(self, hemi, is_rigid):
+        key = (hemi, is_rigid)
+        with self._lock:
+            if key not in self._models:
+                model_files = get_model_files(self.model_path, hemi, is_rigid)
+                self._models[key] = load_models(model_files, self.device)
+            return self._models[key]
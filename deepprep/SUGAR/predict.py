@@ -1,11 +1,17 @@
 import os
+import copy
 import torch
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from sphere_registrate_norigid_multi_level_multi_fixed_predict import train_val
+from model_registry import ModelRegistry, rigid_ico_levels, norigid_ico_levels
 from utils.auxi_data import get_geometry_all_level_torch
 from weight import get_weight
 from pathlib import Path
 import argparse
-from utils.negative_area_triangle import single_remove_negative_area
+import nibabel as nib
+from utils.negative_area_triangle import single_remove_negative_area_data
+from utils.telemetry import telemetry
 
 
 def parse_args():
@@ -20,6 +26,14 @@ def parse_args():
                         help='Output directory $SUBJECTS_DIR (pass via environment or here)')
     parser.add_argument('--model_path', required=True, help='The path of model')
     parser.add_argument('--device', default='cuda', help='Use number of cuda or cpu')
+    parser.add_argument('--parallel', default='serial', choices=['serial', 'thread', 'process'],
+                        help='How to run the hemispheres: serial, concurrent threads or concurrent processes')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='Total torch threads, split evenly between the concurrently running hemispheres')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'auto'],
+                        help='CPU inference precision of the GatUNet (bf16 autocast); auto uses bf16 when the CPU supports it')
+    parser.add_argument('--save_intermediate', default=False, action='store_true',
+                        help='Debug: also write the intermediate interp/rigid/up_fsaverage spheres to $SUBJECTS_DIR/sid/tmp')
 
     args = parser.parse_args()
     if args.sd is None:
@@ -42,20 +56,25 @@ def parse_args():
     return argparse.Namespace(**args_dict)
 
 
-if __name__ == '__main__':
-    # abspath = os.path.abspath(os.path.dirname(__file__))
-    args = parse_args()
+def get_config(args, subj_dir=None, geometry=None):
+    """
+    geometry: get_geometry_all_level_torch() 的结果，多个被试共用时只需构建一次
+    """
+    if subj_dir is None:
+        subj_dir = os.path.join(args.sd, args.sid)
     config = dict()
     # ========================== Predict Config ============================= #
 
     config["dir_fixed"] = os.path.join(args.fsd, 'subjects')  # FreeSurfer fsaverage6 目录
-    config["dir_predict_recon"] = os.path.join(args.sd, args.sid)  # native recon dir
-    config["dir_predict_rigid"] = os.path.join(args.sd, args.sid, 'tmp')  # rigid predict result dir
-    config["dir_predict_result"] = os.path.join(args.sd, args.sid) # norigid predict result dir
+    config["dir_predict_recon"] = subj_dir  # native recon dir
+    config["dir_predict_rigid"] = os.path.join(subj_dir, 'tmp')  # rigid predict result dir
+    config["dir_predict_result"] = subj_dir  # norigid predict result dir
 
     # ========================== Default Config ============================= #
 
-    xyzs, faces = get_geometry_all_level_torch()
+    if geometry is None:
+        geometry = get_geometry_all_level_torch()
+    xyzs, faces = geometry
     config['xyz'] = xyzs
     config['face'] = faces
     ico_level = 'fsaverage6'
@@ -68,54 +87,123 @@ if __name__ == '__main__':
     config['is_da'] = True
     config["ico_level"] = ico_level
     config["model_name"] = "GatUNet"
-    sulc_curv_weight = [[1, 0], [1, 0], [1, 0], [1, 0]]
     config["n_vertex"] = 40962  # 当前细化等级的顶点数量163842 40962
     config["normalize_type"] = 'zscore'  # 计算与相邻顶点的push距离
     config["feature"] = ['sulc', 'sulc', 'sulc', 'sulc']
+    config['save_intermediate'] = getattr(args, 'save_intermediate', False)
+    config['precision'] = getattr(args, 'precision', 'fp32')
+    return config
 
-    # ############### rigid predict #########################
 
-    ico_levels = ['fsaverage6']
-    ico_index = ico_levels.index(ico_level)
+def get_stage_config(config, hemi, is_rigid):
+    config = copy.copy(config)
+    ico_levels = rigid_ico_levels if is_rigid else norigid_ico_levels
     config['ico_levels'] = ico_levels
-    config['ico_index'] = ico_index
-
-    config['is_rigid'] = True
-
-    rigid_model_result_dir = [f'{args.model_path}/fsaverage6']
-    for hemi in args.hemi:
-        config['sim_weight'] = torch.from_numpy(get_weight('sulc', hemi).astype(float)).float()
-        config["hemisphere"] = hemi
-        model_files = []
-        for i in range(len(ico_levels)):
-            model_files.append(os.path.join(rigid_model_result_dir[i],
-                                            f'{config["hemisphere"]}_Rigid_904_{ico_levels[i]}.model'))
-        config["model_files"] = model_files
-        train_val(config=config)
-    # exit()
-# ############### norigid predict #########################
-
-    ico_levels = ['fsaverage3', 'fsaverage4', 'fsaverage5', 'fsaverage6']
-    ico_index = ico_levels.index(ico_level)
-    config['ico_levels'] = ico_levels
-    config['ico_index'] = ico_index
-    config['is_rigid'] = False
-    norigid_model_result_dir = [
-        f'{args.model_path}/fsaverage3',
-        f'{args.model_path}/fsaverage4',
-        f'{args.model_path}/fsaverage5',
-        f'{args.model_path}/fsaverage6'
-    ]
-    for hemi in args.hemi:
-        config["hemisphere"] = hemi
-        config['sim_weight'] = torch.from_numpy(get_weight('sulc', hemi).astype(float)).float()
-        model_files = []
-        for i in range(len(ico_levels)):
-            model_files.append(os.path.join(norigid_model_result_dir[i],
-                                            f'{config["hemisphere"]}_NoRigid_904_{ico_levels[i]}.model'))
-        config["model_files"] = model_files
-        train_val(config=config)
-        # remove negative area triangles
-        sphere_moved_native_neg_file = os.path.join(args.sd, args.sid, 'surf', f'{hemi}.sphere.reg')
-        sphere_moved_native_file = os.path.join(args.sd, args.sid, 'surf', f'{hemi}.sphere.reg')
-        single_remove_negative_area(sphere_moved_native_neg_file, sphere_moved_native_file, device=config['device'])
+    config['ico_index'] = ico_levels.index(config['ico_level'])
+    config['is_rigid'] = is_rigid
+    config["hemisphere"] = hemi
+    config['sim_weight'] = torch.from_numpy(get_weight('sulc', hemi).astype(float)).float()
+    return config
+
+
+def get_subject(config):
+    return os.path.basename(os.path.normpath(config["dir_predict_recon"]))
+
+
+def register_hemisphere(config, hemi, registry, state=None):
+    """
+    单个半球: rigid predict -> norigid predict，两个阶段之间的数据通过 state 在内存中传递
+    各阶段耗时/内存记录在 telemetry 中
+    """
+    if state is None:
+        state = dict()
+
+    with telemetry.context(subject=get_subject(config), hemi=hemi):
+        # ############### rigid predict #########################
+        with telemetry.stage('rigid'):
+            train_val(config=get_stage_config(config, hemi, True), models=registry.get(hemi, True), state=state)
+
+        # ############### norigid predict #########################
+        with telemetry.stage('norigid'):
+            train_val(config=get_stage_config(config, hemi, False), models=registry.get(hemi, False), state=state)
+    return state
+
+
+def repair_hemisphere(config, hemi, state):
+    """
+    remove negative area triangles of the final sphere.reg (state['xyz_reg']) and write it
+    """
+    surf_dir = os.path.join(config["dir_predict_result"], 'surf')
+    sphere_moved_native_file = os.path.join(surf_dir, f'{hemi}.sphere.reg')
+    faces_native = state['native']['faces']
+    with telemetry.context(subject=get_subject(config), hemi=hemi), telemetry.stage('repair'):
+        xyz_removed = single_remove_negative_area_data(state['xyz_reg'], faces_native, device=config['device'])
+        xyz_reg = state['xyz_reg'] if xyz_removed is None else xyz_removed
+        with telemetry.stage('write'):
+            os.makedirs(surf_dir, exist_ok=True)
+            nib.freesurfer.write_geometry(sphere_moved_native_file, xyz_reg, faces_native)
+            print(f'sphere.reg >>> {sphere_moved_native_file}')
+
+
+def predict_hemisphere(config, hemi, registry):
+    """
+    单个半球: rigid predict -> norigid predict -> remove negative area triangles
+    """
+    state = register_hemisphere(config, hemi, registry)
+    repair_hemisphere(config, hemi, state)
+
+
+def load_registry(model_path, device, hemis):
+    with telemetry.context(hemi='_'.join(hemis)), telemetry.stage('load_models'):
+        registry = ModelRegistry(model_path, device)
+        registry.preload(hemis)
+    return registry
+
+
+def predict_hemisphere_process(config, hemi, model_path):
+    """
+    子进程中运行一个半球，返回该进程的 telemetry 记录
+    """
+    telemetry.device = config['device']
+    registry = load_registry(model_path, config['device'], [hemi])
+    predict_hemisphere(config, hemi, registry)
+    return telemetry.records
+
+
+def predict(args, config):
+    hemis = args.hemi
+    workers = len(hemis) if args.parallel != 'serial' else 1
+    threads = max(1, args.threads // workers)
+    telemetry.device = config['device']
+    telemetry.meta.update({'parallel': args.parallel, 'threads': args.threads, 'hemis': hemis,
+                           'precision': config['precision']})
+
+    if args.parallel == 'process' and workers > 1:
+        ctx = multiprocessing.get_context('spawn')
+        # 每个子进程启动时在其主线程中设置一次 torch 线程数
+        with ctx.Pool(workers, initializer=torch.set_num_threads, initargs=(threads,)) as pool:
+            results = [pool.apply_async(predict_hemisphere_process, (config, hemi, args.model_path))
+                       for hemi in hemis]
+            for result in results:
+                telemetry.extend(result.get())
+    else:
+        torch.set_num_threads(threads)
+        registry = load_registry(args.model_path, config['device'], hemis)
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(predict_hemisphere, config, hemi, registry) for hemi in hemis]
+                for future in futures:
+                    future.result()
+        else:
+            for hemi in hemis:
+                predict_hemisphere(config, hemi, registry)
+
+    telemetry.print_summary()
+    telemetry.write_json(os.path.join(config["dir_predict_result"], 'scripts', f'sugar_telemetry.{"_".join(hemis)}.json'))
+
+
+if __name__ == '__main__':
+    # abspath = os.path.abspath(os.path.dirname(__file__))
+    args = parse_args()
+    config = get_config(args)
+    predict(args, config)
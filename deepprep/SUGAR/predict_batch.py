@@ -0,0 +1,130 @@
+import os
+import argparse
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+from predict import get_config, get_subject, register_hemisphere, repair_hemisphere, load_registry
+from sphere_registrate_norigid_multi_level_multi_fixed_predict import read_moving_surf
+from utils.auxi_data import get_geometry_all_level_torch
+from utils.telemetry import telemetry
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SUGAR batch predict: one process for many subjects')
+    parser.add_argument('--subject_dirs', nargs='*', default=[], help='Subject recon directories')
+    parser.add_argument('--subjects_file', help='Text file with one subject recon directory per line')
+    parser.add_argument('--hemi', help="which hemisphere")
+    parser.add_argument('--fsd', default=os.environ.get('FREESURFER_HOME'),
+                        help='Output directory $FREESURFER_HOME (pass via environment or here)')
+    parser.add_argument('--model_path', required=True, help='The path of model')
+    parser.add_argument('--device', default='cuda', help='Use number of cuda or cpu')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(),
+                        help='Total torch threads, split evenly between the concurrently running hemispheres')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='How many subjects to read ahead while the current subject is running')
+    parser.add_argument('--writers', type=int, default=1,
+                        help='Number of background threads writing the final sphere.reg results')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'auto'],
+                        help='CPU inference precision of the GatUNet (bf16 autocast); auto uses bf16 when the CPU supports it')
+    parser.add_argument('--save_intermediate', default=False, action='store_true',
+                        help='Debug: also write the intermediate interp/rigid/up_fsaverage spheres to subject tmp dir')
+
+    args = parser.parse_args()
+    args_dict = vars(args)
+
+    subject_dirs = list(args.subject_dirs)
+    if args.subjects_file is not None:
+        with open(args.subjects_file) as f:
+            subject_dirs.extend(line.strip() for line in f if line.strip())
+    if len(subject_dirs) == 0:
+        raise ValueError('No subject, please set --subject_dirs or --subjects_file')
+    for subj_dir in subject_dirs:
+        if not os.path.exists(subj_dir):
+            raise ValueError(f'{subj_dir} is not exists, please check.')
+    args_dict['subject_dirs'] = subject_dirs
+
+    if args.hemi is None:
+        args_dict['hemi'] = ['lh', 'rh']
+    else:
+        args_dict['hemi'] = [args.hemi]
+
+    if args.fsd is None:
+        args_dict['fsd'] = '/usr/local/freesurfer'
+
+    return argparse.Namespace(**args_dict)
+
+
+def repair_subject(config, states):
+    for hemi, state in states.items():
+        repair_hemisphere(config, hemi, state)
+
+
+def write_subject_telemetry(config, hemis):
+    json_file = os.path.join(config["dir_predict_result"], 'scripts', f'sugar_telemetry.{"_".join(hemis)}.json')
+    telemetry.write_json(json_file, subject=get_subject(config))
+
+
+def predict_batch(args):
+    """
+    所有被试共用一个进程: 模型与 fsaverage 几何只加载一次,
+    下一个被试的 sphere/sulc/curv 在后台线程预读取, 最终的 sphere.reg 在后台线程写出
+    各阶段耗时/内存记录在 telemetry 中, 每个被试写出一个 JSON 报告
+    返回失败的被试列表
+    """
+    hemis = args.hemi
+    subject_dirs = args.subject_dirs
+    torch.set_num_threads(max(1, args.threads // len(hemis)))
+    telemetry.device = args.device
+    telemetry.meta.update({'parallel': 'batch', 'threads': args.threads, 'hemis': hemis,
+                           'precision': args.precision, 'prefetch': args.prefetch, 'writers': args.writers})
+
+    registry = load_registry(args.model_path, args.device, hemis)
+    geometry = get_geometry_all_level_torch()
+
+    failed = list()
+    writes = list()
+    with ThreadPoolExecutor(max_workers=max(1, args.prefetch)) as reader, \
+            ThreadPoolExecutor(max_workers=max(1, args.writers)) as writer, \
+            ThreadPoolExecutor(max_workers=len(hemis)) as hemi_pool:
+        prefetched = deque()
+        next_index = 0
+        for subj_dir in subject_dirs:
+            while next_index < len(subject_dirs) and len(prefetched) <= args.prefetch:
+                prefetched.append(reader.submit(read_moving_surf, subject_dirs[next_index], hemis))
+                next_index += 1
+            try:
+                config = get_config(args, subj_dir, geometry)
+                with telemetry.context(subject=get_subject(config)), telemetry.stage('wait_prefetch'):
+                    moving_datas = prefetched.popleft().result()
+
+                config['moving_datas'] = moving_datas
+                states = {hemi: dict() for hemi in hemis}
+                futures = [hemi_pool.submit(register_hemisphere, config, hemi, registry, states[hemi])
+                           for hemi in hemis]
+                for future in futures:
+                    future.result()
+                writes.append((config, writer.submit(repair_subject, config, states)))
+            except Exception:
+                traceback.print_exc()
+                failed.append(subj_dir)
+
+        for config, future in writes:
+            try:
+                future.result()
+                write_subject_telemetry(config, hemis)
+            except Exception:
+                traceback.print_exc()
+                failed.append(config['dir_predict_recon'])
+
+    telemetry.print_summary()
+    return failed
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    failed = predict_batch(args)
+    if failed:
+        print(f'[SUGAR] failed subjects: {failed}')
+        exit(1)
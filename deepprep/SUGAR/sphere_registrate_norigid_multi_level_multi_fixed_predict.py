@@ -6,61 +6,103 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
 from dataset_multi_level_multi_fixed_predict import SphericalDataset
-from utils.interp_fine import interp_sulc_curv_barycentric
+from utils.interp_fine import resample_sulc_curv_barycentric
 from utils.rotate_matrix import apply_rotate_matrix
 from utils.negative_area_triangle import count_negative_area
 from utils.interp_fine import resample_sphere_surface_barycentric, upsample_std_sphere_torch
-from utils.auxi_data import get_points_num_by_ico_level
+from utils.auxi_data import get_points_num_by_ico_level, fs_to_num
+from gatunet_model import inference_autocast
+from utils.telemetry import telemetry
 
 
-def interp_dir_single(dir_recon: str, dir_rigid: str, dir_fixed: str, ico_level: str, device, hemis=None, is_rigid=False):
+def read_moving_surf(dir_recon: str, hemis):
     """
-    预处理：将native空间插值到fsaverage空间
+    读取 native 空间的 sphere/sulc/curv，供 batch 模式在后台线程中预读取下一个被试
     """
-    if hemis is None:
-        hemis = ['lh', 'rh']
-    elif isinstance(hemis, str):
-        hemis = [hemis]
-    elif isinstance(hemis, list):
-        pass
-
     surf_dir_recon = os.path.join(dir_recon, 'surf')
-    surf_dir_rigid = os.path.join(dir_rigid, 'surf')
-    if not os.path.exists(surf_dir_rigid):
-        os.makedirs(surf_dir_rigid, exist_ok=True)
+    moving_datas = dict()
     for hemisphere in hemis:
-        sphere_fixed_file = os.path.join(dir_fixed, ico_level, 'surf', f'{hemisphere}.sphere')
-
-        # ## 将刚性配准的结果插值到fsaverageN
-        sulc_moving_file = os.path.join(surf_dir_recon, f'{hemisphere}.sulc')
-        curv_moving_file = os.path.join(surf_dir_recon, f'{hemisphere}.curv')
-        if is_rigid:
-            data_type = 'orig'
-            sphere_moving_file = os.path.join(surf_dir_recon, f'{hemisphere}.sphere')
+        xyz, faces = nib.freesurfer.read_geometry(os.path.join(surf_dir_recon, f'{hemisphere}.sphere'))
+        moving_datas[hemisphere] = {
+            'sulc': nib.freesurfer.read_morph_data(os.path.join(surf_dir_recon, f'{hemisphere}.sulc')),
+            'curv': nib.freesurfer.read_morph_data(os.path.join(surf_dir_recon, f'{hemisphere}.curv')),
+            'xyz': xyz,
+            'faces': faces,
+        }
+    return moving_datas
+
+
+def get_state_native(config, hemisphere, state):
+    """
+    native 空间的 sphere/sulc/curv，优先使用 batch 模式预读取的数据
+    """
+    if 'native' not in state:
+        moving_datas = config.get('moving_datas')
+        if moving_datas is not None and hemisphere in moving_datas:
+            state['native'] = moving_datas[hemisphere]
         else:
-            data_type = 'rigid'
-            sphere_moving_file = os.path.join(surf_dir_rigid, f'{hemisphere}.rigid.sphere')  # 跑完刚性配准以后有这个文件
+            state['native'] = read_moving_surf(config["dir_predict_recon"], [hemisphere])[hemisphere]
+    return state['native']
 
-        if not os.path.exists(sphere_moving_file):
-            continue
 
+def get_state_rigid(config, hemisphere, state):
+    """
+    刚性配准后的 native sphere (×100)，不在内存中时读取 tmp 目录下的中间文件
+    """
+    if 'xyz_rigid' not in state:
+        sphere_rigid_native_file = os.path.join(config["dir_predict_rigid"], 'surf', f'{hemisphere}.rigid.sphere')
+        state['xyz_rigid'], _ = nib.freesurfer.read_geometry(sphere_rigid_native_file)
+    return state['xyz_rigid']
+
+
+def interp_hemisphere(config, hemisphere, state, ico_level, device):
+    """
+    预处理：将native空间插值到fsaverage空间
+    return: {ico_level: {'sulc', 'curv', 'xyz', 'faces'}}，供 SphericalDataset 直接使用
+    """
+    native = get_state_native(config, hemisphere, state)
+    if config['is_rigid']:
+        data_type = 'orig'
+        xyz_moving = native['xyz']
+    else:
+        data_type = 'rigid'
+        xyz_moving = get_state_rigid(config, hemisphere, state)
+
+    sphere_fixed_file = os.path.join(config["dir_fixed"], ico_level, 'surf', f'{hemisphere}.sphere')
+    xyz_fixed, faces_fixed = nib.freesurfer.read_geometry(sphere_fixed_file)
+    sulc_interp, curv_interp = resample_sulc_curv_barycentric(native['sulc'], native['curv'], xyz_moving, xyz_fixed,
+                                                              device)
+
+    if config.get('save_intermediate', False):
+        surf_dir_rigid = os.path.join(config["dir_predict_rigid"], 'surf')
+        os.makedirs(surf_dir_rigid, exist_ok=True)
         sulc_moving_interp_file = os.path.join(surf_dir_rigid, f'{hemisphere}.{data_type}.interp_{ico_level}.sulc')
         curv_moving_interp_file = os.path.join(surf_dir_rigid, f'{hemisphere}.{data_type}.interp_{ico_level}.curv')
         sphere_moving_interp_file = os.path.join(surf_dir_rigid,
                                                  f'{hemisphere}.{data_type}.interp_{ico_level}.sphere')
-        # if not os.path.exists(sulc_moving_interp_file):
-        interp_sulc_curv_barycentric(sulc_moving_file, curv_moving_file, sphere_moving_file, sphere_fixed_file,
-                                     sulc_moving_interp_file, curv_moving_interp_file,
-                                     sphere_moving_interp_file, device)
+        nib.freesurfer.write_morph_data(sulc_moving_interp_file, sulc_interp)
+        nib.freesurfer.write_morph_data(curv_moving_interp_file, curv_interp)
+        nib.freesurfer.write_geometry(sphere_moving_interp_file, xyz_fixed, faces_fixed)
         print(f'interp: >>> {sulc_moving_interp_file}')
         print(f'interp: >>> {curv_moving_interp_file}')
         print(f'interp: >>> {sphere_moving_interp_file}')
 
+    return {ico_level: {'sulc': sulc_interp, 'curv': curv_interp, 'xyz': xyz_fixed, 'faces': faces_fixed}}
+
 
-def save_sphere_reg(config, hemisphere, xyz_moved, euler_angle, dir_recon, dir_rigid, dir_result, device):
+def save_sphere_reg(config, hemisphere, xyz_moved, euler_angle, dir_recon, dir_rigid, dir_result, device, state=None):
+    """
+    将 fsaverage 上的配准结果变换回 native 空间
+    rigid: 结果保存在 state['xyz_rigid'] 供非刚性阶段使用
+    norigid: 最终的 sphere.reg 保存在 state['xyz_reg']，不在这里写出
+    其余中间文件只在 config['save_intermediate'] 时写出
+    """
     # #################################################################################################### #
+    if state is None:
+        state = dict()
     faces = config['face']
     xyzs = config['xyz']
+    save_intermediate = config.get('save_intermediate', False)
 
     if config['is_rigid']:
         data_type = 'orig'
@@ -68,97 +110,65 @@ def save_sphere_reg(config, hemisphere, xyz_moved, euler_angle, dir_recon, dir_r
     else:
         data_type = 'rigid'
         surf_dir_out = os.path.join(dir_rigid, 'surf')
-        surf_res_out = os.path.join(dir_result, 'surf')
-
-    # # save sphere.reg in f saverage6 not apply rotate matrix
-    faces_fs = faces[config["ico_level"]].cpu().numpy()
-    if not os.path.exists(surf_dir_out):
-        os.makedirs(surf_dir_out)
-    sphere_moved_fs_file = os.path.join(surf_dir_out,
-                                        f'{hemisphere}.{data_type}.interp_{config["ico_level"]}.sphere.reg')
-    nib.freesurfer.write_geometry(sphere_moved_fs_file, xyz_moved.detach().cpu().numpy() * 100, faces_fs)
-    print(f'sphere_moved_fs_file >>> {sphere_moved_fs_file}')
-
-    # # apply rotate matrix to rigid.interp_fs5.sphere
-    if config["ico_level"] == 'fsaverage3':
 
-        xyz_moved_tmp = upsample_std_sphere_torch(xyz_moved.detach(), norm=True)
+    if save_intermediate:
+        # # save sphere.reg in f saverage6 not apply rotate matrix
+        faces_fs = faces[config["ico_level"]].cpu().numpy()
+        if not os.path.exists(surf_dir_out):
+            os.makedirs(surf_dir_out)
         sphere_moved_fs_file = os.path.join(surf_dir_out,
-                                            f'{hemisphere}.{data_type}.interp_{config["ico_level"]}.up_fsaverage4.sphere.reg')
-        faces_fs4 = faces["fsaverage4"].cpu().numpy()
-        nib.freesurfer.write_geometry(sphere_moved_fs_file, xyz_moved_tmp.cpu().numpy() * 100, faces_fs4)
+                                            f'{hemisphere}.{data_type}.interp_{config["ico_level"]}.sphere.reg')
+        nib.freesurfer.write_geometry(sphere_moved_fs_file, xyz_moved.detach().cpu().numpy() * 100, faces_fs)
         print(f'sphere_moved_fs_file >>> {sphere_moved_fs_file}')
 
-        xyz_moved_tmp = upsample_std_sphere_torch(xyz_moved_tmp, norm=True)
-
-        sphere_moved_fs_file = os.path.join(surf_dir_out,
-                                            f'{hemisphere}.{data_type}.interp_{config["ico_level"]}.up_fsaverage5.sphere.reg')
-        faces_fs5 = faces["fsaverage5"].cpu().numpy()
-        nib.freesurfer.write_geometry(sphere_moved_fs_file, xyz_moved_tmp.cpu().numpy() * 100, faces_fs5)
-        print(f'sphere_moved_fs_file >>> {sphere_moved_fs_file}')
-
-        xyz_moved_tmp = upsample_std_sphere_torch(xyz_moved_tmp, norm=True)
-
-        sphere_moved_fs_file = os.path.join(surf_dir_out,
-                                            f'{hemisphere}.{data_type}.interp_{config["ico_level"]}.up_fsaverage6.sphere.reg')
-        faces_fs6 = faces["fsaverage6"].cpu().numpy()
-        nib.freesurfer.write_geometry(sphere_moved_fs_file, xyz_moved_tmp.cpu().numpy() * 100, faces_fs6)
-        print(f'sphere_moved_fs_file >>> {sphere_moved_fs_file}')
-
-    elif config["ico_level"] == 'fsaverage4':
-
-        xyz_moved_tmp = upsample_std_sphere_torch(xyz_moved.detach(), norm=True)
-        sphere_moved_fs_file = os.path.join(surf_dir_out,
-                                            f'{hemisphere}.{data_type}.interp_{config["ico_level"]}.up_fsaverage5.sphere.reg')
-        faces_fs5 = faces["fsaverage5"].cpu().numpy()
-        nib.freesurfer.write_geometry(sphere_moved_fs_file, xyz_moved_tmp.cpu().numpy() * 100, faces_fs5)
-        print(f'sphere_moved_fs_file >>> {sphere_moved_fs_file}')
-
-        xyz_moved_tmp = upsample_std_sphere_torch(xyz_moved_tmp, norm=True)
-
-        sphere_moved_fs_file = os.path.join(surf_dir_out,
-                                            f'{hemisphere}.{data_type}.interp_{config["ico_level"]}.up_fsaverage6.sphere.reg')
-        faces_fs6 = faces["fsaverage6"].cpu().numpy()
-        nib.freesurfer.write_geometry(sphere_moved_fs_file, xyz_moved_tmp.cpu().numpy() * 100, faces_fs6)
-        print(f'sphere_moved_fs_file >>> {sphere_moved_fs_file}')
-
-    elif config["ico_level"] == 'fsaverage5':
-        sphere_moved_fs_file = os.path.join(surf_dir_out,
-                                            f'{hemisphere}.{data_type}.interp_{config["ico_level"]}.up_fsaverage6.sphere.reg')
-        xyz_moved_tmp = upsample_std_sphere_torch(xyz_moved.detach(), norm=True)
-        faces_fs6 = faces["fsaverage6"].cpu().numpy()
-        nib.freesurfer.write_geometry(sphere_moved_fs_file, xyz_moved_tmp.cpu().numpy() * 100, faces_fs6)
-        print(f'sphere_moved_fs_file >>> {sphere_moved_fs_file}')
-    else:
-        xyz_moved_tmp = xyz_moved
+    # # upsample xyz_moved to fsaverage6
+    xyz_moved_tmp = xyz_moved
+    level = fs_to_num(config["ico_level"])
+    while level < 6:
+        level += 1
+        xyz_moved_tmp = upsample_std_sphere_torch(xyz_moved_tmp.detach(), norm=True)
+        if save_intermediate:
+            sphere_moved_fs_file = os.path.join(surf_dir_out,
+                                                f'{hemisphere}.{data_type}.interp_{config["ico_level"]}.up_fsaverage{level}.sphere.reg')
+            faces_up = faces[f"fsaverage{level}"].cpu().numpy()
+            nib.freesurfer.write_geometry(sphere_moved_fs_file, xyz_moved_tmp.cpu().numpy() * 100, faces_up)
+            print(f'sphere_moved_fs_file >>> {sphere_moved_fs_file}')
 
     # if output_native is True:
     xyz_fixed_fs6 = xyzs['fsaverage6'].to(device)
+    native = get_state_native(config, hemisphere, state)
+    faces_native = native['faces']
 
     # interp sphere.reg to native space
     if not config['is_rigid']:
-        sphere_rigid_native_file = os.path.join(dir_rigid, 'surf', f'{hemisphere}.rigid.sphere')
-        sphere_moved_native_file = os.path.join(surf_res_out, f'{hemisphere}.sphere.reg')
-
-        xyz_native, faces_native = nib.freesurfer.read_geometry(sphere_rigid_native_file)
+        xyz_native = get_state_rigid(config, hemisphere, state)
         xyz_native = torch.from_numpy(xyz_native).float().to(device) / 100
         xyz_moved_native = resample_sphere_surface_barycentric(xyz_fixed_fs6, xyz_native, xyz_moved_tmp,
                                                                device=device)
         xyz_moved_native = xyz_moved_native / torch.norm(xyz_moved_native, dim=1, keepdim=True)
+        xyz_moved_native = xyz_moved_native.detach().cpu().numpy() * 100
+
+        # 最终的 sphere.reg 由 predict.repair_hemisphere 去除负面积三角形后写出
+        state['xyz_reg'] = xyz_moved_native
 
     else:
-        sphere_rigid_native_file = os.path.join(dir_recon, 'surf', f'{hemisphere}.sphere')
-        sphere_moved_native_file = os.path.join(surf_dir_out, f'{hemisphere}.rigid.sphere')
-        xyz_native, faces_native = nib.freesurfer.read_geometry(sphere_rigid_native_file)
-        xyz_native = torch.from_numpy(xyz_native).float().to(device) / 100
+        xyz_native = torch.from_numpy(native['xyz']).float().to(device) / 100
         xyz_moved_native = apply_rotate_matrix(euler_angle, xyz_native, norm=True)
+        xyz_moved_native = xyz_moved_native.detach().cpu().numpy() * 100
 
-    nib.freesurfer.write_geometry(sphere_moved_native_file, xyz_moved_native.detach().cpu().numpy() * 100,
-                                  faces_native)
-    print(f'sphere.reg >>> {sphere_moved_native_file}')
+        if save_intermediate:
+            os.makedirs(surf_dir_out, exist_ok=True)
+            sphere_moved_native_file = os.path.join(surf_dir_out, f'{hemisphere}.rigid.sphere')
+            nib.freesurfer.write_geometry(sphere_moved_native_file, xyz_moved_native, faces_native)
+            print(f'sphere.reg >>> {sphere_moved_native_file}')
+        state['xyz_rigid'] = xyz_moved_native
+    return state
 
 
-def infer(moving_datas, fixed_datas, models, faces, ico_levels, features, device='cuda'):
+def infer(moving_datas, fixed_datas, models, faces, ico_levels, features, device='cuda', precision='fp32'):
+    """
+    precision: CPU 上网络部分的推理精度 'fp32' | 'bf16' | 'auto'，见 inference_autocast
+    """
     assert len(moving_datas) > 0
 
     # negative_area_triangle_list = list()
@@ -173,7 +183,7 @@ def infer(moving_datas, fixed_datas, models, faces, ico_levels, features, device
     curv_fixed_fs6 = curv_fixed_fs6.T.to(device)
 
     seg_moving_fs6 = seg_moving_fs6.squeeze().to(device)
-    seg_fixed_fs6 = seg_fixed_fs6.squeeze().to(device)
+    seg_fixed_fs6 = seg_fixed_fs6.squeeze().to(device).clone()  # fixed 数据在进程内共享缓存，不能原地修改
 
     xyz_moving_fs6 = xyz_moving_fs6.squeeze().to(device)
     xyz_fixed_fs6 = xyz_fixed_fs6.squeeze().to(device)
@@ -214,7 +224,8 @@ def infer(moving_datas, fixed_datas, models, faces, ico_levels, features, device
             data_x = torch.cat((data_moving, data_fixed), 1).to(device)
             data_x = data_x.detach()
 
-            xyz_moved_lap, euler_angle = model(data_x, xyz_moving, face=faces_sphere)
+            with telemetry.stage(f'gnn_{ico_level}'), inference_autocast(device, precision):
+                xyz_moved_lap, euler_angle = model(data_x, xyz_moving, face=faces_sphere)
 
             xyz_moved = apply_rotate_matrix(euler_angle, xyz_moving, norm=True,
                                             en=model.en, face=faces_sphere)
@@ -234,7 +245,8 @@ def infer(moving_datas, fixed_datas, models, faces, ico_levels, features, device
 
             data_x = torch.cat((moving_data_resample, data_fixed), 1).to(device)
 
-            xyz_moved_lap, euler_angle = model(data_x, xyz_moving, face=faces_sphere)
+            with telemetry.stage(f'gnn_{ico_level}'), inference_autocast(device, precision):
+                xyz_moved_lap, euler_angle = model(data_x, xyz_moving, face=faces_sphere)
 
             if euler_angle.shape[1] == 3:
                 euler_angle_interp_moved_upsample = resample_sphere_surface_barycentric(xyz_fixed, xyz_moved_upsample,
@@ -279,7 +291,7 @@ def rd_sample_data(data_level6):
 
 
 def run_epoch(models, faces, config, dataloader,
-              save_result=False, dir_recon=None, dir_rigid=None, dir_result=None, is_train=False):
+              save_result=False, dir_recon=None, dir_rigid=None, dir_result=None, is_train=False, state=None):
     device = config['device']
     features = config['feature']
     ico_levels = config['ico_levels']
@@ -293,22 +305,26 @@ def run_epoch(models, faces, config, dataloader,
 
         datas_fixed = datas_fixed[0]
 
-        xyz_fixed, xyz_moved, xyz_moved_lap, fixed_data, data_moving, data_moving_lap, euler_angle, \
-            seg_moving, seg_moving_lap, seg_fixed, \
-            = infer(datas_moving, datas_fixed, models, faces, ico_levels, features, device)
+        with telemetry.stage('infer'):
+            xyz_fixed, xyz_moved, xyz_moved_lap, fixed_data, data_moving, data_moving_lap, euler_angle, \
+                seg_moving, seg_moving_lap, seg_fixed, \
+                = infer(datas_moving, datas_fixed, models, faces, ico_levels, features, device,
+                        precision=config.get('precision', 'fp32'))
 
 
         if save_result:
             hemisphere = config["hemisphere"]
-            save_sphere_reg(config, hemisphere, xyz_moved, euler_angle, dir_recon, dir_rigid, dir_result, device)
+            with telemetry.stage('save'):
+                save_sphere_reg(config, hemisphere, xyz_moved, euler_angle, dir_recon, dir_rigid, dir_result, device,
+                                state=state)
 
     return subs_loss
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def hemisphere_predict(models, config, hemisphere,
                        dir_recon, dir_rigid=None, dir_result=None,
-                       seg=False):
+                       seg=False, movings=None, state=None):
     for model in models:
         model.eval()
     # 获取config_train的配置
@@ -321,38 +337,57 @@ def hemisphere_predict(models, config, hemisphere,
     dataset_train = SphericalDataset(dir_fixed, dir_rigid,
                                      hemisphere, feature=feature, norm_type=config["normalize_type"],
                                      ico_levels=['fsaverage6'],
-                                     seg=seg, is_train=False, is_da=False, is_rigid=config['is_rigid'])
+                                     seg=seg, is_train=False, is_da=False, is_rigid=config['is_rigid'],
+                                     movings=movings)
 
     dataloader_train = DataLoader(dataset=dataset_train, batch_size=1, num_workers=0)
 
 
     subs_loss = run_epoch(models, faces, config, dataloader_train,
-                          save_result=True, dir_recon=dir_recon, dir_rigid=dir_rigid, dir_result=dir_result)
+                          save_result=True, dir_recon=dir_recon, dir_rigid=dir_rigid, dir_result=dir_result,
+                          state=state)
 
     return subs_loss
 
 
-def train_val(config):
+def load_models(model_files, device):
+    models = []
+    for model_file in model_files:
+        print(f'<<< model : {model_file}')
+        model = torch.load(model_file, map_location=device)['model']
+        model.to(device)
+        model.eval()
+        models.append(model)
+    return models
+
+
+def train_val(config, models=None, state=None):
+    """
+    models: 已加载的模型列表（如来自 ModelRegistry），为 None 时从 config['model_files'] 加载
+    state: 同一半球在 rigid/norigid 阶段之间传递的内存数据（native sphere/sulc/curv、刚性配准后的 sphere），
+           中间结果不再落盘，只有 config['save_intermediate'] 为 True 时才写出（调试用）
+    return: state
+    """
     # 获取config_train的配置
     device = config['device']  # 使用的硬件
+    if state is None:
+        state = dict()
 
     if config['validation'] is True:
-        # 1. interp file
-        interp_dir_single(config["dir_predict_recon"], config["dir_predict_rigid"], config["dir_fixed"],
-                          'fsaverage6', hemis=config['hemisphere'], is_rigid=config['is_rigid'], device=device)
-
-        models = []
-        for model_file in config['model_files'][:config["ico_index"] + 1]:
-            print(f'<<< model : {model_file}')
-            model = torch.load(model_file, map_location=device)['model']
-            model.to(device)
-            model.eval()
-            models.append(model)
+        # 1. interp
+        with telemetry.stage('interp'):
+            movings = interp_hemisphere(config, config['hemisphere'], state, 'fsaverage6', device)
+
+        if models is None:
+            with telemetry.stage('load_models'):
+                models = load_models(config['model_files'][:config["ico_index"] + 1], device)
+        else:
+            models = models[:config["ico_index"] + 1]
 
         hemisphere_predict(models, config, config['hemisphere'],
                            dir_recon=config['dir_predict_recon'],
                            dir_rigid=config['dir_predict_rigid'],
                            dir_result=config['dir_predict_result'],
-                           seg=False)
+                           seg=False, movings=movings, state=state)
 
-        return
+    return state
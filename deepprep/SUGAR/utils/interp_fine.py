@@ -347,27 +347,32 @@ def interp_morph_barycentric(sphere_orig_file, sphere_target_file, gt_orig_morph
         print(f'copy sphere_target_file to sphere_interp_file: >>> {sphere_interp_file}')
 
 
+def resample_sulc_curv_barycentric(sulc_orig, curv_orig, xyz_orig, xyz_target, device='cuda'):
+    """
+    将 sulc/curv 从 xyz_orig 插值到 xyz_target，返回 float32 numpy 数组（不写文件）
+    """
+    sulc_orig_t = torch.from_numpy(sulc_orig.astype(np.float32)).to(device)
+    curv_orig_t = torch.from_numpy(curv_orig.astype(np.float32)).to(device)
+    xyz_orig_t = torch.from_numpy(xyz_orig.astype(np.float32)).to(device)
+    xyz_target_t = torch.from_numpy(xyz_target.astype(np.float32)).to(device)
+
+    sulc_interp = resample_sphere_surface_barycentric(xyz_orig_t, xyz_target_t, sulc_orig_t.unsqueeze(1), device)
+    curv_interp = resample_sphere_surface_barycentric(xyz_orig_t, xyz_target_t, curv_orig_t.unsqueeze(1), device)
+    return sulc_interp.squeeze().cpu().numpy(), curv_interp.squeeze().cpu().numpy()
+
+
 def interp_sulc_curv_barycentric(sulc_orig_file, curv_orig_file, sphere_orig_file, sphere_target_file,
                                  sulc_interp_file, curv_interp_file, sphere_interp_file=None, device='cuda'):
     # 加载数据
     sulc_orig = nib.freesurfer.read_morph_data(sulc_orig_file).astype(np.float32)
     curv_orig = nib.freesurfer.read_morph_data(curv_orig_file).astype(np.float32)
     xyz_orig, faces_orig = nib.freesurfer.read_geometry(sphere_orig_file)
-    xyz_orig = xyz_orig.astype(np.float32)
-
     xyz_target, faces_target = nib.freesurfer.read_geometry(sphere_target_file)
-    xyz_target = xyz_target.astype(np.float32)
 
-    sulc_orig_t = torch.from_numpy(sulc_orig).to(device)
-    curv_orig_t = torch.from_numpy(curv_orig).to(device)
-    xyz_orig_t = torch.from_numpy(xyz_orig).to(device)
-    xyz_target_t = torch.from_numpy(xyz_target).to(device)
-
-    sulc_interp = resample_sphere_surface_barycentric(xyz_orig_t, xyz_target_t, sulc_orig_t.unsqueeze(1), device)
-    curv_interp = resample_sphere_surface_barycentric(xyz_orig_t, xyz_target_t, curv_orig_t.unsqueeze(1), device)
+    sulc_interp, curv_interp = resample_sulc_curv_barycentric(sulc_orig, curv_orig, xyz_orig, xyz_target, device)
 
-    nib.freesurfer.write_morph_data(sulc_interp_file, sulc_interp.squeeze().cpu().numpy())
-    nib.freesurfer.write_morph_data(curv_interp_file, curv_interp.squeeze().cpu().numpy())
+    nib.freesurfer.write_morph_data(sulc_interp_file, sulc_interp)
+    nib.freesurfer.write_morph_data(curv_interp_file, curv_interp)
 
     if sphere_interp_file is not None and not os.path.exists(sphere_interp_file):
         shutil.copyfile(sphere_target_file, sphere_interp_file)
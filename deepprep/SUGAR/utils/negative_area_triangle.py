@@ -3,9 +3,9 @@ from pathlib import Path
 import nibabel as nib
 import numpy as np
 import torch
-from torch_scatter import scatter_mean
 import time
 from functools import wraps
+from .smooth import get_smoother
 """
 负面积三角形相关代码
 
@@ -72,27 +72,13 @@ def remove_negative_area(faces, xyz, device='cuda'):
     remove_times = 0
     dt_weight_init = 1  # 初始值
 
-    x = np.expand_dims(faces.cpu()[:, 0], 1)
-    y = np.expand_dims(faces.cpu()[:, 1], 1)
-    z = np.expand_dims(faces.cpu()[:, 2], 1)
-
-    a = np.concatenate([x, y], axis=1)
-    b = np.concatenate([y, x], axis=1)
-    c = np.concatenate([x, z], axis=1)
-    d = np.concatenate([z, x], axis=1)
-    e = np.concatenate([y, z], axis=1)
-    f = np.concatenate([z, y], axis=1)
-
-    edge_index = np.concatenate([a, b, c, d, e, f])
-    edge_index = torch.from_numpy(edge_index).to(device)
-    edge_index = edge_index.t().contiguous()
-
-    row, col = edge_index
+    # 拓扑不变，Laplacian 算子按 faces 缓存，每次迭代只做一次稀疏矩阵乘
+    smoother = get_smoother(faces, len(xyz), backend='torch', device=device)
 
     while count > 0:
         dt_weight = dt_weight_init - count % 10 * 0.01  # 按比例减小
 
-        xyz_dt = scatter_mean(xyz[col], row, dim=0) - xyz
+        xyz_dt = smoother.laplacian(xyz)
         neg_faces = faces[index]
         index = neg_faces.flatten()
         xyz[index] = xyz[index] + xyz_dt[index] * dt_weight
@@ -110,8 +96,11 @@ def remove_negative_area(faces, xyz, device='cuda'):
     return xyz, count, remove_times
 
 
-def single_remove_negative_area(sphere, sphere_removed, device='cuda'):
-    xyz_sphere, faces_sphere = nib.freesurfer.read_geometry(str(sphere))
+def single_remove_negative_area_data(xyz_sphere, faces_sphere, device='cuda'):
+    """
+    与 single_remove_negative_area 相同，但输入输出为内存中的 numpy 数组
+    return: xyz_sphere_removed (没有负面积三角形时为 None)
+    """
     xyz_sphere = torch.from_numpy(xyz_sphere.astype(np.float32)).to(device)
     faces_sphere = torch.from_numpy(faces_sphere.astype(int)).to(device)
     area = negative_area(faces_sphere, xyz_sphere)
@@ -122,11 +111,19 @@ def single_remove_negative_area(sphere, sphere_removed, device='cuda'):
     if count_orig > 0:
         xyz_sphere_removed, count_final, times = remove_negative_area(faces_sphere, xyz_sphere, device)
         # print(f'negative area: {count_orig}   {count_final}  {times}')
+        return xyz_sphere_removed.cpu().numpy()
+    else:
+        print(f'negative area: {count_orig}   {count_final}  {times}')
+        return None
+
+
+def single_remove_negative_area(sphere, sphere_removed, device='cuda'):
+    xyz_sphere, faces_sphere = nib.freesurfer.read_geometry(str(sphere))
+    xyz_sphere_removed = single_remove_negative_area_data(xyz_sphere, faces_sphere, device)
+    if xyz_sphere_removed is not None:
         if sphere_removed == sphere:
             os.system(f'mv {sphere} {sphere}.bak')
-        nib.freesurfer.write_geometry(sphere_removed, xyz_sphere_removed.cpu().numpy(), faces_sphere.cpu().numpy())
+        nib.freesurfer.write_geometry(sphere_removed, xyz_sphere_removed, faces_sphere)
         if os.path.exists(f'{sphere}.bak'):
             os.system(f'rm {sphere}.bak')
         # print(f'remove negative area triangle: >>> {sphere_removed}')
-    else:
-        print(f'negative area: {count_orig}   {count_final}  {times}')
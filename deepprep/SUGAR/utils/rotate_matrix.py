@@ -62,17 +62,16 @@ def apply_norigid_rotate_matrix(sphere_moving_f, rotate_metrix_file, sphere_move
 
 
 def get_en_torch(xyz):
-    device = xyz.device
-    xyz = xyz.cpu().numpy()
-    base_vector = np.array([0, 0, 1])
-    en1 = np.cross(base_vector, xyz)
-    idx = np.logical_and(xyz[:, 0] == 0, xyz[:, 1] == 0)
-    en1[idx] = np.array([1, 0, 0])
-    en2 = np.cross(en1, xyz)
-    en1 = en1 / np.linalg.norm(en1, axis=1, keepdims=True)
-    en2 = en2 / np.linalg.norm(en2, axis=1, keepdims=True)
-    en = np.concatenate([en1[:, np.newaxis, :], en2[:, np.newaxis, :]], axis=1)
-    en = torch.from_numpy(en).float().to(device)
+    # 全部在 xyz 所在设备上计算，不经过 CPU/numpy
+    xyz = xyz.float()
+    base_vector = torch.tensor([0., 0., 1.], device=xyz.device).expand_as(xyz)
+    en1 = torch.linalg.cross(base_vector, xyz, dim=1)
+    idx = torch.logical_and(xyz[:, 0] == 0, xyz[:, 1] == 0)
+    en1[idx] = torch.tensor([1., 0., 0.], device=xyz.device)
+    en2 = torch.linalg.cross(en1, xyz, dim=1)
+    en1 = en1 / torch.norm(en1, dim=1, keepdim=True)
+    en2 = en2 / torch.norm(en2, dim=1, keepdim=True)
+    en = torch.cat([en1.unsqueeze(1), en2.unsqueeze(1)], dim=1)
     return en
 
 
@@ -1,7 +1,12 @@
+import hashlib
+import threading
 import numpy as np
 import torch
 import nibabel as nib
-from torch_scatter import scatter_mean
+
+# 按网格拓扑缓存的平滑算子: (faces hash, n_vertex, backend, device) -> SurfaceSmoother
+smoother_cache = dict()
+smoother_cache_lock = threading.Lock()
 
 
 def get_edge_index(faces, device='cuda'):
@@ -24,17 +29,101 @@ def get_edge_index(faces, device='cuda'):
     return edge_index
 
 
+def get_adjacency_coo(faces, n_vertex):
+    """
+    return: row, col, value 的行归一化邻接矩阵 P = D^-1 A（每条边只计一次）
+    P @ x 等价于 scatter_mean(x[col], row, dim=0)
+    """
+    edge_index = get_edge_index(faces, device='cpu').numpy()
+    row, col = edge_index
+    degree = np.bincount(row, minlength=n_vertex).astype(np.float32)
+    degree[degree == 0] = 1
+    value = 1. / degree[row]
+    return row, col, value
+
+
+class SurfaceSmoother:
+    """
+    Laplacian smoothing 算子：每个网格只构建一次 CSR 归一化邻接矩阵，
+    k 次平滑即 k 次稀疏矩阵乘，所有通道 (N, C) 一次完成
+
+    backend: 'torch' (torch.sparse_csr, 支持 cuda) 或 'scipy' (scipy.sparse.csr_matrix, numpy 输入输出)
+    """
+
+    def __init__(self, faces, n_vertex=None, backend='torch', device='cpu'):
+        if isinstance(faces, torch.Tensor):
+            faces = faces.cpu().numpy()
+        faces = np.asarray(faces).astype(np.int64)
+        if n_vertex is None:
+            n_vertex = int(faces.max()) + 1
+        self.n_vertex = n_vertex
+        self.backend = backend
+        self.device = device
+
+        row, col, value = get_adjacency_coo(faces, n_vertex)
+        if backend == 'torch':
+            operator = torch.sparse_coo_tensor(torch.from_numpy(np.stack([row, col])), torch.from_numpy(value),
+                                               (n_vertex, n_vertex)).coalesce()
+            self.operator = operator.to_sparse_csr().to(device)
+        elif backend == 'scipy':
+            from scipy.sparse import csr_matrix
+            self.operator = csr_matrix((value, (row, col)), shape=(n_vertex, n_vertex))
+        else:
+            raise NotImplementedError(f'backend: {backend}')
+
+    def mean_neighbors(self, data):
+        """
+        data: (N,) or (N, C) -> 每个顶点邻居的均值
+        """
+        squeeze = data.ndim == 1
+        if squeeze:
+            data = data[:, None]
+        if self.backend == 'torch':
+            operator = self.operator
+            if operator.dtype != data.dtype:
+                operator = operator.to(data.dtype)
+            result = operator @ data
+        else:
+            result = self.operator @ data
+        return result[:, 0] if squeeze else result
+
+    def __call__(self, data, times=1):
+        for _ in range(times):
+            data = self.mean_neighbors(data)
+        return data
+
+    def laplacian(self, data):
+        """
+        umbrella Laplacian: 邻居均值 - 自身
+        """
+        return self.mean_neighbors(data) - data
+
+
+def get_smoother(faces, n_vertex=None, backend='torch', device='cpu'):
+    """
+    按拓扑（faces 的 hash）缓存的 SurfaceSmoother，同一网格在进程内只构建一次
+    """
+    if isinstance(faces, torch.Tensor):
+        faces = faces.cpu().numpy()
+    faces = np.ascontiguousarray(faces, dtype=np.int64)
+    if n_vertex is None:
+        n_vertex = int(faces.max()) + 1
+    key = (hashlib.sha1(faces.tobytes()).hexdigest(), n_vertex, backend, str(device))
+    with smoother_cache_lock:
+        if key not in smoother_cache:
+            smoother_cache[key] = SurfaceSmoother(faces, n_vertex, backend=backend, device=device)
+        return smoother_cache[key]
+
+
 def smooth(surf_file, morph_file, smooth_file, times=1, device='cuda'):
     xyz_surf, faces_surf = nib.freesurfer.read_geometry(surf_file)
-    edge_index = get_edge_index(faces_surf).to(device)
-    row, col = edge_index
+    smoother = get_smoother(faces_surf, len(xyz_surf), backend='torch', device=device)
 
     morph_data = nib.freesurfer.read_morph_data(morph_file).astype(np.float32)
     morph_data = np.expand_dims(morph_data, 1)
     morph_data = torch.from_numpy(morph_data.astype(np.float32)).to(device)
 
-    for _ in range(times):
-        morph_data = scatter_mean(morph_data[col], row, dim=0, dim_size=morph_data.size(0))
+    morph_data = smoother(morph_data, times=times)
     nib.freesurfer.write_morph_data(smooth_file, morph_data.cpu())
     print(f'smooth >>> {smooth_file}')
 
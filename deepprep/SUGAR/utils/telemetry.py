@@ -0,0 +1,137 @@
+"""
+SUGAR 各阶段的耗时与内存记录
+
+每个阶段记录 wall time、CPU time、峰值 RSS 以及（cuda 时）显存峰值，
+按 subject / hemi 标注，最后写成 JSON 报告用于容量规划。
+
+注意: CPU time、峰值 RSS 与显存峰值都是进程级的；两个半球并发运行时它们互相包含对方的开销。
+显存峰值只在没有其他顶层阶段运行时重置，并发时记录的是这些阶段共同的峰值。
+"""
+import os
+import json
+import time
+import socket
+import resource
+import threading
+from contextlib import contextmanager
+
+import torch
+
+
+def get_peak_rss_mb():
+    # Linux 下 ru_maxrss 单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Telemetry:
+    def __init__(self):
+        self.records = list()
+        self.meta = dict()
+        self.device = 'cpu'
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # 各线程中正在运行的顶层阶段数
+        self._active = 0
+        self._t0 = time.perf_counter()
+
+    def _labels(self):
+        if not hasattr(self._local, 'labels'):
+            self._local.labels = dict()
+        return self._local.labels
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = list()
+        return self._local.stack
+
+    def _is_cuda(self):
+        return torch.device(self.device).type == 'cuda' and torch.cuda.is_available()
+
+    @contextmanager
+    def context(self, **labels):
+        """
+        为当前线程中的阶段加上标签，如 subject=..., hemi=...
+        """
+        current = self._labels()
+        previous = dict(current)
+        current.update(labels)
+        try:
+            yield
+        finally:
+            current.clear()
+            current.update(previous)
+
+    @contextmanager
+    def stage(self, name):
+        stack = self._stack()
+        is_cuda = self._is_cuda()
+        is_top = len(stack) == 0
+        if is_top:
+            with self._lock:
+                # 重置会清掉其他线程正在记录的峰值，只在没有并发阶段时重置
+                if is_cuda and self._active == 0:
+                    torch.cuda.reset_peak_memory_stats()
+                self._active += 1
+        stack.append(name)
+        record = dict(self._labels())
+        record['stage'] = '/'.join(stack)
+        record['start_s'] = time.perf_counter() - self._t0
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            if is_cuda:
+                torch.cuda.synchronize()
+            record['wall_time_s'] = time.perf_counter() - wall
+            record['cpu_time_s'] = time.process_time() - cpu
+            record['peak_rss_mb'] = get_peak_rss_mb()
+            record['device_peak_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2 if is_cuda else None
+            stack.pop()
+            with self._lock:
+                self.records.append(record)
+                if is_top:
+                    self._active -= 1
+
+    def extend(self, records):
+        with self._lock:
+            self.records.extend(records)
+
+    def summary(self, **labels):
+        """
+        按 (subject, hemi, stage) 汇总 wall time，可按标签过滤
+        """
+        summary = dict()
+        for record in self.records:
+            if any(record.get(k) != v for k, v in labels.items()):
+                continue
+            key = (record.get('subject'), record.get('hemi'), record['stage'])
+            summary[key] = summary.get(key, 0) + record['wall_time_s']
+        return summary
+
+    def print_summary(self, **labels):
+        for (subject, hemi, stage), seconds in self.summary(**labels).items():
+            prefix = ' '.join(str(i) for i in (subject, hemi) if i is not None)
+            print(f'[SUGAR timing] {prefix} {stage}: {seconds:.2f}s')
+
+    def write_json(self, json_file, **labels):
+        records = [record for record in self.records
+                   if all(record.get(k) == v for k, v in labels.items())]
+        meta = {
+            'hostname': socket.gethostname(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'torch_version': torch.__version__,
+            'device': str(self.device),
+        }
+        if self._is_cuda():
+            meta['device_name'] = torch.cuda.get_device_name()
+        meta.update(self.meta)
+        os.makedirs(os.path.dirname(os.path.abspath(json_file)), exist_ok=True)
+        with open(json_file, 'w') as f:
+            json.dump({'meta': meta, 'records': records}, f, indent=2)
+        print(f'telemetry >>> {json_file}')
+
+
+# 进程内默认实例
+telemetry = Telemetry()
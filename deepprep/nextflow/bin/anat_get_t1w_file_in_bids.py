@@ -1,7 +1,7 @@
 #! /usr/bin/env python3
 import os
 import argparse
-import bids
+from bids_index import get_layout
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -16,7 +16,7 @@ if __name__ == '__main__':
         subject_ids = [subject_id.split('-')[1] for subject_id in args.subject_ids]
     else:
         subject_ids = args.subject_ids
-    layout = bids.BIDSLayout(args.bids_dir, derivatives=False)
+    layout = get_layout(args.bids_dir, derivatives=False)
     subject_dict = {}
     t1w_filess = []
     for t1w_file in layout.get(return_type='filename', subject=subject_ids, suffix="T1w", extension='.nii.gz'):
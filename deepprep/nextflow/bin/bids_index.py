@@ -0,0 +1,214 @@
+#! /usr/bin/env python3
+"""
+Shared pybids index of the input BIDS dataset.
+
+Building a BIDSLayout walks and parses the whole dataset, and every BOLD / QC
+task used to do it again (often twice) just to resolve a few paths.
+Here the layout of the input dataset is indexed once into a pybids SQLite
+database (BIDSLayout(database_path=...)) under $DEEPPREP_BIDS_INDEX, and the
+tasks load it read-only.
+
+The input dataset does not change during a run, so an index is a generation:
+deepprep_init builds it at pipeline start and writes its name into the marker
+current.json of the layout (dataset root and BIDSLayout arguments). The tasks
+load the generation of the marker without walking the dataset. deepprep_init
+compares a fingerprint of the directory mtimes with the one of the marker and
+builds a new generation only when the dataset has changed since (or always with
+--rebuild). Without a marker, the first get_layout builds the generation.
+
+The derivatives (bold_preprocess_dir) are still written while the tasks run and
+are not indexed: find_files lists the files of one subject and matches their
+entities as BIDSLayout.get does.
+
+Without $DEEPPREP_BIDS_INDEX (or --index_dir) get_layout builds a plain BIDSLayout as before.
+
+deepprep_init.py builds the index of --bids_dir at pipeline start:
+    bids_index.py --bids_dir <bids_dir> --index_dir <output_dir>/WorkDir/bids_index
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+from contextlib import contextmanager
+
+# BIDSLayout 参数的默认值，用于生成与写法无关的 index key
+LAYOUT_DEFAULTS = {'validate': True, 'derivatives': False}
+MARKER_NAME = 'current.json'
+# 保留的旧 index：其他 task 可能仍在读取
+KEEP_OLD_INDEXES = 2
+MIN_OLD_INDEX_AGE_S = 600
+# bold_preprocess_dir 中的文件名含有 space / desc 等 derivatives 的 entity
+DERIVATIVES_CONFIG = ['bids', 'derivatives']
+
+
+def get_index_dir(index_dir=None):
+    if index_dir is None:
+        index_dir = os.environ.get('DEEPPREP_BIDS_INDEX')
+    return None if index_dir in [None, ''] else Path(index_dir)
+
+
+def get_layout_key(root, layout_kwargs):
+    kwargs = dict(LAYOUT_DEFAULTS)
+    kwargs.update(layout_kwargs)
+    key = json.dumps([os.path.realpath(root), kwargs], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def get_fingerprint(root):
+    """
+    sha1 of (relative path, mtime) of every directory under root
+    """
+    sha1 = hashlib.sha1()
+    for dir_path, dir_names, _ in os.walk(root):
+        dir_names.sort()
+        sha1.update(f'{os.path.relpath(dir_path, root)}:{os.stat(dir_path).st_mtime_ns}\n'.encode())
+    return sha1.hexdigest()
+
+
+def read_marker(layout_dir: Path):
+    """
+    {'database': <name of the current generation>, 'fingerprint': ...}, None when there is no built generation
+    """
+    try:
+        with open(layout_dir / MARKER_NAME) as f:
+            marker = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return marker if (layout_dir / marker['database']).exists() else None
+
+
+def write_marker(layout_dir: Path, marker):
+    # replace 是原子的，task 读到的总是完整的 marker
+    tmp_file = layout_dir / f'{MARKER_NAME}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(marker, f)
+    tmp_file.replace(layout_dir / MARKER_NAME)
+
+
+@contextmanager
+def build_lock(layout_dir: Path):
+    with open(layout_dir / 'build.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def remove_old_indexes(layout_dir: Path, current):
+    indexes = sorted([i for i in layout_dir.iterdir() if i.is_dir() and i.name != current and '.tmp' not in i.name],
+                     key=lambda i: i.stat().st_mtime, reverse=True)
+    for index in indexes[KEEP_OLD_INDEXES:]:
+        if time.time() - index.stat().st_mtime > MIN_OLD_INDEX_AGE_S:
+            shutil.rmtree(index, ignore_errors=True)
+
+
+def build_index(root, database_path: Path, **layout_kwargs):
+    from bids import BIDSLayout
+
+    tmp_path = database_path.parent / f'{database_path.name}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    BIDSLayout(root, database_path=str(tmp_path), reset_database=True, **layout_kwargs)
+    # rename 后其他 task 才能看到，不会读到写了一半的数据库
+    tmp_path.rename(database_path)
+
+
+def update_index(root, index_dir, check=True, rebuild=False, **layout_kwargs):
+    """
+    Database of the current generation of the index of root, built when there is none.
+    check: also build a new generation when the directory mtimes under root have changed since the current one;
+    rebuild: always build a new generation.
+    """
+    layout_dir = index_dir / get_layout_key(root, layout_kwargs)
+    layout_dir.mkdir(parents=True, exist_ok=True)
+    with build_lock(layout_dir):
+        marker = read_marker(layout_dir)
+        fingerprint = get_fingerprint(root) if check or rebuild else None
+        if marker is None or rebuild or (check and marker.get('fingerprint') != fingerprint):
+            database = f'generation-{time.time_ns()}'
+            print(f'build BIDS index: {root} >>> {layout_dir / database}')
+            build_index(root, layout_dir / database, **layout_kwargs)
+            marker = {'database': database, 'fingerprint': fingerprint}
+            write_marker(layout_dir, marker)
+            remove_old_indexes(layout_dir, database)
+    return layout_dir / marker['database']
+
+
+def get_layout(root, index_dir=None, **layout_kwargs):
+    """
+    BIDSLayout(root, **layout_kwargs), loaded from the current generation of the shared index when one is configured.
+    """
+    from bids import BIDSLayout
+
+    index_dir = get_index_dir(index_dir)
+    if index_dir is None:
+        return BIDSLayout(root, **layout_kwargs)
+
+    marker = read_marker(index_dir / get_layout_key(root, layout_kwargs))
+    if marker is None:
+        # 没有经过 deepprep_init（例如单独运行脚本）
+        database_path = update_index(root, index_dir, check=False, **layout_kwargs)
+    else:
+        database_path = index_dir / get_layout_key(root, layout_kwargs) / marker['database']
+    return BIDSLayout(root, database_path=str(database_path), **layout_kwargs)
+
+
+def get_file_entities(root, file_path, config='bids'):
+    """
+    BIDS entities of file_path in the dataset root, as BIDSLayout(root).parse_file_entities, without a layout
+    """
+    from bids.layout import parse_file_entities
+    return parse_file_entities(os.sep + os.path.relpath(file_path, root), config=config)
+
+
+def match_entity(value, expected):
+    if expected is None:
+        return value is None
+    if value is None:
+        return False
+    if isinstance(value, int):
+        # run / echo 等按整数比较：run-01 == 1
+        return value == int(expected)
+    return str(value) == str(expected)
+
+
+def find_files(root, **entities):
+    """
+    Sorted paths of the files under root matching entities, as BIDSLayout(root, validate=False).get(**entities):
+    the entities not given match anything. Only the directory of the subject is listed.
+    """
+    root = Path(root)
+    if entities.get('extension') is not None:
+        entities['extension'] = '.' + str(entities['extension']).lstrip('.')
+    search_dir = root / f'sub-{entities["subject"]}' if entities.get('subject') is not None else root
+    files = list()
+    for dir_path, dir_names, file_names in os.walk(search_dir):
+        dir_names[:] = [i for i in dir_names if not i.startswith('.')]
+        for file_name in file_names:
+            if file_name.startswith('.'):
+                continue
+            file_path = Path(dir_path) / file_name
+            found = get_file_entities(root, file_path, DERIVATIVES_CONFIG)
+            if all(match_entity(found.get(k), v) for k, v in entities.items()):
+                files.append(file_path)
+    return sorted(files)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="DeepPrep: build the shared index of the input BIDS dataset"
+    )
+    parser.add_argument("--bids_dir", required=True, help="input directory of BIDS type")
+    parser.add_argument("--index_dir", required=True, help="directory of the index, export it as $DEEPPREP_BIDS_INDEX")
+    parser.add_argument("--rebuild", default=False, action='store_true',
+                        help="build a new generation even if the dataset is unchanged")
+    args = parser.parse_args()
+
+    # 各脚本中使用的 BIDSLayout 参数
+    for layout_kwargs in [{}, {'validate': False}, {'derivatives': True}]:
+        database_path = update_index(args.bids_dir, Path(args.index_dir), rebuild=args.rebuild, **layout_kwargs)
+        print(f'BIDS index: {args.bids_dir} {layout_kwargs} >>> {database_path}')
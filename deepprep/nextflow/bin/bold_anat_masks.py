@@ -0,0 +1,241 @@
+#! /usr/bin/env python3
+"""
+In-process projection of the FreeSurfer segmentation and brainmask onto a BOLD grid.
+
+Replaces the FreeSurfer chain of bold_mkbrainmask.py / bold_mc2fs6.py (mri_convert -rl, mri_label2vol,
+mri_vol2vol, mri_binarize), about six subprocesses per BOLD run:
+  - T1w space (anat2bold_t1w): anat and BOLD share the scanner space, voxels are mapped through the two
+    vox2ras; labels by nearest neighbour, brainmask trilinear (mri_convert -rl).
+  - native space (anat2bold_by_bbregister): voxels are mapped through the tkregister matrix of
+    register.dat; every BOLD voxel takes the label of the majority of the anat voxels falling into it
+    (mri_label2vol --seg), brainmask trilinear (mri_vol2vol --inv).
+  - masks as mri_binarize: --wm --erode 1 (3x3x3), --min 24 --max 24, --ventricles, brainmask >= 0.0001.
+
+The runs of a subject mostly share the BOLD grid and the registration, so the masks are cached under
+$DEEPPREP_MASK_CACHE by (aseg sha256, brainmask sha256, BOLD grid, registration sha256) and another run
+only copies them. Without $DEEPPREP_MASK_CACHE (or cache_dir) they are computed every time.
+
+    bold_anat_masks.py --aseg aparc+aseg.mgz --brainmask brainmask.mgz --ref <mc.nii.gz> --reg <register.dat> \
+        --out_dir <dir>
+"""
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from deepprep_manifest import hash_file_stamped
+
+MASK_CACHE_VERSION = 1
+# mri_binarize --wm / --ventricles
+WM_LABELS = [2, 41, 77, 251, 252, 253, 254, 255]
+VENTRICLE_LABELS = [4, 5, 14, 43, 44, 72, 31, 63]
+CSF_LABELS = [24]
+WM_ERODE = 1
+BRAINMASK_MIN = 0.0001
+MASK_NAMES = ['dseg', 'wm', 'csf', 'vent', 'mask', 'binmask']
+# anat 的 slice 分块，限制投票时坐标数组的内存
+VOTE_CHUNK_SLICES = 32
+
+
+def get_cache_dir(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.environ.get('DEEPPREP_MASK_CACHE')
+    return None if cache_dir in [None, ''] else Path(cache_dir)
+
+
+def read_register_dat(reg_file):
+    """
+    4x4 tkregister matrix of register.dat, maps the anat (target) tkRAS to the BOLD (movable) tkRAS
+    """
+    with open(reg_file) as f:
+        lines = [i.strip() for i in f.readlines() if i.strip()]
+    return np.array([[float(j) for j in i.split()] for i in lines[4:8]])
+
+
+def vox2ras_tkr(shape, zooms):
+    """
+    tkregister vox2ras of a volume (FreeSurfer MRIxfmCRS2XYZtkreg, as nibabel MGHHeader.get_vox2ras_tkr)
+    """
+    (nx, ny, nz), (dx, dy, dz) = shape[:3], zooms[:3]
+    return np.array([[-dx, 0, 0, dx * nx / 2],
+                     [0, 0, dz, -dz * nz / 2],
+                     [0, -dy, 0, dy * ny / 2],
+                     [0, 0, 0, 1]])
+
+
+def get_grid(img):
+    return tuple(int(i) for i in img.shape[:3]), img.affine
+
+
+def get_ref2anat(anat_img, ref_img, reg_file=None):
+    """
+    vox2vox from the BOLD (ref) voxels to the anat voxels
+    """
+    if reg_file is None:
+        return np.linalg.inv(anat_img.affine) @ ref_img.affine
+    reg = read_register_dat(reg_file)
+    anat_tkr = vox2ras_tkr(anat_img.shape, anat_img.header.get_zooms())
+    ref_tkr = vox2ras_tkr(ref_img.shape, ref_img.header.get_zooms())
+    return np.linalg.inv(anat_tkr) @ np.linalg.inv(reg) @ ref_tkr
+
+
+def grid_coords(shape, vox2vox):
+    ijk = np.indices(shape, dtype=np.float64).reshape(3, -1)
+    return vox2vox[:3, :3] @ ijk + vox2vox[:3, 3:]
+
+
+def nearest_labels(seg, shape, ref2anat):
+    """
+    label of the anat voxel nearest to the center of every BOLD voxel, 0 outside the anat volume
+    """
+    ijk = np.rint(grid_coords(shape, ref2anat)).astype(np.int64)
+    inside = np.all((ijk >= 0) & (ijk < np.array(seg.shape)[:, None]), axis=0)
+    labels = np.zeros(ijk.shape[1], dtype=seg.dtype)
+    labels[inside] = seg[tuple(ijk[:, inside])]
+    return labels.reshape(shape)
+
+
+def vote_labels(seg, shape, ref2anat):
+    """
+    every BOLD voxel takes the label of the majority of the anat voxels whose center falls into it
+    (ties: the smaller label), 0 if none does
+    """
+    anat2ref = np.linalg.inv(ref2anat)
+    values, ranks = np.unique(seg, return_inverse=True)
+    ranks = ranks.reshape(seg.shape).astype(np.int64)
+    n_labels = len(values)
+    keys = list()
+    for start in range(0, seg.shape[2], VOTE_CHUNK_SLICES):
+        stop = min(start + VOTE_CHUNK_SLICES, seg.shape[2])
+        ijk = np.indices(seg.shape[:2] + (stop - start,), dtype=np.float64).reshape(3, -1)
+        ijk[2] += start
+        ref_ijk = np.rint(anat2ref[:3, :3] @ ijk + anat2ref[:3, 3:]).astype(np.int64)
+        inside = np.all((ref_ijk >= 0) & (ref_ijk < np.array(shape)[:, None]), axis=0)
+        ref_index = np.ravel_multi_index(tuple(ref_ijk[:, inside]), shape)
+        keys.append(ref_index * n_labels + ranks[..., start:stop].reshape(-1)[inside])
+    keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    ref_index, label_rank = keys // n_labels, keys % n_labels
+    # 每个 BOLD voxel 内按票数降序、label 升序排列，取第一个
+    order = np.lexsort((label_rank, -counts, ref_index))
+    first = order[np.r_[True, ref_index[order][1:] != ref_index[order][:-1]]]
+    labels = np.zeros(int(np.prod(shape)), dtype=seg.dtype)
+    labels[ref_index[first]] = values[label_rank[first]]
+    return labels.reshape(shape)
+
+
+def linear_resample(volume, shape, ref2anat):
+    coords = grid_coords(shape, ref2anat)
+    return ndimage.map_coordinates(volume, coords, order=1, mode='constant', cval=0).reshape(shape)
+
+
+def binarize_masks(dseg, brain):
+    wm = np.isin(dseg, WM_LABELS)
+    if WM_ERODE > 0:
+        # mri_binarize --erode: 3x3x3 最小值滤波，边界外不参与
+        wm = ndimage.binary_erosion(wm, structure=np.ones((3, 3, 3), dtype=bool), iterations=WM_ERODE,
+                                    border_value=1)
+    return {
+        'dseg': dseg.astype(np.int32),
+        'wm': wm.astype(np.uint8),
+        'csf': np.isin(dseg, CSF_LABELS).astype(np.uint8),
+        'vent': np.isin(dseg, VENTRICLE_LABELS).astype(np.uint8),
+        'mask': brain.astype(np.float32),
+        'binmask': (brain >= BRAINMASK_MIN).astype(np.uint8),
+    }
+
+
+def project_anat(aseg_file, brainmask_file, ref_file, reg_file=None):
+    """
+    {name: 3D array} of MASK_NAMES on the grid of ref_file, and the affine of that grid
+    """
+    aseg_img = nib.load(os.fspath(aseg_file))
+    brain_img = nib.load(os.fspath(brainmask_file))
+    ref_img = nib.load(os.fspath(ref_file))
+    shape, affine = get_grid(ref_img)
+
+    seg = np.asanyarray(aseg_img.dataobj)
+    ref2anat = get_ref2anat(aseg_img, ref_img, reg_file)
+    if reg_file is None:
+        dseg = nearest_labels(seg, shape, ref2anat)
+    else:
+        dseg = vote_labels(seg, shape, ref2anat)
+    brain = linear_resample(np.asanyarray(brain_img.dataobj).astype(np.float32), shape,
+                            get_ref2anat(brain_img, ref_img, reg_file))
+    return binarize_masks(dseg, brain), affine
+
+
+def save_volume(data, affine, out_file):
+    img = nib.Nifti1Image(data, affine)
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    nib.save(img, os.fspath(out_file))
+
+
+def get_cache_key(aseg_file, brainmask_file, ref_file, reg_file, cache_dir: Path):
+    shape, affine = get_grid(nib.load(os.fspath(ref_file)))
+    stamp_dir = cache_dir / 'stamps'
+    content = {
+        'version': MASK_CACHE_VERSION,
+        'aseg': hash_file_stamped(aseg_file, stamp_dir),
+        'brainmask': hash_file_stamped(brainmask_file, stamp_dir),
+        'grid': [shape, np.round(affine, 6).tolist()],
+        'reg': None if reg_file is None else hash_file_stamped(reg_file, stamp_dir),
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def write_anat_masks(aseg_file, brainmask_file, ref_file, out_files: dict, reg_file=None, cache_dir=None):
+    """
+    Write the masks of MASK_NAMES to out_files {name: path}, from the cache when it has them
+    """
+    cache_dir = get_cache_dir(cache_dir)
+    cached_dir = None
+    if cache_dir is not None:
+        cached_dir = cache_dir / get_cache_key(aseg_file, brainmask_file, ref_file, reg_file, cache_dir)
+        if cached_dir.exists():
+            for name, out_file in out_files.items():
+                shutil.copyfile(cached_dir / f'{name}.nii.gz', out_file)
+            print(f'INFO: BOLD masks from cache: {cached_dir}')
+            return
+
+    masks, affine = project_anat(aseg_file, brainmask_file, ref_file, reg_file)
+    for name, out_file in out_files.items():
+        save_volume(masks[name], affine, out_file)
+
+    if cached_dir is not None:
+        # rename 后其他 task 才能看到，不会读到写了一半的 cache
+        tmp_dir = cached_dir.parent / f'{cached_dir.name}.{os.getpid()}.tmp'
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        for name in MASK_NAMES:
+            save_volume(masks[name], affine, tmp_dir / f'{name}.nii.gz')
+        try:
+            tmp_dir.rename(cached_dir)
+        except OSError:
+            # 另一个 task 已经写入了同样的 cache
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="DeepPrep: project the FreeSurfer segmentation and brainmask onto a BOLD grid"
+    )
+    parser.add_argument("--aseg", required=True, help="aseg.mgz / aparc+aseg.mgz")
+    parser.add_argument("--brainmask", required=True, help="brainmask.mgz")
+    parser.add_argument("--ref", required=True, help="BOLD (or boldref) whose grid the masks are written on")
+    parser.add_argument("--reg", help="register.dat from the BOLD to the anat, default: same scanner space")
+    parser.add_argument("--out_dir", required=True)
+    parser.add_argument("--cache_dir", help="default is $DEEPPREP_MASK_CACHE")
+    args = parser.parse_args()
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_files = {name: out_dir / f'{name}.nii.gz' for name in MASK_NAMES}
+    write_anat_masks(args.aseg, args.brainmask, args.ref, out_files, args.reg, args.cache_dir)
+    for out_file in out_files.values():
+        print(f'>>> {out_file}')
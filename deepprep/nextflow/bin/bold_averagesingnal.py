@@ -1,5 +1,4 @@
 #! /usr/bin/env python3
-from nipype.algorithms.confounds import ComputeDVARS, FramewiseDisplacement
 from pathlib import Path
 from confounds import FMRISummary
 import os
@@ -10,42 +9,12 @@ import pandas as pd
 import argparse
 import shutil
 from bold_mkbrainmask import anat2bold_t1w
+from confound_signals import ROIMeans, StdDVARS, load_mask, stream_bold, framewise_displacement
 
 
-def reshape_bold(bold_file):
-    bold = nib.load(bold_file).get_fdata()
-    n_frame = bold.shape[3]
-    n_vertex = bold.shape[0] * bold.shape[1] * bold.shape[2]
-    bold_surf = bold.reshape((n_vertex, n_frame), order='F')
-    return bold_surf
-
-
-def reshape_annot(annot_file):
-    annot = nib.load(annot_file).get_fdata()
-
-    n_vertex = annot.shape[0] * annot.shape[1] * annot.shape[2]
-    annot_surf = annot.reshape(n_vertex, order='F')
-    return annot_surf
-
-
-class ComputeDVARSNode:
-    def __call__(self, bold_file, bold_mask, base_dir):
-        ComputeDVARS_node = Node(ComputeDVARS(), name='ComputeDVARS_node')
-        ComputeDVARS_node.inputs.in_file = bold_file
-        ComputeDVARS_node.inputs.in_mask = bold_mask
-        ComputeDVARS_node.base_dir = base_dir
-        result = ComputeDVARS_node.run()
-        return os.path.abspath(result.outputs.out_std)
-
-
-class FramewiseDisplacementNode:
-    def __call__(self, mcpar, base_dir):
-        FramewiseDisplacement_node = Node(FramewiseDisplacement(), f'FramewiseDisplacement_node')
-        FramewiseDisplacement_node.inputs.in_file = mcpar
-        FramewiseDisplacement_node.inputs.parameter_source = 'FSL'
-        FramewiseDisplacement_node.base_dir = base_dir
-        result = FramewiseDisplacement_node.run()
-        return os.path.abspath(result.outputs.out_file)
+def load_roi(annot_file):
+    annot = np.asanyarray(nib.load(annot_file).dataobj)
+    return annot.reshape(-1) == 1.0
 
 
 class FMRISummaryNode:
@@ -80,27 +49,20 @@ def calculate_mc(mcdat):
 def AverageSingnal(tmp_work_dir, save_svg_dir, bold_id,
                    bold_space_t1w, mcpar, rel_dat_file, aseg, brainmask, brainmask_bin, wm, csf):
 
-    bold = reshape_bold(bold_space_t1w)
     roi_inf = {'global_signal': brainmask_bin, 'white_matter': wm, 'csf': csf}
-    results = []
-    for key in roi_inf.keys():
-        annot_file = roi_inf[key]
-        parc_annot = reshape_annot(annot_file)
-        roi_mean = np.mean(bold[np.where(parc_annot == 1.0)[0]], axis=0)
-        results.append(np.expand_dims(roi_mean, 1))
+    # 一次读入 bold：ROI 均值信号与标准化 DVARS 只保留逐体素 / 逐帧的状态
+    roi_means = ROIMeans({key: load_roi(roi_inf[key]) for key in roi_inf.keys()})
+    dvars = StdDVARS(load_mask(brainmask))
+    stream_bold(bold_space_t1w, [roi_means, dvars])
+    means = roi_means.result()
+    results = [np.expand_dims(means[key], 1) for key in roi_inf.keys()]
     columns = list(roi_inf.keys())
-    bold_mask = brainmask
-    compute_dvars = ComputeDVARSNode()
-    std_dvars_path = compute_dvars(bold_space_t1w, bold_mask, tmp_work_dir)
-    std_dvars = pd.read_csv(std_dvars_path, header=None).values
-    std_dvars = np.insert(std_dvars, 0, np.array([np.nan]), axis=0)
+
+    std_dvars = np.insert(dvars.result(bold_space_t1w), 0, np.nan).reshape(-1, 1)
     results.append(std_dvars)
     columns.append('std_dvars')
 
-    framewisedisplacement = FramewiseDisplacementNode()
-    fd_path = framewisedisplacement(mcpar, tmp_work_dir)
-    fd = pd.read_csv(fd_path, sep='\t', encoding='utf-8').values
-    fd = np.insert(fd, 0, np.array([np.nan]), axis=0)
+    fd = np.insert(framewise_displacement(mcpar), 0, np.nan).reshape(-1, 1)
     results.append(fd)
     columns.append('framewise_displacement')
     rel_transform = np.loadtxt(rel_dat_file)
@@ -120,33 +82,31 @@ def AverageSingnal(tmp_work_dir, save_svg_dir, bold_id,
 
 
 def get_space_t1w_bold(bids_orig, bids_preproc, bold_orig_file):
-    from bids import BIDSLayout
-    layout_orig = BIDSLayout(bids_orig, validate=False)
-    layout_preproc = BIDSLayout(bids_preproc, validate=False)
-    info = layout_orig.parse_file_entities(bold_orig_file)
+    from bids_index import get_file_entities, find_files
+    info = get_file_entities(bids_orig, bold_orig_file)
 
     boldref_t1w_info = info.copy()
     boldref_t1w_info['space'] = 'T1w'
     boldref_t1w_info['suffix'] = 'boldref'
-    boldref_t1w_file = layout_preproc.get(**boldref_t1w_info)[0]
+    boldref_t1w_file = find_files(bids_preproc, **boldref_t1w_info)[0]
 
     bold_t1w_info = info.copy()
     bold_t1w_info['space'] = 'T1w'
     bold_t1w_info['desc'] = 'preproc'
     bold_t1w_info['suffix'] = 'bold'
-    bold_t1w_file = layout_preproc.get(**bold_t1w_info)[0]
+    bold_t1w_file = find_files(bids_preproc, **bold_t1w_info)[0]
 
     fd_t1w_info = info.copy()
     fd_t1w_info['suffix'] = 'mcf'
     fd_t1w_info['extension'] = 'nii.gz.par'
-    fd_t1w_file = layout_preproc.get(**fd_t1w_info)[0]
+    fd_t1w_file = find_files(bids_preproc, **fd_t1w_info)[0]
 
     rel_t1w_info = info.copy()
     rel_t1w_info['suffix'] = 'mcf'
     rel_t1w_info['extension'] = 'nii.gz_rel.rms'
-    rel_t1w_file = layout_preproc.get(**rel_t1w_info)[0]
+    rel_t1w_file = find_files(bids_preproc, **rel_t1w_info)[0]
 
-    return bold_t1w_file.path, boldref_t1w_file.path, fd_t1w_file.path, rel_t1w_file.path
+    return str(bold_t1w_file), str(boldref_t1w_file), str(fd_t1w_file), str(rel_t1w_file)
 
 
 if __name__ == '__main__':
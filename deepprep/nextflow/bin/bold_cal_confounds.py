@@ -6,10 +6,11 @@ import csv
 from pathlib import Path
 import pandas as pd
 import numpy as np
-import nibabel as nib
-from sklearn.decomposition import PCA
 import shutil
 
+from confound_signals import (PCA_COMPONENTS, PCA_METHODS, extract_roi_means, extract_pca_regressors,
+                              extract_confound_signals, write_roi_regressor, write_pca_regressor)
+
 
 def qnt_nifti(bpss_path, maskpath, outpath):
     '''
@@ -18,63 +19,21 @@ def qnt_nifti(bpss_path, maskpath, outpath):
     maskpath - Path to file containing mask.
     outpath  - Path to file to place the output.
     '''
-
-    # Open mask.
-    mask_img = nib.load(maskpath)
-    mask = mask_img.get_fdata().flatten() > 0
-    nvox = float(mask.sum())
-    assert nvox > 0, 'Null mask found in %s' % maskpath
-
-    p = 0
-    with outpath.open('w') as f:
-        img = nib.load(bpss_path)
-        data = img.get_fdata()
-        for iframe in range(data.shape[-1]):
-            frame = data[:, :, :, iframe].flatten()
-            total = frame[mask].sum()
-            q = total / nvox
-
-            if iframe == 0:
-                diff = 0.0
-            else:
-                diff = q - p
-            f.write('%10.4f\t%10.4f\n' % (q, diff))
-            p = q
-
-
-def regressor_PCA_singlebold(pca_data, n):
-    pca = PCA(n_components=n, random_state=False)
-    pca_regressor = pca.fit_transform(pca_data.T)
-    return pca_regressor
+    means = extract_roi_means(bpss_path, {'roi': maskpath})
+    write_roi_regressor(means['roi'], outpath)
 
 
-def regressors_PCA(bpss_path, maskpath, outpath):
+def regressors_PCA(bpss_path, maskpath, outpath, n_components=PCA_COMPONENTS, method='randomized'):
     '''
     Generate PCA regressor from outer points of brain.
         bpss_path - path. Path of bold after bpass process.
         maskpath - Path to file containing mask.
         outpath  - Path to file to place the output.
+        n_components - number of PCA regressors.
+        method - randomized / incremental / full, see confound_signals.py.
     '''
-    # PCA parameter.
-    n = 10
-
-    # Open mask.
-    mask_img = nib.load(maskpath)
-    mask = mask_img.get_fdata().swapaxes(0, 1)
-    mask = mask.flatten(order='F') == 0
-    nvox = float(mask.sum())
-    assert nvox > 0, 'Null mask found in %s' % maskpath
-
-    with outpath.open('w') as f:
-        img = nib.load(bpss_path)
-        data = img.get_fdata().swapaxes(0, 1)
-        vol_data = data.reshape((data.shape[0] * data.shape[1] * data.shape[2], data.shape[3]), order='F')
-        pca_data = vol_data[mask]
-        pca_regressor = regressor_PCA_singlebold(pca_data, n)
-        for iframe in range(data.shape[-1]):
-            for idx in range(n):
-                f.write('%10.4f\t' % (pca_regressor[iframe, idx]))
-            f.write('\n')
+    pca_regressor = extract_pca_regressors(bpss_path, maskpath, n_components, method)
+    write_pca_regressor(pca_regressor, outpath)
 
 
 def build_movement_regressors(subject, movement_path: Path, fcmri_path: Path, mcdat_file: Path):
@@ -174,8 +133,8 @@ def build_movement_regressors(subject, movement_path: Path, fcmri_path: Path, mc
 
 
 def compile_regressors(func_path: Path, subject, bold_id: str, bpss_path: Path, confounds_dir_path,
-                       mcdat_file, aseg_wm, aseg_brainmask, aseg_brainmask_bin, aseg_ventricles
-                       ):
+                       mcdat_file, aseg_wm, aseg_brainmask, aseg_brainmask_bin, aseg_ventricles,
+                       pca_components=PCA_COMPONENTS, pca_method='randomized'):
     # Compile the regressors.
 
     # wipe mov regressors, if there
@@ -184,14 +143,18 @@ def compile_regressors(func_path: Path, subject, bold_id: str, bpss_path: Path,
     mov_regressor_path = confounds_dir_path / ('%s_mov_regressor.dat' % subject)
     os.rename(mov_regressor_common_path, mov_regressor_path)
 
+    # 一次读入 bold，同时计算 WB / ventricles / wm 的均值信号与脑外体素的 PCA
+    roi_means, pca_regressor = extract_confound_signals(
+        bpss_path, {'WB': aseg_brainmask_bin, 'ventricles': aseg_ventricles, 'wm': aseg_wm}, aseg_brainmask,
+        pca_components, pca_method)
     out_path = confounds_dir_path / ('%s_WB_regressor_dt.dat' % subject)
-    qnt_nifti(bpss_path, str(aseg_brainmask_bin), out_path)
+    write_roi_regressor(roi_means['WB'], out_path)
 
     vent_out_path = confounds_dir_path / ('%s_ventricles_regressor_dt.dat' % subject)
-    qnt_nifti(bpss_path, str(aseg_ventricles), vent_out_path)
+    write_roi_regressor(roi_means['ventricles'], vent_out_path)
 
     wm_out_path = confounds_dir_path / ('%s_wm_regressor_dt.dat' % subject)
-    qnt_nifti(bpss_path, str(aseg_wm), wm_out_path)
+    write_roi_regressor(roi_means['wm'], wm_out_path)
 
     pasted_out_path = confounds_dir_path / ('%s_vent_wm_dt.dat' % subject)
     with pasted_out_path.open('w') as f:
@@ -199,7 +162,7 @@ def compile_regressors(func_path: Path, subject, bold_id: str, bpss_path: Path,
 
     # Generate PCA regressors of bpss nifti.
     pca_out_path = confounds_dir_path / ('%s_pca_regressor_dt.dat' % subject)
-    regressors_PCA(bpss_path, str(aseg_brainmask), pca_out_path)
+    write_pca_regressor(pca_regressor, pca_out_path)
 
     fnames = [
         confounds_dir_path / ('%s_mov_regressor.dat' % subject),
@@ -226,8 +189,7 @@ def compile_regressors(func_path: Path, subject, bold_id: str, bpss_path: Path,
     download_regressors = np.concatenate((frame_no, regressors), axis=1)
     label_header = ['Frame', 'dL', 'dP', 'dS', 'pitch', 'yaw', 'roll',
                     'dL_d', 'dP_d', 'dS_d', 'pitch_d', 'yaw_d', 'roll_d',
-                    'WB', 'WB_d', 'vent', 'vent_d', 'wm', 'wm_d',
-                    'comp1', 'comp2', 'comp3', 'comp4', 'comp5', 'comp6', 'comp7', 'comp8', 'comp9', 'comp10']
+                    'WB', 'WB_d', 'vent', 'vent_d', 'wm', 'wm_d'] + [f'comp{i + 1}' for i in range(pca_components)]
     with download_all_regressors_path.open('w') as f:
         csv.writer(f, delimiter=' ').writerows([label_header])
         writer = csv.writer(f, delimiter=' ')
@@ -252,6 +214,10 @@ if __name__ == '__main__':
     parser.add_argument("--aseg_brainmask", required=True)
     parser.add_argument("--aseg_brainmask_bin", required=True)
     parser.add_argument("--aseg_ventricles", required=True)
+    parser.add_argument("--pca_components", type=int, default=PCA_COMPONENTS,
+                        help="number of PCA regressors of the voxels outside the brain")
+    parser.add_argument("--pca_method", default='randomized', choices=PCA_METHODS,
+                        help="randomized / incremental (bounded memory) / full (exact) PCA")
     args = parser.parse_args()
 
     func_path = Path(args.bold_preprocess_dir) / args.subject_id / 'func'
@@ -272,5 +238,5 @@ if __name__ == '__main__':
     aseg_ventricles = args.aseg_ventricles
 
     compile_regressors(func_path, args.subject_id, args.bold_id, bold_file, confounds_dir_path,
-                       mcdat_file, aseg_wm, aseg_brainmask, aseg_brainmask_bin, aseg_ventricles
-                       )
+                       mcdat_file, aseg_wm, aseg_brainmask, aseg_brainmask_bin, aseg_ventricles,
+                       args.pca_components, args.pca_method)
@@ -11,15 +11,13 @@ def concat_bold(transformed_dir, concat_bold_file):
 
 
 def get_space_t1w_bold(bids_orig, bids_preproc, bold_orig_file):
-    from bids import BIDSLayout
-    layout_orig = BIDSLayout(bids_orig, validate=False)
-    layout_preproc = BIDSLayout(bids_preproc, validate=False)
-    info = layout_orig.parse_file_entities(bold_orig_file)
+    from bids_index import get_file_entities, find_files
+    info = get_file_entities(bids_orig, bold_orig_file)
     bold_t1w_info = info.copy()
     bold_t1w_info['space'] = 'T1w'
     bold_t1w_info['suffix'] = 'bold'
     bold_t1w_info['extension'] = '.nii.gz'
-    bold_t1w_file = layout_preproc.get(**bold_t1w_info)[0]
+    bold_t1w_file = find_files(bids_preproc, **bold_t1w_info)[0]
 
     return bold_t1w_file
 
@@ -43,7 +41,7 @@ if __name__ == '__main__':
     bold_file = data[1]
     bold_t1w_file = get_space_t1w_bold(args.bids_dir, args.bold_preprocess_dir, bold_file)
 
-    bold_output = Path(bold_t1w_file.dirname) / f'{args.bold_id}_space-{args.template_space}_res-{args.template_resolution}_desc-preproc_bold.nii.gz'
+    bold_output = bold_t1w_file.parent / f'{args.bold_id}_space-{args.template_space}_res-{args.template_resolution}_desc-preproc_bold.nii.gz'
     concat_bold(args.transform_dir, bold_output)
     assert os.path.exists(bold_output), f'{bold_output}'
     rm_dir = Path(args.transform_dir).parent
@@ -6,10 +6,11 @@ import csv
 from pathlib import Path
 import pandas as pd
 import numpy as np
-import nibabel as nib
-from sklearn.decomposition import PCA
 import shutil
 
+from confound_signals import (PCA_COMPONENTS, PCA_METHODS, extract_roi_means, extract_pca_regressors,
+                              extract_confound_signals, write_roi_regressor, write_pca_regressor)
+
 from bold_mkbrainmask import anat2bold_t1w
 
 
@@ -20,63 +21,21 @@ def qnt_nifti(bpss_path, maskpath, outpath):
     maskpath - Path to file containing mask.
     outpath  - Path to file to place the output.
     '''
-
-    # Open mask.
-    mask_img = nib.load(maskpath)
-    mask = mask_img.get_fdata().flatten() > 0
-    nvox = float(mask.sum())
-    assert nvox > 0, 'Null mask found in %s' % maskpath
-
-    p = 0
-    with outpath.open('w') as f:
-        img = nib.load(bpss_path)
-        data = img.get_fdata()
-        for iframe in range(data.shape[-1]):
-            frame = data[:, :, :, iframe].flatten()
-            total = frame[mask].sum()
-            q = total / nvox
-
-            if iframe == 0:
-                diff = 0.0
-            else:
-                diff = q - p
-            f.write('%10.4f\t%10.4f\n' % (q, diff))
-            p = q
-
-
-def regressor_PCA_singlebold(pca_data, n):
-    pca = PCA(n_components=n, random_state=False)
-    pca_regressor = pca.fit_transform(pca_data.T)
-    return pca_regressor
+    means = extract_roi_means(bpss_path, {'roi': maskpath})
+    write_roi_regressor(means['roi'], outpath)
 
 
-def regressors_PCA(bpss_path, maskpath, outpath):
+def regressors_PCA(bpss_path, maskpath, outpath, n_components=PCA_COMPONENTS, method='randomized'):
     '''
     Generate PCA regressor from outer points of brain.
         bpss_path - path. Path of bold after bpass process.
         maskpath - Path to file containing mask.
         outpath  - Path to file to place the output.
+        n_components - number of PCA regressors.
+        method - randomized / incremental / full, see confound_signals.py.
     '''
-    # PCA parameter.
-    n = 10
-
-    # Open mask.
-    mask_img = nib.load(maskpath)
-    mask = mask_img.get_fdata().swapaxes(0, 1)
-    mask = mask.flatten(order='F') == 0
-    nvox = float(mask.sum())
-    assert nvox > 0, 'Null mask found in %s' % maskpath
-
-    with outpath.open('w') as f:
-        img = nib.load(bpss_path)
-        data = img.get_fdata().swapaxes(0, 1)
-        vol_data = data.reshape((data.shape[0] * data.shape[1] * data.shape[2], data.shape[3]), order='F')
-        pca_data = vol_data[mask]
-        pca_regressor = regressor_PCA_singlebold(pca_data, n)
-        for iframe in range(data.shape[-1]):
-            for idx in range(n):
-                f.write('%10.4f\t' % (pca_regressor[iframe, idx]))
-            f.write('\n')
+    pca_regressor = extract_pca_regressors(bpss_path, maskpath, n_components, method)
+    write_pca_regressor(pca_regressor, outpath)
 
 
 def build_movement_regressors(movement_path: Path, mcpar_file: Path, output_file: Path):
@@ -170,21 +129,25 @@ def build_movement_regressors(movement_path: Path, mcpar_file: Path, output_file
 
 def compile_regressors(func_path: Path, bold_id: str, bpss_path: Path, confounds_dir_path,
                        mcdat_file, aseg_wm, aseg_brainmask, aseg_brainmask_bin, aseg_ventricles,
-                       output_file):
+                       output_file, pca_components=PCA_COMPONENTS, pca_method='randomized'):
     # Compile the regressors.
 
     # wipe mov regressors, if there
     mov_out_path = confounds_dir_path / 'mov_regressor.dat'
     build_movement_regressors(confounds_dir_path, mcdat_file, mov_out_path)
 
+    # 一次读入 bold，同时计算 WB / ventricles / wm 的均值信号与脑外体素的 PCA
+    roi_means, pca_regressor = extract_confound_signals(
+        bpss_path, {'WB': aseg_brainmask_bin, 'ventricles': aseg_ventricles, 'wm': aseg_wm}, aseg_brainmask,
+        pca_components, pca_method)
     wb_out_path = confounds_dir_path / 'WB_regressor_dt.dat'
-    qnt_nifti(bpss_path, str(aseg_brainmask_bin), wb_out_path)
+    write_roi_regressor(roi_means['WB'], wb_out_path)
 
     vent_out_path = confounds_dir_path / 'ventricles_regressor_dt.dat'
-    qnt_nifti(bpss_path, str(aseg_ventricles), vent_out_path)
+    write_roi_regressor(roi_means['ventricles'], vent_out_path)
 
     wm_out_path = confounds_dir_path / 'WM_regressor_dt.dat'
-    qnt_nifti(bpss_path, str(aseg_wm), wm_out_path)
+    write_roi_regressor(roi_means['wm'], wm_out_path)
 
     pasted_out_path = confounds_dir_path / 'Vent_wm_dt.dat'
     with pasted_out_path.open('w') as f:
@@ -192,7 +155,7 @@ def compile_regressors(func_path: Path, bold_id: str, bpss_path: Path, confounds
 
     # Generate PCA regressors of bpss nifti.
     pca_out_path = confounds_dir_path / 'pca_regressor_dt.dat'
-    regressors_PCA(bpss_path, str(aseg_brainmask), pca_out_path)
+    write_pca_regressor(pca_regressor, pca_out_path)
 
     fnames = [
         mov_out_path,
@@ -219,8 +182,7 @@ def compile_regressors(func_path: Path, bold_id: str, bpss_path: Path, confounds
     download_regressors = np.concatenate((frame_no, regressors), axis=1)
     label_header = ['Frame', 'dL', 'dP', 'dS', 'pitch', 'yaw', 'roll',
                     'dL_d', 'dP_d', 'dS_d', 'pitch_d', 'yaw_d', 'roll_d',
-                    'WB', 'WB_d', 'vent', 'vent_d', 'wm', 'wm_d',
-                    'comp1', 'comp2', 'comp3', 'comp4', 'comp5', 'comp6', 'comp7', 'comp8', 'comp9', 'comp10']
+                    'WB', 'WB_d', 'vent', 'vent_d', 'wm', 'wm_d'] + [f'comp{i + 1}' for i in range(pca_components)]
     with output_file.open('w') as f:
         csv.writer(f, delimiter=' ').writerows([label_header])
         writer = csv.writer(f, delimiter=' ')
@@ -230,21 +192,19 @@ def compile_regressors(func_path: Path, bold_id: str, bpss_path: Path, confounds
 
 
 def get_space_t1w_bold(bids_orig, bids_preproc, bold_orig_file):
-    from bids import BIDSLayout
-    layout_orig = BIDSLayout(bids_orig, validate=False)
-    layout_preproc = BIDSLayout(bids_preproc, validate=False)
-    info = layout_orig.parse_file_entities(bold_orig_file)
+    from bids_index import get_file_entities, find_files
+    info = get_file_entities(bids_orig, bold_orig_file)
 
     boldref_t1w_info = info.copy()
     boldref_t1w_info['space'] = 'T1w'
     boldref_t1w_info['suffix'] = 'boldref'
-    boldref_t1w_file = layout_preproc.get(**boldref_t1w_info)[0]
+    boldref_t1w_file = find_files(bids_preproc, **boldref_t1w_info)[0]
 
     bold_t1w_info = info.copy()
     bold_t1w_info['space'] = 'T1w'
     bold_t1w_info['desc'] = 'preproc'
     bold_t1w_info['suffix'] = 'bold'
-    bold_t1w_file = layout_preproc.get(**bold_t1w_info)[0]
+    bold_t1w_file = find_files(bids_preproc, **bold_t1w_info)[0]
 
     # sub-CIMT001_ses-38659_task-rest_run-01_bold_mcf.nii.gz.par
     # bold_par_info = layout_preproc.parse_file_entities(f'{bids_preproc}/sub-CIMT001_ses-38659_task-rest_run-01_bold_mcf.nii.gz.par')
@@ -253,9 +213,9 @@ def get_space_t1w_bold(bids_orig, bids_preproc, bold_orig_file):
     bold_par_info.pop('datatype')
     bold_par_info['suffix'] = 'mcf'
     bold_par_info['extension'] = '.nii.gz.par'
-    bold_par = layout_preproc.get(**bold_par_info)[0]
+    bold_par = find_files(bids_preproc, **bold_par_info)[0]
 
-    return bold_t1w_file.path, boldref_t1w_file.path, bold_par.path
+    return str(bold_t1w_file), str(boldref_t1w_file), str(bold_par)
 
 
 if __name__ == '__main__':
@@ -271,6 +231,10 @@ if __name__ == '__main__':
     parser.add_argument("--bold_file", required=True)
     parser.add_argument("--aseg_mgz", required=True)
     parser.add_argument("--brainmask_mgz", required=True)
+    parser.add_argument("--pca_components", type=int, default=PCA_COMPONENTS,
+                        help="number of PCA regressors of the voxels outside the brain")
+    parser.add_argument("--pca_method", default='randomized', choices=PCA_METHODS,
+                        help="randomized / incremental (bounded memory) / full (exact) PCA")
     args = parser.parse_args()
     """
     input:
@@ -312,5 +276,5 @@ if __name__ == '__main__':
     confounds_file = Path(boldref_space_t1w_file).parent / f'{args.bold_id}_desc-confounds_timeseries.txt'
     compile_regressors(Path(args.bold_preprocess_dir), args.bold_id, bold_space_t1w_file, confounds_dir_path,
                        Path(bold_mcpar_file), wm, mask, binmask, vent,
-                       confounds_file)
+                       confounds_file, args.pca_components, args.pca_method)
     assert confounds_file.exists()
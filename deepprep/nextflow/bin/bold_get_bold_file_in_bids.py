@@ -1,7 +1,7 @@
 #! /usr/bin/env python3
 import os
 import argparse
-import bids
+from bids_index import get_layout
 from pathlib import Path
 
 if __name__ == '__main__':
@@ -22,7 +22,7 @@ if __name__ == '__main__':
     else:
         bold_subject_ids = args.subject_ids
         anat_subject_ids = bold_subject_ids
-    layout = bids.BIDSLayout(args.bids_dir, derivatives=False)
+    layout = get_layout(args.bids_dir, derivatives=False)
     bold_subject_dict = {}
     anat_subject_dict = {}
     bold_filess = []
@@ -1,10 +1,10 @@
 #! /usr/bin/env python3
-import sys
-import sh
 from pathlib import Path
 import argparse
 import os
 
+from bold_anat_masks import write_anat_masks
+
 def cmd(subj_func_dir: Path, mc: Path, bbregister_dat: Path, subjects_dir: Path, subject_id: str):
     mov = mc
     reg = bbregister_dat
@@ -20,46 +20,9 @@ def cmd(subj_func_dir: Path, mc: Path, bbregister_dat: Path, subjects_dir: Path,
     mask = subj_func_dir / mc.name.replace('.nii.gz', '.anat.brainmask.nii.gz')
     binmask = subj_func_dir / mc.name.replace('.nii.gz', '.anat.brainmask.bin.nii.gz')
 
-    shargs = [
-        '--seg', seg,
-        '--temp', mov,
-        '--reg', reg,
-        '--o', func]
-    sh.mri_label2vol(*shargs, _out=sys.stdout)
-
-    shargs = [
-        '--i', func,
-        '--wm',
-        '--erode', 1, #TODO
-        '--o', wm]
-    sh.mri_binarize(*shargs, _out=sys.stdout)
-
-    shargs = [
-        '--i', func,
-        '--min', 24,
-        '--max', 24,
-        '--o', csf]
-    sh.mri_binarize(*shargs, _out=sys.stdout)
-
-    shargs = [
-        '--i', func,
-        '--ventricles',
-        '--o', vent]
-    sh.mri_binarize(*shargs, _out=sys.stdout)
-
-    shargs = [
-        '--reg', reg,
-        '--targ', targ,
-        '--mov', mov,
-        '--inv',
-        '--o', mask]
-    sh.mri_vol2vol(*shargs, _out=sys.stdout)
+    out_files = {'dseg': func, 'wm': wm, 'vent': vent, 'csf': csf, 'mask': mask, 'binmask': binmask}
+    write_anat_masks(seg, targ, mov, out_files, reg_file=reg)
 
-    shargs = [
-        '--i', mask,
-        '--o', binmask,
-        '--min', 0.0001]
-    sh.mri_binarize(*shargs, _out=sys.stdout)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -13,7 +13,7 @@
 # limitations under the License.
 
 from pathlib import Path
-import bids
+from bids_index import get_layout
 import argparse
 import os
 import shutil
@@ -62,7 +62,7 @@ def cmd(subj_tmp_dir, bids_dir, bold_file, raw_ref_image, orig_bold_file, mc_xfo
     print('hmc DONE!!!!!!!!')
 
     # # run stc if metadata is provided
-    layout = bids.BIDSLayout(str(bids_dir), derivatives=True)
+    layout = get_layout(str(bids_dir), derivatives=True)
     all_metadata = [layout.get_metadata(fname) for fname in listify(orig_bold_file)]
     metadata = all_metadata[0]
     run_stc = bool(metadata.get("SliceTiming"))
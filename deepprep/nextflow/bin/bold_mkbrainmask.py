@@ -3,6 +3,8 @@ from pathlib import Path
 import argparse
 import os
 
+from bold_anat_masks import write_anat_masks
+
 
 # import bids
 # from niworkflows.interfaces.bids import DerivativesDataSink
@@ -20,44 +22,11 @@ import os
 def anat2bold_t1w(aseg_mgz: str, brainmask_mgz: str, bold_space_t1w_file: str,
                   aseg: Path, wm: Path, vent: Path, csf: Path, mask: Path, binmask: Path
                   ):
-
-    cmd = f'mri_convert -rl {bold_space_t1w_file} {aseg_mgz} {aseg}'
-    os.system(cmd)
-    assert os.path.exists(aseg)
-
-    cmd = f'mri_convert -rl {bold_space_t1w_file} {brainmask_mgz} {mask}'
-    os.system(cmd)
-    assert os.path.exists(mask)
-
-    shargs = [
-        '--i', aseg,
-        '--wm',
-        '--erode', '1',
-        '--o', wm]
-    os.system('mri_binarize ' + ' '.join(shargs))
-    assert os.path.exists(wm)
-
-    shargs = [
-        '--i', aseg,
-        '--min', '24',
-        '--max', '24',
-        '--o', csf]
-    os.system('mri_binarize ' + ' '.join(shargs))
-    assert os.path.exists(csf)
-
-    shargs = [
-        '--i', aseg,
-        '--ventricles',
-        '--o', vent]
-    os.system('mri_binarize ' + ' '.join(shargs))
-    assert os.path.exists(vent)
-
-    shargs = [
-        '--i', mask,
-        '--o', binmask,
-        '--min', '0.0001']
-    os.system('mri_binarize ' + ' '.join(shargs))
-    assert os.path.exists(binmask)
+    # anat 与 T1w 空间的 BOLD 共用 scanner RAS（原 mri_convert -rl + mri_binarize）
+    out_files = {'dseg': aseg, 'wm': wm, 'vent': vent, 'csf': csf, 'mask': mask, 'binmask': binmask}
+    write_anat_masks(aseg_mgz, brainmask_mgz, bold_space_t1w_file, out_files)
+    for out_file in out_files.values():
+        assert os.path.exists(out_file)
 
 
 def anat2bold_by_bbregister(subj_func_dir: Path, mc: Path, bbregister_dat: Path, subjects_dir: Path, subject_id: str):
@@ -75,46 +44,9 @@ def anat2bold_by_bbregister(subj_func_dir: Path, mc: Path, bbregister_dat: Path,
     mask = subj_func_dir / mc.name.replace('bold.nii.gz', 'desc-brain_mask.nii.gz')
     binmask = subj_func_dir / mc.name.replace('bold.nii.gz', 'desc-brain_maskbin.nii.gz')
 
-    shargs = [
-        '--seg', seg,
-        '--temp', mov,
-        '--reg', reg,
-        '--o', func]
-    os.system('mri_label2vol ' + ' '.join(shargs))
-
-    shargs = [
-        '--i', func,
-        '--wm',
-        '--erode', '1',
-        '--o', wm]
-    os.system('mri_binarize ' + ' '.join(shargs))
-
-    shargs = [
-        '--i', func,
-        '--min', '24',
-        '--max', '24',
-        '--o', csf]
-    os.system('mri_binarize ' + ' '.join(shargs))
-
-    shargs = [
-        '--i', func,
-        '--ventricles',
-        '--o', vent]
-    os.system('mri_binarize ' + ' '.join(shargs))
-
-    shargs = [
-        '--reg', reg,
-        '--targ', targ,
-        '--mov', mov,
-        '--inv',
-        '--o', mask]
-    os.system('mri_vol2vol ' + ' '.join(shargs))
-
-    shargs = [
-        '--i', mask,
-        '--o', binmask,
-        '--min', '0.0001']
-    os.system('mri_binarize ' + ' '.join(shargs))
+    # 经 bbregister 的 register.dat 投影（原 mri_label2vol / mri_vol2vol --inv + mri_binarize）
+    out_files = {'dseg': func, 'wm': wm, 'vent': vent, 'csf': csf, 'mask': mask, 'binmask': binmask}
+    write_anat_masks(seg, targ, mov, out_files, reg_file=reg)
 
 
 if __name__ == '__main__':
@@ -23,6 +23,7 @@ import argparse
 from pathlib import Path
 
 import bids
+from bids_index import get_layout
 from nipype.pipeline import engine as pe
 
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
@@ -197,18 +198,26 @@ def map_fieldmap_estimation(
     return fmap_estimators, estimator_map
 
 
+def find_bold_file(layout, subject_id, bold_file_name):
+    """
+    BOLD of the input BIDS dataset that bold_file_name (the file name without _space-mc) comes from, None if not found
+    """
+    bold_file = None
+    for _f in layout.get('file', subject=subject_id, suffix="bold", extension='.nii.gz'):
+        if bold_file_name in _f:
+            bold_file = _f
+    return bold_file
+
+
 def main(bids_path, subject_id, bold_id, bold_file_name, bold_input_file, boldref_file, hmc_xfm_file, tmp_dir, sdc_file):
-    layout = bids.BIDSLayout(bids_path)
+    layout = get_layout(bids_path)
     use_syn_sdc = False
     force_syn = False
     omp_nthreads = 1
 
     print('bold_file_name : ', bold_file_name)
-    bold_file = None
-    for _f in layout.get('file', subject=subject_id, suffix="bold", extension='.nii.gz'):
-        if bold_file_name in _f:
-            bold_file = _f
-            print('bold_file : ', bold_file)
+    bold_file = find_bold_file(layout, subject_id, bold_file_name)
+    print('bold_file : ', bold_file)
     if not bold_file:
         print('No bold file found for subject')
         return
@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+"""
+Inputs of the SDC of one BOLD run in the input BIDS dataset, for the manifest of bold_sdc.py.
+
+bold_sdc.py finds the fieldmaps itself in --bids_dir. Here the same estimators are
+looked up (as main of bold_sdc.py does) and every source file is printed as an
+--input argument of deepprep_manifest.py. The metadata bold_sdc.py uses (sidecars
+with inheritance, IntendedFor / B0FieldSource) is written to --metadata_file, which
+is printed as an input too. So an added, replaced or edited fieldmap invalidates
+the manifest of the runs it corrects.
+
+    fmap_inputs=$(bold_sdc_inputs.py --bids_dir <bids_dir> --subject_id sub-01 \
+        --bold_file <sub-01_task-rest_run-01_space-mc_bold.nii.gz> --metadata_file <bold_id>_sdc_fmap.json)
+    deepprep_manifest.py ... ${fmap_inputs} ... -- bold_sdc.py ...
+"""
+import os
+import sys
+import json
+import argparse
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from bids_index import get_layout
+from bold_sdc import find_bold_file, map_fieldmap_estimation
+
+
+def get_sdc_sources(bids_path, subject_id, bold_file_name):
+    """
+    {name: path} of the BOLD and the fieldmap source files, and the metadata of them and of the estimators
+    """
+    layout = get_layout(bids_path)
+    bold_file = find_bold_file(layout, subject_id, bold_file_name)
+    if not bold_file:
+        return dict(), dict()
+
+    # 与 bold_sdc.py main 中的设置相同
+    fmap_estimators, _ = map_fieldmap_estimation(layout=layout, subject_id=subject_id, bold_data=[[bold_file]],
+                                                 ignore_fieldmaps=False, use_syn=False, force_syn=False)
+    sources = {'bold_orig': bold_file}
+    metadata = {'bold': {'path': os.path.relpath(bold_file, bids_path), 'metadata': layout.get_metadata(bold_file)},
+                'estimators': list()}
+    for estimator in fmap_estimators:
+        estimator_metadata = {'bids_id': estimator.bids_id, 'method': str(estimator.method), 'sources': list()}
+        for source in estimator.sources:
+            sources[f'fmap_{len(sources) - 1}'] = str(source.path)
+            estimator_metadata['sources'].append({'path': os.path.relpath(source.path, bids_path),
+                                                  'metadata': source.metadata})
+        metadata['estimators'].append(estimator_metadata)
+    return sources, metadata
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="DeepPrep: print the fieldmap inputs of bold_sdc.py as deepprep_manifest.py --input arguments"
+    )
+    parser.add_argument("--bids_dir", required=True)
+    parser.add_argument("--subject_id", required=True)
+    parser.add_argument("--bold_file", required=True, help="motion corrected BOLD (_space-mc) given to bold_sdc.py")
+    parser.add_argument("--metadata_file", required=True, help="json of the metadata of the BOLD and the fieldmaps")
+    args = parser.parse_args()
+
+    bold_file_name = Path(args.bold_file).name.replace('_space-mc', '')
+    # stdout 只输出 --input 参数，其他信息写到 stderr
+    with redirect_stdout(sys.stderr):
+        sources, metadata = get_sdc_sources(args.bids_dir, args.subject_id.split('-')[1], bold_file_name)
+    metadata_file = Path(args.metadata_file)
+    metadata_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(metadata_file, 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True, default=str)
+    sources['fmap_metadata'] = metadata_file
+    print(' '.join(f'--input {name}={path}' for name, path in sources.items()))
@@ -36,15 +36,13 @@ def split_bold_convert(ori_bold_file, work_dir, tar_t1w_file, bold_id, process_n
 
 
 def get_space_t1w_bold(bids_orig, bids_preproc, bold_orig_file):
-    from bids import BIDSLayout
-    layout_orig = BIDSLayout(bids_orig, validate=False)
-    layout_preproc = BIDSLayout(bids_preproc, validate=False)
-    info = layout_orig.parse_file_entities(bold_orig_file)
+    from bids_index import get_file_entities, find_files
+    info = get_file_entities(bids_orig, bold_orig_file)
     bold_t1w_info = info.copy()
     bold_t1w_info['space'] = 'T1w'
     bold_t1w_info['suffix'] = 'bold'
     bold_t1w_info['extension'] = '.nii.gz'
-    bold_t1w_file = layout_preproc.get(**bold_t1w_info)[0]
+    bold_t1w_file = find_files(bids_preproc, **bold_t1w_info)[0]
 
     return bold_t1w_file
 
@@ -70,5 +68,5 @@ if __name__ == '__main__':
     data = [i.strip() for i in data]
     bold_file = data[1]
     bold_t1w_file = get_space_t1w_bold(args.bids_dir, args.bold_preprocess_dir, bold_file)
-    upsampled_dir, rm_dir = split_bold_convert(bold_t1w_file.path, args.work_dir, T1_2mm, args.bold_id, process_num=int(args.process_num))
+    upsampled_dir, rm_dir = split_bold_convert(str(bold_t1w_file), args.work_dir, T1_2mm, args.bold_id, process_num=int(args.process_num))
     assert os.path.exists(upsampled_dir), f'{upsampled_dir}'
\ No newline at end of file
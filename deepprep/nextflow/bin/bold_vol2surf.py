@@ -6,18 +6,42 @@ import numpy as np
 import nibabel as nib
 from pathlib import Path
 from nilearn import surface
+from surf_resample import get_surf2surf_matrix, surf2surf as surf2surf_matrix
+from surf_projection import get_projection_matrix, project_bold
 
 
-def vol2surf(vol, hemi_pial, hemi_white, hemi_w_g_pct, hemi_fsnative_surf_output):
+def vol2surf(vol, hemi_pial, hemi_white, hemi_w_g_pct, hemi_fsnative_surf_output, cache_dir=None):
+    """
+    cache_dir: use the cached sparse projection matrix (surf_projection) and stream the frames;
+               None falls back to nilearn vol_to_surf on the full 4D series
+    """
     img = nib.load(vol)
-    surf_data = surface.vol_to_surf(img,
-                                    surf_mesh=hemi_pial,
-                                    inner_mesh=hemi_white)
+    if cache_dir is not None:
+        matrix = get_projection_matrix(hemi_pial, hemi_white, img, cache_dir=cache_dir)
+        surf_data = project_bold(matrix, img)
+    else:
+        surf_data = surface.vol_to_surf(img,
+                                        surf_mesh=hemi_pial,
+                                        inner_mesh=hemi_white)
     surf_data[np.isnan(surf_data)] = 0
     hemi_template = nib.load(hemi_w_g_pct)
     tarimg = nib.Nifti1Image(surf_data.reshape([surf_data.shape[0], 1, 1, surf_data.shape[1]]), hemi_template.affine,
                              hemi_template.header)
     nib.save(tarimg, hemi_fsnative_surf_output)
+    return surf_data, tarimg
+
+
+def surf2surf_sparse(surf_data, fsnative_img, subjects_dir, subject_id, hemi, trgsubject,
+                     hemi_fsaverage_surf_output, cache_dir):
+    """
+    In-process mri_surf2surf: one sparse product over the whole vertex x time series
+    """
+    matrix = get_surf2surf_matrix(subjects_dir, subject_id, hemi, trgsubject, cache_dir=cache_dir)
+    trg_data = surf2surf_matrix(matrix, surf_data)
+    tarimg = nib.Nifti1Image(trg_data.reshape([trg_data.shape[0], 1, 1, trg_data.shape[1]]), fsnative_img.affine,
+                             fsnative_img.header)
+    tarimg.set_data_dtype(np.float32)
+    nib.save(tarimg, hemi_fsaverage_surf_output)
 
 
 def surf2surf(hemi_fsnative_surf_output, subjects_dir, freesurfer_home, subject_id, hemi, trgsubject,
@@ -45,6 +69,10 @@ if __name__ == '__main__':
     parser.add_argument("--trgsubject", default='fsaverage6')
     parser.add_argument("--hemi_fsnative_surf_output", required=True)
     parser.add_argument("--hemi_fsaverage_surf_output", required=True)
+    parser.add_argument("--surf2surf_method", default='sparse', choices=['sparse', 'mri_surf2surf'],
+                        help='sparse: in-process cached sparse resampling; mri_surf2surf: FreeSurfer subprocess')
+    parser.add_argument("--vol2surf_method", default='sparse', choices=['sparse', 'nilearn'],
+                        help='sparse: cached projection matrix with streamed frames; nilearn: vol_to_surf')
     args = parser.parse_args()
 
     preprocess_dir = Path(args.bold_preprocess_dir) / args.subject_id
@@ -62,6 +90,13 @@ if __name__ == '__main__':
     trgsubject_dir = Path(args.subjects_dir) / args.trgsubject
     if not trgsubject_dir.exists():
         os.system(f"ln -sf {Path(args.freesurfer_home) / f'subjects/{args.trgsubject}'} {trgsubject_dir}")
-    vol2surf(bbregister_native_2mm, hemi_pial, hemi_white, hemi_w_g_pct, hemi_fsnative_surf_output)
-    surf2surf(hemi_fsnative_surf_output, args.subjects_dir, args.freesurfer_home, args.subject_id, hemi,
-              args.trgsubject, hemi_fsaverage_surf_output)
+    vol2surf_cache_dir = Path(preprocess_dir) / 'tmp' / 'vol2surf' if args.vol2surf_method == 'sparse' else None
+    surf_data, fsnative_img = vol2surf(bbregister_native_2mm, hemi_pial, hemi_white, hemi_w_g_pct,
+                                       hemi_fsnative_surf_output, cache_dir=vol2surf_cache_dir)
+    if args.surf2surf_method == 'sparse':
+        cache_dir = Path(preprocess_dir) / 'tmp' / 'surf2surf'
+        surf2surf_sparse(surf_data, fsnative_img, args.subjects_dir, args.subject_id, hemi, args.trgsubject,
+                         hemi_fsaverage_surf_output, cache_dir)
+    else:
+        surf2surf(hemi_fsnative_surf_output, args.subjects_dir, args.freesurfer_home, args.subject_id, hemi,
+                  args.trgsubject, hemi_fsaverage_surf_output)
@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+"""
+Check the randomized / incremental PCA regressors of confound_signals.py against the exact PCA.
+
+Components are compared up to sign: each score column is flipped to the sign of
+the exact one, and the relative error ||s - s_exact|| / ||s_exact|| must be
+below the tolerance of its method.
+
+    check_confound_pca.py --synthetic
+    check_confound_pca.py --bold_file <bold.nii.gz> --mask <desc-brain_mask.nii.gz>
+"""
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+
+from confound_signals import PCA_COMPONENTS, extract_pca_regressors
+
+TOLERANCES = {'randomized': 1e-3, 'incremental': 1e-3}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DeepPrep: check the confound PCA regressors against the exact PCA')
+    parser.add_argument('--bold_file', help='BOLD series, e.g. the T1w space bold of bold_confounds.py')
+    parser.add_argument('--mask', help='brain mask on the BOLD grid, the PCA uses the voxels outside of it')
+    parser.add_argument('--pca_components', type=int, default=PCA_COMPONENTS)
+    parser.add_argument('--synthetic', default=False, action='store_true',
+                        help='Use a random low-rank series instead of --bold_file / --mask')
+    args = parser.parse_args()
+    if not args.synthetic and (args.bold_file is None or args.mask is None):
+        raise ValueError('Set --bold_file and --mask, or use --synthetic')
+    return args
+
+
+def make_synthetic(out_dir: Path, shape=(48, 56, 48), n_frames=300, rank=20, seed=0):
+    """
+    Out-of-brain signal of rank components with decaying variance plus noise, int16 with scaling as scanners write it
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(i) for i in shape], indexing='ij'))
+    radius = np.sqrt(((grid - np.array(shape)[:, None, None, None] / 2) ** 2).sum(0))
+    mask = (radius < min(shape) / 2 - 4).astype(np.uint8)
+
+    n_voxels = int(np.prod(shape))
+    # 成分的方差彼此分开且高于噪声，成分才是唯一确定的（至多差一个符号）
+    spatial = rng.normal(size=(n_voxels, rank)) * (0.85 ** np.arange(rank) * 40)
+    temporal = rng.normal(size=(rank, n_frames))
+    data = 1000 + spatial @ temporal + rng.normal(scale=5, size=(n_voxels, n_frames))
+    bold = nib.Nifti1Image(data.reshape(shape + (n_frames,)).astype(np.float32), np.eye(4))
+    bold.set_data_dtype(np.int16)
+    bold_file, mask_file = out_dir / 'bold.nii.gz', out_dir / 'mask.nii.gz'
+    nib.save(bold, bold_file)
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), mask_file)
+    return bold_file, mask_file
+
+
+def check(bold_file, mask_file, n_components):
+    tic = time.time()
+    exact = extract_pca_regressors(bold_file, mask_file, n_components, 'full')
+    print(f'full: {time.time() - tic:.2f}s')
+    ok = True
+    for method, tolerance in TOLERANCES.items():
+        tic = time.time()
+        scores = extract_pca_regressors(bold_file, mask_file, n_components, method)
+        seconds = time.time() - tic
+        signs = np.sign((scores * exact).sum(axis=0))
+        errors = np.linalg.norm(scores * signs - exact, axis=0) / np.linalg.norm(exact, axis=0)
+        ok = ok and bool(np.all(errors < tolerance))
+        print(f'{method}: {seconds:.2f}s, max relative error {errors.max():.2e} (tolerance {tolerance:g}), '
+              f'per component: {" ".join(f"{i:.1e}" for i in errors)}')
+    return ok
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            passed = check(*make_synthetic(Path(tmp_dir)), args.pca_components)
+    else:
+        passed = check(args.bold_file, args.mask, args.pca_components)
+    if not passed:
+        exit(1)
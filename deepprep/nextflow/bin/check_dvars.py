@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+"""
+Check the streamed standardized DVARS of confound_signals.py against nipype compute_dvars.
+
+Both are computed with remove_zerovariance, variance_tol and intensity normalization
+as ComputeDVARS uses them by default. The relative error |d - d_nipype| / d_nipype of
+every frame must be below the tolerance: the quartiles of the kept voxels come from a
+histogram and are exact only up to the interpolation inside one bin.
+
+    check_dvars.py --synthetic
+    check_dvars.py --bold_file <space-T1w_desc-preproc_bold.nii.gz> --mask <desc-brain_mask.nii.gz>
+
+The synthetic cases are Gaussian noise, a mask with binary low-signal voxels and a
+mask whose half is constant but for a few spikes.
+"""
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+from nipype.algorithms.confounds import compute_dvars
+
+from confound_signals import CHUNK_FRAMES, StdDVARS, load_mask, stream_bold
+
+TOLERANCE = 1e-2
+VARIANCE_TOL = 1e-7
+SYNTHETIC_CASES = ['gaussian', 'binary', 'spikes']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DeepPrep: check the streamed DVARS against nipype compute_dvars')
+    parser.add_argument('--bold_file', help='BOLD series, e.g. the T1w space bold of bold_averagesingnal.py')
+    parser.add_argument('--mask', help='brain mask on the BOLD grid')
+    parser.add_argument('--synthetic', default=False, action='store_true',
+                        help='Use the synthetic series instead of --bold_file / --mask')
+    args = parser.parse_args()
+    if not args.synthetic and (args.bold_file is None or args.mask is None):
+        raise ValueError('Set --bold_file and --mask, or use --synthetic')
+    return args
+
+
+def make_synthetic(out_dir: Path, case, shape=(32, 36, 32), n_frames=200, seed=0):
+    """
+    AR(1) noise around a smooth baseline inside a sphere; case changes part of the mask:
+      binary  a quarter of the voxels are 0 with an occasional 1, most of them have a zero IQR
+      spikes  half of the voxels are constant but for a few frames with a spike
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(i) for i in shape], indexing='ij'))
+    radius = np.sqrt(((grid - np.array(shape)[:, None, None, None] / 2) ** 2).sum(0))
+    mask = radius < min(shape) / 2 - 2
+
+    n_voxels = int(np.prod(shape))
+    noise = rng.normal(scale=10, size=(n_voxels, n_frames))
+    for i in range(1, n_frames):
+        noise[:, i] += 0.3 * noise[:, i - 1]
+    data = 800 + 400 * rng.random(size=(n_voxels, 1)) + noise
+
+    voxels = np.flatnonzero(mask.reshape(-1))
+    if case == 'binary':
+        binary = rng.choice(voxels, size=len(voxels) // 4, replace=False)
+        data[binary] = (rng.random(size=(len(binary), n_frames)) < 0.1).astype(float)
+    elif case == 'spikes':
+        constant = rng.choice(voxels, size=len(voxels) // 2, replace=False)
+        data[constant] = 1000
+        spikes = rng.choice(n_frames, size=5, replace=False)
+        data[np.ix_(constant, spikes)] += rng.normal(scale=200, size=(len(constant), len(spikes)))
+    elif case != 'gaussian':
+        raise ValueError(f'unknown synthetic case: {case}, choose from {SYNTHETIC_CASES}')
+
+    bold_file, mask_file = out_dir / f'{case}_bold.nii.gz', out_dir / f'{case}_mask.nii.gz'
+    nib.save(nib.Nifti1Image(data.reshape(shape + (n_frames,)).astype(np.float32), np.eye(4)), bold_file)
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), np.eye(4)), mask_file)
+    return bold_file, mask_file
+
+
+def check(bold_file, mask_file, name):
+    tic = time.time()
+    expected = compute_dvars(str(bold_file), str(mask_file), remove_zerovariance=True, variance_tol=VARIANCE_TOL)[0]
+    seconds_nipype = time.time() - tic
+
+    tic = time.time()
+    dvars = StdDVARS(load_mask(mask_file), variance_tol=VARIANCE_TOL)
+    stream_bold(bold_file, [dvars])
+    std_dvars = dvars.result(bold_file, CHUNK_FRAMES)
+    seconds = time.time() - tic
+
+    errors = np.abs(std_dvars - expected) / np.abs(expected)
+    ok = bool(np.all(errors < TOLERANCE))
+    print(f'{name}: nipype {seconds_nipype:.2f}s, streamed {seconds:.2f}s, max relative error {errors.max():.2e} '
+          f'(tolerance {TOLERANCE:g}), mean {errors.mean():.2e} {"OK" if ok else "FAIL"}')
+    return ok
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.synthetic:
+        passed = True
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for case in SYNTHETIC_CASES:
+                passed = check(*make_synthetic(Path(tmp_dir), case), case) and passed
+    else:
+        passed = check(args.bold_file, args.mask, Path(args.bold_file).name)
+    if not passed:
+        exit(1)
@@ -0,0 +1,134 @@
+#! /usr/bin/env python3
+"""
+Check the sparse surf2surf matrix of surf_resample.py against mri_surf2surf.
+
+The resampled values must match those of mri_surf2surf --mapmethod nnfr up to
+float32 precision. mri_surf2surf is taken from PATH; when it is not there the
+matrix is only checked against a plain loop version of its nnfr algorithm
+(forward hits, then reverse hits of the source vertices no target vertex hit).
+
+    check_surf_resample.py --synthetic
+    check_surf_resample.py --subjects_dir <subjects_dir> --subject_id sub-01 --hemi lh --trgsubject fsaverage6
+"""
+import os
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+from scipy.spatial import ConvexHull, cKDTree
+
+from surf_resample import nn_resample_matrix, read_sphere, average_radius, surf2surf
+
+TOLERANCE = 1e-4
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DeepPrep: check the sparse surf2surf matrix against mri_surf2surf')
+    parser.add_argument('--subjects_dir', help='subjects dir of --subject_id and --trgsubject')
+    parser.add_argument('--subject_id')
+    parser.add_argument('--hemi', default='lh')
+    parser.add_argument('--trgsubject', default='fsaverage6')
+    parser.add_argument('--synthetic', default=False, action='store_true',
+                        help='Use two random spheres instead of --subjects_dir / --subject_id')
+    args = parser.parse_args()
+    if not args.synthetic and (args.subjects_dir is None or args.subject_id is None):
+        raise ValueError('Set --subjects_dir and --subject_id, or use --synthetic')
+    return args
+
+
+def fibonacci_sphere(n_vertex, radius, jitter, rng):
+    index = np.arange(n_vertex) + 0.5
+    phi = np.arccos(1 - 2 * index / n_vertex)
+    theta = np.pi * (1 + 5 ** 0.5) * index + rng.uniform(0, 2 * np.pi)
+    xyz = np.stack([np.cos(theta) * np.sin(phi), np.sin(theta) * np.sin(phi), np.cos(phi)], axis=1)
+    # sphere.reg 的顶点并不严格在球面上
+    return xyz * (radius + rng.normal(scale=jitter, size=(n_vertex, 1)))
+
+
+def make_synthetic(subjects_dir: Path, hemi, n_src=30000, n_trg=10242, seed=0):
+    """
+    A dense source and a sparser target sphere.reg, as fsnative -> fsaverage5
+    """
+    rng = np.random.default_rng(seed)
+    for subject_id, n_vertex in [('src', n_src), ('trg', n_trg)]:
+        xyz = fibonacci_sphere(n_vertex, 100, 0.2, rng)
+        faces = ConvexHull(xyz).simplices.astype(np.int32)
+        surf_dir = subjects_dir / subject_id / 'surf'
+        surf_dir.mkdir(parents=True)
+        for surf in ['sphere.reg', 'white']:
+            nib.freesurfer.write_geometry(str(surf_dir / f'{hemi}.{surf}'), xyz, faces)
+    return 'src', 'trg'
+
+
+def reference_nnfr(src_xyz, trg_xyz, src_data):
+    """
+    mri_surf2surf nnfr written out vertex by vertex
+    """
+    trg_xyz = trg_xyz * (average_radius(src_xyz) / average_radius(trg_xyz))
+    src_tree, trg_tree = cKDTree(src_xyz), cKDTree(trg_xyz)
+    trg_sum = np.zeros((len(trg_xyz),) + src_data.shape[1:])
+    trg_hits = np.zeros(len(trg_xyz))
+    src_hit = np.zeros(len(src_xyz), dtype=bool)
+    for trg_vertex in range(len(trg_xyz)):
+        src_vertex = src_tree.query(trg_xyz[trg_vertex])[1]
+        trg_sum[trg_vertex] += src_data[src_vertex]
+        trg_hits[trg_vertex] += 1
+        src_hit[src_vertex] = True
+    for src_vertex in np.flatnonzero(~src_hit):
+        trg_vertex = trg_tree.query(src_xyz[src_vertex])[1]
+        trg_sum[trg_vertex] += src_data[src_vertex]
+        trg_hits[trg_vertex] += 1
+    return trg_sum / np.maximum(trg_hits, 1)[:, None]
+
+
+def run_mri_surf2surf(subjects_dir: Path, subject_id, hemi, trgsubject, src_data, out_dir: Path):
+    src_file, trg_file = out_dir / 'src.mgh', out_dir / 'trg.mgh'
+    nib.save(nib.MGHImage(src_data.reshape(len(src_data), 1, 1, -1), np.eye(4)), src_file)
+    cmd = ['mri_surf2surf', '--hemi', hemi, '--srcsubject', subject_id, '--trgsubject', trgsubject,
+           '--sval', str(src_file), '--tval', str(trg_file), '--mapmethod', 'nnfr']
+    subprocess.run(cmd, check=True, env=dict(os.environ, SUBJECTS_DIR=str(subjects_dir)))
+    trg_data = np.asanyarray(nib.load(trg_file).dataobj)
+    return trg_data.reshape(trg_data.shape[0], -1)
+
+
+def relative_error(data, expected):
+    return float(np.abs(data - expected).max() / np.abs(expected).max())
+
+
+def check(subjects_dir: Path, subject_id, hemi, trgsubject, n_frames=3, seed=0):
+    src_xyz = read_sphere(subjects_dir / subject_id / 'surf' / f'{hemi}.sphere.reg')
+    trg_xyz = read_sphere(subjects_dir / trgsubject / 'surf' / f'{hemi}.sphere.reg')
+    src_data = np.random.default_rng(seed).normal(size=(len(src_xyz), n_frames)).astype(np.float32)
+    trg_data = surf2surf(nn_resample_matrix(src_xyz, trg_xyz, 'nnfr'), src_data)
+
+    ok = True
+    error = relative_error(trg_data, reference_nnfr(src_xyz, trg_xyz, src_data))
+    ok = ok and error < TOLERANCE
+    print(f'reference nnfr: max relative error {error:.2e} (tolerance {TOLERANCE:g})')
+    if shutil.which('mri_surf2surf') is None:
+        print('mri_surf2surf not found in PATH, skip the comparison against FreeSurfer')
+        return ok
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        expected = run_mri_surf2surf(subjects_dir, subject_id, hemi, trgsubject, src_data, Path(tmp_dir))
+    error = relative_error(trg_data, expected)
+    ok = ok and error < TOLERANCE
+    print(f'mri_surf2surf: max relative error {error:.2e} (tolerance {TOLERANCE:g}), '
+          f'{int(np.sum(np.abs(trg_data - expected).max(axis=1) > TOLERANCE))} vertices differ')
+    return ok
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.synthetic:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            subjects_dir = Path(tmp_dir)
+            subject_id, trgsubject = make_synthetic(subjects_dir, args.hemi)
+            passed = check(subjects_dir, subject_id, args.hemi, trgsubject)
+    else:
+        passed = check(Path(args.subjects_dir), args.subject_id, args.hemi, args.trgsubject)
+    if not passed:
+        exit(1)
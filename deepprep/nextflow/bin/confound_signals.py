@@ -0,0 +1,455 @@
+#! /usr/bin/env python3
+"""
+Single-pass confound signal extraction.
+
+The BOLD series is read once, frame chunk by frame chunk (float32 when the
+stored values allow it), and every
+chunk is handed to all consumers (ROI means, ...) instead of loading the full
+4D series as float64 once per ROI.
+
+ROI means use one sparse (n_roi x n_voxel) averaging matrix over the union of
+the ROI voxels, so overlapping masks (brain / white matter / ventricles) are
+reduced together with a single matrix product per chunk.
+
+The PCA regressors of the out-of-brain voxels (frames are the samples) use
+  randomized   the out-of-brain voxels are gathered as float32 during the pass
+               and decomposed with a randomized SVD (default)
+  incremental  IncrementalPCA is fitted chunk by chunk, a second pass projects
+               the frames; memory does not grow with the number of frames
+  full         exact SVD in float64, the reference of the other two
+
+The QC time series of bold_averagesingnal.py (global signal, ROI means,
+standardized DVARS) and the tSNR maps of the QC figures come from the same
+kind of pass with per-voxel state only, the framewise displacement from the
+motion parameters.
+"""
+import os
+
+import numpy as np
+import nibabel as nib
+from numpy.polynomial import Legendre
+from scipy import sparse
+from sklearn.decomposition import PCA, IncrementalPCA
+
+# 每次读入的帧数：2mm 全脑约 1.5 MB / 帧 (float32)
+CHUNK_FRAMES = 32
+PCA_COMPONENTS = 10
+# incremental PCA 每批之后只保留 n_components + PCA_OVERSAMPLES 个成分，多保留的成分减少截断误差
+PCA_OVERSAMPLES = 10
+PCA_METHODS = ['randomized', 'incremental', 'full']
+# DVARS：每个体素时间序列四分位数的直方图 bin 数（4 的倍数）
+DVARS_HIST_BINS = 128
+# DVARS：直方图给出的 IQR 下界不足 variance_tol 的这个倍数时，重新读取该体素的序列计算精确的四分位数
+DVARS_TOL_MARGIN = 1e3
+
+
+def load_mask(mask_file):
+    """
+    voxels > 0, flattened in C order (same as get_fdata().flatten())
+    """
+    mask = np.asanyarray(nib.load(os.fspath(mask_file)).dataobj).reshape(-1) > 0
+    assert mask.sum() > 0, 'Null mask found in %s' % mask_file
+    return mask
+
+
+def get_chunk_dtype(img):
+    """
+    float32 if the stored values are exact in float32 (float32 / small int without scaling), else float64
+    """
+    dtype = img.get_data_dtype()
+    slope = getattr(img.dataobj, 'slope', 1.)
+    inter = getattr(img.dataobj, 'inter', 0.)
+    if slope != 1. or inter != 0.:
+        # 在 float32 下做缩放会改变结果的末位
+        return np.float64
+    if dtype == np.float32 or (np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2):
+        return np.float32
+    return np.float64
+
+
+def iter_frame_chunks(bold_file, chunk_frames=CHUNK_FRAMES):
+    """
+    yield (start frame, (n_voxel, n_chunk_frames) float32 / float64), voxels in C order
+    """
+    # keep_file_open: 顺序读取 .nii.gz 时不必每个 chunk 都从文件头重新解压
+    img = nib.load(os.fspath(bold_file), keep_file_open=True)
+    dtype = get_chunk_dtype(img)
+    n_frames = img.shape[3] if len(img.shape) > 3 else 1
+    n_voxels = int(np.prod(img.shape[:3]))
+    for start in range(0, n_frames, chunk_frames):
+        stop = min(start + chunk_frames, n_frames)
+        if len(img.shape) > 3:
+            chunk = np.asarray(img.dataobj[..., start:stop], dtype=dtype)
+        else:
+            chunk = np.asarray(img.dataobj, dtype=dtype)[..., None]
+        yield start, chunk.reshape(n_voxels, stop - start)
+
+
+class ROIMeans(object):
+    """
+    Mean signal of several (possibly overlapping) ROIs per frame.
+    """
+
+    def __init__(self, masks: dict):
+        self.names = list(masks.keys())
+        masks = np.stack([masks[name] for name in self.names])
+        self.voxels = np.flatnonzero(masks.any(axis=0))
+        roi_masks = masks[:, self.voxels]
+        weights = roi_masks / roi_masks.sum(axis=1, keepdims=True)
+        self.matrix = sparse.csr_matrix(weights)
+        self.means = list()
+
+    def update(self, start, chunk):
+        # float64 累加，与原来 float64 下的求和一致
+        self.means.append(self.matrix @ chunk[self.voxels].astype(np.float64))
+
+    def result(self):
+        means = np.hstack(self.means)
+        return {name: means[i] for i, name in enumerate(self.names)}
+
+
+class OutOfMaskPCA(object):
+    """
+    PCA scores (n_frames, n_components) of the voxels outside a mask.
+    """
+
+    def __init__(self, mask, n_components=PCA_COMPONENTS, method='randomized'):
+        if method not in PCA_METHODS:
+            raise ValueError(f'unknown PCA method: {method}, choose from {PCA_METHODS}')
+        self.voxels = np.flatnonzero(~mask)
+        assert len(self.voxels) > 0, 'Null out of mask region found'
+        self.n_components = n_components
+        self.method = method
+        self.rows = list()
+        self.pca = IncrementalPCA(n_components=n_components + PCA_OVERSAMPLES) if method == 'incremental' else None
+        self.pending = None
+
+    def update(self, start, chunk):
+        rows = chunk[self.voxels].T
+        if self.method != 'incremental':
+            self.rows.append(rows)
+        elif self.pending is None:
+            self.pending = rows
+        elif len(self.pending) >= self.pca.n_components and len(rows) >= self.pca.n_components:
+            self.pca.partial_fit(self.pending)
+            self.pending = rows
+        else:
+            # partial_fit 每批的帧数不少于成分数，不足的批次并入上一批
+            self.pending = np.vstack([self.pending, rows])
+
+    def finish(self):
+        if self.method == 'incremental':
+            self.pca.partial_fit(self.pending)
+            self.pending = None
+
+    def result(self, bold_file=None, chunk_frames=CHUNK_FRAMES):
+        """
+        bold_file: read again to project the frames with the incremental PCA
+        """
+        if self.method == 'incremental':
+            return np.vstack([self.pca.transform(chunk[self.voxels].T)[:, :self.n_components]
+                              for _, chunk in iter_frame_chunks(bold_file, chunk_frames)])
+        data, self.rows = np.vstack(self.rows), list()
+        if self.method == 'full':
+            pca = PCA(n_components=self.n_components, svd_solver='full')
+            return pca.fit_transform(data.astype(np.float64))
+        pca = PCA(n_components=self.n_components, svd_solver='randomized', random_state=0)
+        return pca.fit_transform(data)
+
+
+class StdDVARS(object):
+    """
+    Standardized DVARS (Nichols 2013) as nipype ComputeDVARS computes it (out_std, remove_zerovariance, "lower"
+    quartiles), from per-voxel running state instead of the voxel x frame matrix:
+      - lag-0 / lag-1 sums of the voxel series (shifted by the first frame) give the AR(1) coefficient,
+      - the squared frame differences are summed per frame,
+      - the quartiles of the voxel series are read from a per-voxel histogram whose bins double in width when
+        a value falls outside; they are exact up to the interpolation inside one bin.
+    Voxels whose robust SD may be within DVARS_TOL_MARGIN of variance_tol (e.g. binary or mostly constant
+    series) are read again in result(): their quartiles are computed exactly, in float32 as nipype does, and
+    the frame differences of the removed ones are taken out of the per-frame sums.
+    The intensity normalization of nipype scales numerator and denominator alike and cancels out; it only
+    enters the variance_tol test, with the median of the frame medians for the median of all values.
+    """
+
+    def __init__(self, mask, n_bins=DVARS_HIST_BINS, variance_tol=1e-7, intensity_normalization=1000.):
+        self.voxels = np.flatnonzero(mask)
+        self.n_bins = n_bins
+        self.variance_tol = variance_tol
+        self.intensity_normalization = intensity_normalization
+        self.n = 0
+        self.first = None
+        self.diff_sq = list()
+        self.frame_medians = list()
+
+    def _init_state(self, y):
+        n_voxels = len(self.voxels)
+        self.sum, self.sum_sq, self.sum_lag = np.zeros(n_voxels), np.zeros(n_voxels), np.zeros(n_voxels)
+        self.min, self.max = np.full(n_voxels, np.inf), np.full(n_voxels, -np.inf)
+        self.last = np.zeros(n_voxels)
+        # 第一块数据决定初始 bin 宽度：覆盖 ±2 倍的最大偏离
+        spread = np.abs(y).max(axis=1)
+        tiny = np.maximum(np.abs(self.first), 1.) * np.finfo(np.float32).eps
+        self.width = np.maximum(spread * 4 / self.n_bins, tiny)
+        # uint16 计数：每个体素 2 * n_bins 字节，最多 65535 帧
+        self.counts = np.zeros((n_voxels, self.n_bins), dtype=np.uint16)
+
+    def _bin(self, values, rows=slice(None)):
+        return np.floor(values / self.width[rows]).astype(np.int64) + self.n_bins // 2
+
+    def _double_width(self, rows):
+        pairs = self.counts[rows].reshape(len(rows), self.n_bins // 2, 2).sum(axis=2)
+        counts = np.zeros((len(rows), self.n_bins), dtype=self.counts.dtype)
+        counts[:, self.n_bins // 4:self.n_bins // 4 + self.n_bins // 2] = pairs
+        self.counts[rows] = counts
+        self.width[rows] *= 2
+
+    def _add_frame(self, values):
+        bins = self._bin(values)
+        outside = np.flatnonzero((bins < 0) | (bins >= self.n_bins))
+        while len(outside) > 0:
+            self._double_width(outside)
+            bins[outside] = self._bin(values[outside], outside)
+            outside = outside[(bins[outside] < 0) | (bins[outside] >= self.n_bins)]
+        self.counts[np.arange(len(bins)), bins] += 1
+
+    def update(self, start, chunk):
+        data = chunk[self.voxels].astype(np.float64)
+        self.frame_medians.extend(np.median(data, axis=0))
+        if self.first is None:
+            self.first = data[:, 0].copy()
+            y = data - self.first[:, None]
+            self._init_state(y)
+            series = y
+        else:
+            y = data - self.first[:, None]
+            series = np.hstack([self.last[:, None], y])
+        self.sum += y.sum(axis=1)
+        self.sum_sq += np.square(y).sum(axis=1)
+        self.sum_lag += (series[:, 1:] * series[:, :-1]).sum(axis=1)
+        self.diff_sq.extend(np.square(np.diff(series, axis=1)).sum(axis=0))
+        self.min = np.minimum(self.min, y.min(axis=1))
+        self.max = np.maximum(self.max, y.max(axis=1))
+        self.last = y[:, -1].copy()
+        assert self.n + y.shape[1] <= np.iinfo(self.counts.dtype).max, 'too many frames for the DVARS histogram'
+        for i in range(y.shape[1]):
+            self._add_frame(y[:, i])
+        self.n += y.shape[1]
+
+    def quantile_bins(self, q):
+        """
+        bins of the histogram holding the q quantile, and its value interpolated inside the bin
+        """
+        # numpy percentile(method='lower')：排序后第 floor(q * (n - 1)) 个值
+        rank = int(np.floor(q * (self.n - 1)))
+        cumsum = np.cumsum(self.counts, axis=1)
+        bins = np.argmax(cumsum > rank, axis=1)
+        rows = np.arange(len(bins))
+        below = cumsum[rows, bins] - self.counts[rows, bins]
+        position = (rank - below + 0.5) / self.counts[rows, bins]
+        values = (bins - self.n_bins // 2 + position) * self.width
+        return bins, np.clip(values, self.min, self.max)
+
+    def quantile(self, q):
+        return self.quantile_bins(q)[1]
+
+    def exact_func_sd(self, rows, median, bold_file, chunk_frames):
+        """
+        Robust SD of the voxels rows, whether nipype keeps them (in float32 as compute_dvars) and the per-frame
+        sums of the squared differences of the removed ones, from their full series read again
+        """
+        voxels = self.voxels[rows]
+        series = np.hstack([chunk[voxels] for _, chunk in iter_frame_chunks(bold_file, chunk_frames)])
+        func_sd = (np.percentile(series, 75, axis=1, method='lower') -
+                   np.percentile(series, 25, axis=1, method='lower')) / 1.349
+        normalized = series.astype(np.float32)
+        if self.intensity_normalization:
+            normalized = (normalized / np.float32(median)) * np.float32(self.intensity_normalization)
+        normalized_sd = (np.percentile(normalized, 75, axis=1, method='lower') -
+                         np.percentile(normalized, 25, axis=1, method='lower')) / 1.349
+        keep = normalized_sd > self.variance_tol
+        removed = series[~keep].astype(np.float64)
+        return func_sd, keep, np.square(np.diff(removed, axis=1)).sum(axis=0)
+
+    def result(self, bold_file=None, chunk_frames=CHUNK_FRAMES):
+        """
+        bold_file: read again for the voxels close to the variance_tol, needed only if there are such voxels
+        """
+        bins_25, q_25 = self.quantile_bins(0.25)
+        bins_75, q_75 = self.quantile_bins(0.75)
+        func_sd = (q_75 - q_25) / 1.349
+        median = np.median(self.frame_medians)
+        scale = self.intensity_normalization / median if self.intensity_normalization else 1.
+        # 常数体素的 IQR 与帧差都为 0
+        keep = self.max > self.min
+        diff_sq = np.asarray(self.diff_sq)
+        # 两个四分位数所在 bin 之间至少隔着 (bins_75 - bins_25 - 1) 个 bin 宽度
+        sd_lower = np.maximum(bins_75 - bins_25 - 1, 0) * self.width / 1.349
+        rows = np.flatnonzero(keep & (sd_lower * scale <= self.variance_tol * DVARS_TOL_MARGIN))
+        if len(rows) > 0:
+            if bold_file is None:
+                raise ValueError(f'{len(rows)} voxels have a robust SD close to variance_tol, '
+                                 f'set bold_file to compute them exactly')
+            func_sd[rows], keep[rows], removed_diff_sq = self.exact_func_sd(rows, median, bold_file, chunk_frames)
+            diff_sq = diff_sq - removed_diff_sq
+
+        n = self.n
+        mean = self.sum[keep] / n
+        r0 = self.sum_sq[keep] - n * mean ** 2
+        r1 = self.sum_lag[keep] - mean * (2 * self.sum[keep] - self.last[keep]) + (n - 1) * mean ** 2
+        ar1 = r1 / r0
+        diff_sd_mean = (np.sqrt((1 - ar1) * 2) * func_sd[keep]).mean()
+        # diff_sq 中只剩保留的体素（移除的常数体素帧差为 0）
+        dvars_nstd = np.sqrt(np.maximum(diff_sq, 0) / keep.sum())
+        return dvars_nstd / diff_sd_mean
+
+
+class TemporalSNR(object):
+    """
+    Voxel-wise temporal mean, standard deviation and tSNR as nipype TSNR computes them.
+    Mean and variance are merged chunk by chunk (Welford / Chan). With regress_poly the polynomials up to that
+    degree (not the mean) are removed first, as TSNR(regress_poly=...): only the projections of the voxel series
+    onto the precomputed Legendre design are accumulated.
+    """
+
+    def __init__(self, n_frames, regress_poly=None):
+        self.n_frames = n_frames
+        self.n = 0
+        self.mean = self.m2 = None
+        self.design = None
+        if regress_poly:
+            # 与 nipype regress_poly 相同的设计矩阵：常数列 + 1..degree 阶 Legendre 多项式
+            value_array = np.linspace(-1, 1, n_frames)
+            self.design = np.column_stack([np.ones(n_frames)] + [Legendre.basis(i + 1)(value_array)
+                                                                 for i in range(regress_poly)])
+            self.first = self.sum_sq = self.projection = None
+
+    def update(self, start, chunk):
+        data = np.nan_to_num(chunk).astype(np.float64)
+        if self.design is not None:
+            self._update_projection(start, data)
+            return
+        n_chunk = data.shape[1]
+        mean = data.mean(axis=1)
+        m2 = np.square(data - mean[:, None]).sum(axis=1)
+        if self.mean is None:
+            self.mean, self.m2 = mean, m2
+        else:
+            n = self.n + n_chunk
+            delta = mean - self.mean
+            self.mean = self.mean + delta * (n_chunk / n)
+            self.m2 = self.m2 + m2 + np.square(delta) * (self.n * n_chunk / n)
+        self.n += n_chunk
+
+    def _update_projection(self, start, data):
+        if self.first is None:
+            # 减去第一帧以免平方和的抵消误差；平移只落在常数列上，不改变多项式系数
+            self.first = data[:, 0].copy()
+            self.sum_sq = np.zeros(len(self.first))
+            self.projection = np.zeros((self.design.shape[1], len(self.first)))
+        y = data - self.first[:, None]
+        self.sum_sq += np.square(y).sum(axis=1)
+        self.projection += self.design[start:start + y.shape[1]].T @ y.T
+        self.n += y.shape[1]
+
+    def finish(self):
+        if self.design is None:
+            return
+        x1 = self.design[:, 1:]
+        betas = np.linalg.solve(self.design.T @ self.design, self.projection)[1:]
+        # 去趋势后 d = y - x1 @ betas 的一阶、二阶矩
+        sum_d = self.projection[0] - x1.sum(axis=0) @ betas
+        sum_sq_d = (self.sum_sq - 2 * (betas * self.projection[1:]).sum(axis=0)
+                    + (betas * (x1.T @ x1 @ betas)).sum(axis=0))
+        mean = sum_d / self.n
+        self.mean = mean + self.first
+        self.m2 = np.maximum(sum_sq_d - self.n * np.square(mean), 0)
+
+    def result(self):
+        """
+        mean, std (ddof=0) and tSNR (0 where std <= 1e-3) of every voxel
+        """
+        std = np.sqrt(self.m2 / self.n)
+        tsnr = np.zeros_like(self.mean)
+        nonzero = std > 1.0e-3
+        tsnr[nonzero] = self.mean[nonzero] / std[nonzero]
+        return self.mean, std, tsnr
+
+
+def compute_tsnr(bold_file, regress_poly=None, chunk_frames=CHUNK_FRAMES):
+    """
+    return: tSNR volume, the BOLD image (header only, the data is streamed)
+    """
+    img = nib.load(os.fspath(bold_file))
+    tsnr = TemporalSNR(img.shape[3] if len(img.shape) > 3 else 1, regress_poly)
+    stream_bold(bold_file, [tsnr], chunk_frames)
+    return tsnr.result()[2].reshape(img.shape[:3]), img
+
+
+def framewise_displacement(mcpar_file, radius=50.):
+    """
+    Power 2012 FD of FSL motion parameters (rx ry rz tx ty tz), as nipype FramewiseDisplacement
+    """
+    mpars = np.loadtxt(mcpar_file)[:, [3, 4, 5, 0, 1, 2]]
+    diff = mpars[:-1, :6] - mpars[1:, :6]
+    diff[:, 3:6] *= radius
+    return np.abs(diff).sum(axis=1)
+
+
+def stream_bold(bold_file, consumers, chunk_frames=CHUNK_FRAMES):
+    for start, chunk in iter_frame_chunks(bold_file, chunk_frames):
+        for consumer in consumers:
+            consumer.update(start, chunk)
+    for consumer in consumers:
+        if hasattr(consumer, 'finish'):
+            consumer.finish()
+
+
+def extract_roi_means(bold_file, mask_files: dict, chunk_frames=CHUNK_FRAMES):
+    """
+    mask_files: name -> mask file on the BOLD grid
+    return: name -> (n_frames,) mean signal
+    """
+    roi_means = ROIMeans({name: load_mask(mask_file) for name, mask_file in mask_files.items()})
+    stream_bold(bold_file, [roi_means], chunk_frames)
+    return roi_means.result()
+
+
+def extract_confound_signals(bold_file, mask_files: dict, pca_mask_file, n_components=PCA_COMPONENTS,
+                             pca_method='randomized', chunk_frames=CHUNK_FRAMES):
+    """
+    ROI means (as extract_roi_means) and the PCA regressors of the voxels outside pca_mask_file,
+    from a single pass over the BOLD series (two for the incremental PCA).
+    """
+    roi_means = ROIMeans({name: load_mask(mask_file) for name, mask_file in mask_files.items()})
+    pca = OutOfMaskPCA(load_mask(pca_mask_file), n_components, pca_method)
+    stream_bold(bold_file, [roi_means, pca], chunk_frames)
+    return roi_means.result(), pca.result(bold_file, chunk_frames)
+
+
+def extract_pca_regressors(bold_file, mask_file, n_components=PCA_COMPONENTS, method='randomized',
+                           chunk_frames=CHUNK_FRAMES):
+    pca = OutOfMaskPCA(load_mask(mask_file), n_components, method)
+    stream_bold(bold_file, [pca], chunk_frames)
+    return pca.result(bold_file, chunk_frames)
+
+
+def write_pca_regressor(scores, outpath):
+    """
+    one line per frame, formatted as regressors_PCA
+    """
+    with outpath.open('w') as f:
+        for row in scores:
+            for value in row:
+                f.write('%10.4f\t' % value)
+            f.write('\n')
+
+
+def write_roi_regressor(signal, outpath):
+    """
+    signal and its backward difference, formatted as qnt_nifti
+    """
+    diff = np.concatenate([[0.], np.diff(signal)])
+    with outpath.open('w') as f:
+        for q, d in zip(signal, diff):
+            f.write('%10.4f\t%10.4f\n' % (q, d))
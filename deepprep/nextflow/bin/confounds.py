@@ -44,9 +44,14 @@ from nipype.interfaces.base import (
 )
 from nipype.utils.filemanip import fname_presuffix
 from niworkflows.utils.timeseries import _cifti_timeseries
-from niworkflows.viz.plots import fMRIPlot
+from niworkflows.viz.plots import fMRIPlot, confoundplot, plot_carpet
+
+from confound_signals import iter_frame_chunks
 
 LOGGER = logging.getLogger('nipype.interface')
+# Maximum number of carpet samples (voxels, timepoints), as in niworkflows' plot_carpet
+CARPET_SIZE = (900, 1200)
+
 
 def _nifti_timeseries(
     dataset,
@@ -62,6 +67,17 @@ def _nifti_timeseries(
     if segmentation is None:
         return data, None
 
+    fgmask, seg_dict = _segment_voxels(segmentation, labels=labels, remap_rois=remap_rois, lut=lut)
+    return data[fgmask], seg_dict
+
+
+def _segment_voxels(
+    segmentation,
+    labels=("Ctx GM", "dGM", "WM+CSF", "Cb", "Crown", "RHM"),
+    remap_rois=False,
+    lut=None,
+):
+    """Foreground mask of a segmentation and the indices of each segment within the foreground."""
     # Open NIfTI and extract numpy array
     segmentation = nb.load(segmentation) if isinstance(segmentation, str) else segmentation
     segmentation = np.asanyarray(segmentation.dataobj, dtype=int).reshape(-1)
@@ -85,7 +101,84 @@ def _nifti_timeseries(
     for i in np.unique(segmentation):
         seg_dict[labels[i - 1]] = np.argwhere(segmentation == i).squeeze()
 
-    return data[fgmask], seg_dict
+    return fgmask, seg_dict
+
+
+def _carpet_timeseries(
+    dataset,
+    segmentation,
+    labels=("Ctx GM", "dGM", "WM+CSF", "Cb", "Crown", "RHM"),
+    tr=None,
+    drop_trs=0,
+    size=CARPET_SIZE,
+):
+    """
+    Decimated carpet data, with a cost bounded by ``size`` instead of the dataset size.
+
+    The voxels of every segment are sampled with the stride plot_carpet would decimate the
+    rows by, and only those are read from the streamed BOLD frames. Each sampled timeseries
+    is detrended and standardized at full temporal resolution, then the timepoints are
+    averaged in bins as wide as the stride plot_carpet would decimate the columns by.
+
+    Returns the (rows x bins) data, the segments as row indices, and the number of
+    timepoints per bin.
+    """
+    from nilearn.signal import clean
+
+    fgmask, seg_dict = _segment_voxels(segmentation, labels=labels, remap_rois=False)
+    fg_voxels = np.flatnonzero(fgmask)
+
+    # Stratified decimation: the same stride for every tissue class
+    n_dec = int((1.8 * len(fg_voxels)) // size[0])
+    segments = {}
+    rows = []
+    for label, idx in seg_dict.items():
+        idx = np.atleast_1d(idx)[::max(n_dec, 1)]
+        segments[label] = np.arange(len(idx)) + sum(len(i) for i in rows)
+        rows.append(idx)
+    voxels = fg_voxels[np.concatenate(rows)]
+
+    data = np.hstack([chunk[voxels].astype(np.float32) for _, chunk in iter_frame_chunks(dataset)])
+    data = clean(data.T, t_r=None if tr is None else float(tr), filter=False).T
+
+    n_trs = data.shape[-1] - drop_trs
+    t_dec = max(int((1.8 * n_trs) // size[1]), 1)
+    starts = np.arange(drop_trs, data.shape[-1], t_dec)
+    counts = np.diff(np.append(starts, data.shape[-1]))
+    data = np.add.reduceat(data, starts, axis=1) / counts
+    return data, segments, n_trs / data.shape[-1]
+
+
+def _plot_summary(data, segments, confounds, units, tr=None, drop_trs=0, trs_per_column=1.):
+    """
+    fMRIPlot.plot for carpet data that is already detrended and binned in time.
+    """
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    from matplotlib import gridspec as mgs
+
+    sns.set_style('whitegrid')
+    sns.set_context('paper', font_scale=0.8)
+    figure = plt.gcf()
+
+    nconfounds = 0 if confounds is None else len(confounds.columns)
+    grid = mgs.GridSpec(nconfounds + 1, 1, wspace=0.0, hspace=0.05, height_ratios=[1] * nconfounds + [5])
+    if nconfounds:
+        palette = sns.color_palette('husl', nconfounds)
+        for i, name in enumerate(confounds.columns):
+            confoundplot(confounds[[name]].values.squeeze().tolist(), grid[i], tr=tr, color=palette[i],
+                         name=name, units=units.get(name))
+
+    plot_carpet(data, segments=segments, subplot=grid[-1], tr=tr, detrend=False, sort_rows=True)
+
+    # plot_carpet labels the columns, relabel them with the timepoints they stand for
+    ax = [ax for ax in figure.axes if ax.images][-1]
+    xticks = ax.get_xticks()
+    xticklabels = (xticks * trs_per_column).astype('uint32') + drop_trs
+    if tr is not None:
+        xticklabels = [f'{int(t // 60):02d}:{(t % 60).round(0).astype(int):02d}' for t in (tr * xticklabels)]
+    ax.set_xticklabels(xticklabels)
+    return figure
 
 
 
@@ -128,17 +221,16 @@ class FMRISummary(SimpleInterface):
 
         # Read input object and create timeseries + segments object
         seg_file = self.inputs.in_segm if isdefined(self.inputs.in_segm) else None
-        dataset, segments = _nifti_timeseries(
-            nb.load(self.inputs.in_nifti),
-            nb.load(seg_file),
-            remap_rois=False,
-            labels=(
-                ("WM+CSF", "Edge") if has_cifti else ("Ctx GM", "dGM", "WM+CSF", "The rest", "Edge", "RHM")
-            ),
-        )
+        labels = ("WM+CSF", "Edge") if has_cifti else ("Ctx GM", "dGM", "WM+CSF", "The rest", "Edge", "RHM")
 
         # Process CIFTI
         if has_cifti:
+            dataset, segments = _nifti_timeseries(
+                nb.load(self.inputs.in_nifti),
+                nb.load(seg_file),
+                remap_rois=False,
+                labels=labels,
+            )
             cifti_data, cifti_segments = _cifti_timeseries(nb.load(self.inputs.in_cifti))
 
             if seg_file is not None:
@@ -188,14 +280,33 @@ class FMRISummary(SimpleInterface):
 
         data.columns = colnames
 
-        fig = fMRIPlot(
-            dataset,
-            segments=segments,
-            tr=self.inputs.tr,
-            confounds=data,
-            units=units,
-            nskip=self.inputs.drop_trs,
-            paired_carpet=has_cifti,
-        ).plot()
+        if has_cifti:
+            fig = fMRIPlot(
+                dataset,
+                segments=segments,
+                tr=self.inputs.tr,
+                confounds=data,
+                units=units,
+                nskip=self.inputs.drop_trs,
+                paired_carpet=has_cifti,
+            ).plot()
+        else:
+            # Only the decimated carpet rows are read, see _carpet_timeseries
+            dataset, segments, trs_per_column = _carpet_timeseries(
+                self.inputs.in_nifti,
+                seg_file,
+                labels=labels,
+                tr=self.inputs.tr,
+                drop_trs=self.inputs.drop_trs,
+            )
+            fig = _plot_summary(
+                dataset,
+                segments,
+                data,
+                units,
+                tr=self.inputs.tr,
+                drop_trs=self.inputs.drop_trs,
+                trs_per_column=trs_per_column,
+            )
         fig.savefig(self._results["out_file"], bbox_inches="tight")
         return runtime
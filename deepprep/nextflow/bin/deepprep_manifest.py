@@ -0,0 +1,276 @@
+#! /usr/bin/env python3
+"""
+Content-hash manifest of DeepPrep derivatives, for incremental reprocessing.
+
+Nextflow's -resume cache is lost when the work directory is cleaned or a path
+changes. This wrapper records, next to the derivatives, what produced them:
+the content hashes (sha256) of the inputs and tools (scripts, models), the
+parameters and the hashes of the outputs. When the manifest of a rerun
+matches and the outputs are still there unchanged, the command is skipped.
+
+    deepprep_manifest.py --manifest <subject>/scripts/manifest/<stage>.json \
+        --input orig=<orig.mgz> --script script=<fastcsr_model_infer.py> --tool model=<model.pth> \
+        --param hemi=lh --output levelset=<lh_levelset.nii.gz> \
+        -- <command> <args> ...
+
+A --script is recorded as a tool together with every module it imports from its
+own directory tree (as `python3 <script>` resolves them, recursively), so an
+edit of a helper module also invalidates the manifest.
+
+Inputs, tools and outputs are named by role, so moving a dataset (other paths,
+same contents) still matches. Hashes are reused from the previous manifest
+while a file keeps its path, size and mtime, so unchanged files are not read again.
+"""
+import os
+import sys
+import json
+import time
+import ast
+import hashlib
+import argparse
+import subprocess
+from pathlib import Path
+
+MANIFEST_VERSION = 1
+
+
+def hash_file(file_path, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def list_files(path: Path):
+    if path.is_dir():
+        return sorted(i for i in path.rglob('*') if i.is_file())
+    return [path]
+
+
+def get_stamp(path: Path):
+    """
+    cheap change detector: (relative path, size, mtime) of every file
+    """
+    stamp = list()
+    for file_path in list_files(path):
+        stat = file_path.stat()
+        stamp.append([os.path.relpath(file_path, path) if path.is_dir() else '', stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(stamp).encode()).hexdigest()
+
+
+def describe(path, previous=None):
+    """
+    {'path', 'stamp', 'sha256'} of a file or directory; the hash of previous is reused if path and stamp are unchanged
+    """
+    path = Path(path).absolute()
+    if not path.exists():
+        return None
+    stamp = get_stamp(path)
+    if previous is not None and previous.get('path') == str(path) and previous.get('stamp') == stamp:
+        sha256 = previous['sha256']
+    elif path.is_dir():
+        content = [[os.path.relpath(i, path), hash_file(i)] for i in list_files(path)]
+        sha256 = hashlib.sha256(json.dumps(content).encode()).hexdigest()
+    else:
+        sha256 = hash_file(path)
+    return {'path': str(path), 'stamp': stamp, 'sha256': sha256}
+
+
+def hash_file_stamped(file_path, stamp_dir: Path):
+    """
+    sha256 of file_path, reused from its record in stamp_dir while its path, size and mtime are unchanged
+    """
+    file_path = Path(file_path)
+    stamp_file = stamp_dir / f'{hashlib.sha1(str(file_path.absolute()).encode()).hexdigest()}.json'
+    previous = None
+    if stamp_file.exists():
+        try:
+            with open(stamp_file) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = None
+    current = describe(file_path, previous)
+    if current is None:
+        raise FileNotFoundError(f'file not found: {file_path}')
+    if current != previous:
+        stamp_dir.mkdir(parents=True, exist_ok=True)
+        tmp_file = stamp_dir / f'{stamp_file.name}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(current, f)
+        tmp_file.replace(stamp_file)
+    return current['sha256']
+
+
+def find_module(root: Path, parts):
+    for module_file in [root.joinpath(*parts).with_suffix('.py'), root.joinpath(*parts, '__init__.py')]:
+        if parts and module_file.is_file():
+            return module_file
+    return None
+
+
+def imported_modules(module_file: Path, root: Path):
+    """
+    files under root of the modules imported by module_file (not recursive)
+    """
+    try:
+        tree = ast.parse(module_file.read_text(), str(module_file))
+    except (SyntaxError, UnicodeDecodeError):
+        return set()
+    package = module_file.parent.relative_to(root).parts
+    found = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name.split('.') for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            # 相对 import 以当前模块所在的 package 为起点
+            base = list(package[:len(package) - node.level + 1]) if node.level else []
+            base += node.module.split('.') if node.module else []
+            # from a import b 中 b 可能是子模块
+            names = [base] + [base + [alias.name] for alias in node.names]
+        else:
+            continue
+        for name in names:
+            # import a.b.c 同时导入 a、a.b 与 a.b.c
+            for i in range(1, len(name) + 1):
+                found_file = find_module(root, name[:i])
+                if found_file is not None:
+                    found.add(found_file)
+    return found
+
+
+def script_modules(script):
+    """
+    {relative path: path} of the script and the modules it imports, recursively, from the directory of the script
+    """
+    script = Path(script).absolute()
+    root = script.parent
+    modules = {script}
+    pending = [script]
+    while pending:
+        for module_file in imported_modules(pending.pop(), root):
+            if module_file not in modules:
+                modules.add(module_file)
+                pending.append(module_file)
+    return {os.path.relpath(i, root): i for i in sorted(modules)}
+
+
+def expand_scripts(scripts):
+    """
+    tools of the --script name=path: name for the script itself and name/<module> for the modules it imports
+    """
+    tools = dict()
+    for name, script in scripts.items():
+        for relpath, module_file in script_modules(script).items():
+            tools[name if module_file == Path(script).absolute() else f'{name}/{relpath}'] = str(module_file)
+    return tools
+
+
+def parse_named(items):
+    named = dict()
+    for item in items or []:
+        if '=' not in item:
+            raise ValueError(f'expect name=value, got: {item}')
+        name, value = item.split('=', 1)
+        named[name] = value
+    return named
+
+
+class Manifest(object):
+    def __init__(self, manifest_file, inputs=None, outputs=None, tools=None, params=None):
+        self.manifest_file = Path(manifest_file)
+        self.inputs = inputs or dict()
+        self.outputs = outputs or dict()
+        self.tools = tools or dict()
+        self.params = {k: str(v) for k, v in (params or dict()).items()}
+        self.previous = self.load()
+
+    def load(self):
+        if not self.manifest_file.exists():
+            return None
+        try:
+            with open(self.manifest_file) as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return previous if previous.get('version') == MANIFEST_VERSION else None
+
+    def _describe_all(self, kind, paths):
+        previous = (self.previous or dict()).get(kind, dict())
+        return {name: describe(path, previous.get(name)) for name, path in paths.items()}
+
+    def changes(self):
+        """
+        Reasons to (re)run, empty if the previous run can be reused
+        """
+        if self.previous is None:
+            return ['no manifest']
+        changes = list()
+        if self.previous.get('params') != self.params:
+            changes.append('params')
+        for kind, paths in [('inputs', self.inputs), ('tools', self.tools), ('outputs', self.outputs)]:
+            previous = self.previous.get(kind, dict())
+            if set(previous.keys()) != set(paths.keys()):
+                changes.append(f'{kind} names')
+                continue
+            for name, current in self._describe_all(kind, paths).items():
+                if current is None:
+                    changes.append(f'{kind}.{name} missing')
+                elif previous[name] is None or current['sha256'] != previous[name]['sha256']:
+                    changes.append(f'{kind}.{name} changed')
+        return changes
+
+    def record(self, command=None):
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'command': command,
+            'params': self.params,
+            'inputs': self._describe_all('inputs', self.inputs),
+            'tools': self._describe_all('tools', self.tools),
+            'outputs': self._describe_all('outputs', self.outputs),
+        }
+        missing = [name for name, output in manifest['outputs'].items() if output is None]
+        if missing:
+            raise FileNotFoundError(f'outputs not created: {missing}')
+        self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.manifest_file.parent / f'{self.manifest_file.name}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        tmp_file.replace(self.manifest_file)
+        self.previous = manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="DeepPrep: run a command unless its manifest (input / tool / output hashes, params) matches"
+    )
+    parser.add_argument("--manifest", required=True, help="manifest json file of this derivative")
+    parser.add_argument("--input", action='append', help="name=path of an input file or directory")
+    parser.add_argument("--output", action='append', help="name=path of an output file or directory")
+    parser.add_argument("--tool", action='append', help="name=path of a model / data file or directory")
+    parser.add_argument("--script", action='append',
+                        help="name=path of a python script, recorded with the modules it imports from its directory")
+    parser.add_argument("--param", action='append', help="name=value of a parameter")
+    parser.add_argument("--force", action='store_true', help="run and record even if the manifest matches")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="-- command to run")
+    args = parser.parse_args()
+
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if len(command) == 0:
+        parser.error('no command given after --')
+
+    tools = parse_named(args.tool)
+    tools.update(expand_scripts(parse_named(args.script)))
+    manifest = Manifest(args.manifest, parse_named(args.input), parse_named(args.output), tools,
+                        parse_named(args.param))
+    changes = ['--force'] if args.force else manifest.changes()
+    if not changes:
+        print(f'INFO: manifest matches, skip: {args.manifest}')
+        sys.exit(0)
+    print(f'INFO: run ({", ".join(changes)}): {" ".join(command)}')
+    ret = subprocess.run(command)
+    if ret.returncode != 0:
+        sys.exit(ret.returncode)
+    manifest.record(command)
+    print(f'INFO: manifest >>> {args.manifest}')
@@ -8,6 +8,7 @@ import os
 from pathlib import Path
 import base64
 from wand.image import Image
+from qc_render_cache import RenderCache
 
 svg_img_head = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" viewBox="0 0 {view_height} {view_width}" preserveAspectRatio="xMidYMid meet">'
 
@@ -68,6 +69,39 @@ def encode_png(png_img):
     return pngdata
 
 
+def plot_volparc(subject_id, subjects_dir, qc_result_path, dlabel_info_txt, scene_file):
+    subject_resultdir = Path(qc_result_path) / subject_id / 'figures'
+    subject_resultdir.mkdir(parents=True, exist_ok=True)
+    T1_mgz = Path(subjects_dir) / subject_id / 'mri' / 'T1.mgz'
+    aseg_mgz = Path(subjects_dir) / subject_id / 'mri' / 'aparc+aseg.mgz'
+    Volume_parc_savepath_svg = subject_resultdir / f'{subject_id}_desc-volparc_T1w.svg'
+    render_cache = RenderCache('volparc', inputs=[T1_mgz, aseg_mgz],
+                               templates=[scene_file, dlabel_info_txt, __file__], params={'size': [2400, 1000]})
+    if render_cache.fetch(Volume_parc_savepath_svg):
+        print(f'>>> {Volume_parc_savepath_svg}')
+        return Volume_parc_savepath_svg
+
+    subject_workdir = Path(subject_resultdir) / 'aseg_aparc'
+    subject_workdir.mkdir(parents=True, exist_ok=True)
+
+    T1_nii = subject_workdir / 'T1.nii.gz'
+    aparc_asge_nii = subject_workdir / 'aparc+aseg.nii.gz'
+    mgz2nii(T1_mgz, T1_nii)
+    mgz2nii(aseg_mgz, aparc_asge_nii)
+    aparc_asge_cifti = subject_workdir / 'aparc+aseg_dlabel.nii.gz'
+    asge_nii2dlabel(aparc_asge_nii, dlabel_info_txt, aparc_asge_cifti)
+    png_savepath = subject_workdir / 'Volume_parc.png'
+    Volume_parc_scene = subject_workdir / 'Volume_parc.scene'
+    if Volume_parc_scene.exists() is False:
+        shutil.copyfile(scene_file, Volume_parc_scene)
+    scene_plot(Volume_parc_scene, png_savepath, 2400, 1000)
+    print(f'>>> {Volume_parc_savepath_svg}')
+    write_single_svg(Volume_parc_savepath_svg, png_savepath, 2400, 1000)
+    render_cache.store(Volume_parc_savepath_svg)
+    shutil.rmtree(subject_workdir)
+    return Volume_parc_savepath_svg
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="plot subject aparc fig")
     parser.add_argument('--subject_id', help='输入的subjects id', required=True)
@@ -88,25 +122,4 @@ if __name__ == '__main__':
     freesurfer_home = args.freesurfer_home
     set_environ(freesurfer_home)
 
-    subject_resultdir = Path(args.qc_result_path) / subject_id / 'figures'
-    subject_resultdir.mkdir(parents=True, exist_ok=True)
-    subject_workdir = Path(subject_resultdir) / 'aseg_aparc'
-    subject_workdir.mkdir(parents=True, exist_ok=True)
-
-    T1_mgz = Path(subjects_dir) / subject_id / 'mri' / 'T1.mgz'
-    aseg_mgz = Path(subjects_dir) / subject_id / 'mri' / 'aparc+aseg.mgz'
-    T1_nii = subject_workdir / 'T1.nii.gz'
-    aparc_asge_nii = subject_workdir / 'aparc+aseg.nii.gz'
-    mgz2nii(T1_mgz, T1_nii)
-    mgz2nii(aseg_mgz, aparc_asge_nii)
-    aparc_asge_cifti = subject_workdir / 'aparc+aseg_dlabel.nii.gz'
-    asge_nii2dlabel(aparc_asge_nii, dlabel_info_txt, aparc_asge_cifti)
-    png_savepath = subject_workdir / 'Volume_parc.png'
-    Volume_parc_scene = subject_workdir / 'Volume_parc.scene'
-    if Volume_parc_scene.exists() is False:
-        shutil.copyfile(scene_file, Volume_parc_scene)
-    scene_plot(Volume_parc_scene, png_savepath, 2400, 1000)
-    Volume_parc_savepath_svg = subject_resultdir / f'{subject_id}_desc-volparc_T1w.svg'
-    print(f'>>> {Volume_parc_savepath_svg}')
-    write_single_svg(Volume_parc_savepath_svg, png_savepath, 2400, 1000)
-    shutil.rmtree(subject_workdir)
+    plot_volparc(subject_id, subjects_dir, args.qc_result_path, dlabel_info_txt, scene_file)
@@ -7,6 +7,7 @@ import os
 from pathlib import Path
 import base64
 from wand.image import Image
+from qc_render_cache import RenderCache
 
 svg_img_head = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" viewBox="0 0 {view_height} {view_width}" preserveAspectRatio="xMidYMid meet">'
 
@@ -85,27 +86,19 @@ def encode_png(png_img):
     return pngdata
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="plot subject surf parc fig")
-    parser.add_argument('--subject_id', help='输入的subjects id', required=True)
-    parser.add_argument('--subjects_dir', help='输入的subjects dir文件', required=True)
-    parser.add_argument('--qc_result_path', help='QC result path', required=True)
-    parser.add_argument('--affine_mat', help='surf转换格式配准的affine', required=True)
-    parser.add_argument('--scene_file', help='画图所需要的scene文件', required=True)
-    parser.add_argument('--svg_outpath', help='输出的svg图片保存路径', required=True)
-    parser.add_argument('--freesurfer_home', help='freesurfer 的环境变量', default="/usr/local/freesurfer720",
-                        required=False)
-    args = parser.parse_args()
-
-    subject_id = args.subject_id
-    subjects_dir = args.subjects_dir
-    affine_mat_atlas = args.affine_mat
-    scene_file = args.scene_file
-    freesurfer_home = args.freesurfer_home
-    set_environ(freesurfer_home)
-
-    subject_resultdir = Path(args.qc_result_path) / subject_id / 'figures'
+def plot_surfparc(subject_id, subjects_dir, qc_result_path, affine_mat_atlas, scene_file):
+    subject_resultdir = Path(qc_result_path) / subject_id / 'figures'
     subject_resultdir.mkdir(parents=True, exist_ok=True)
+    Surface_parc_savepath_svg = subject_resultdir / f'{subject_id}_desc-surfparc_T1w.svg'
+    render_inputs = [Path(subjects_dir) / subject_id / i for i in
+                     ['surf/lh.white', 'surf/rh.white', 'surf/lh.pial', 'surf/rh.pial',
+                      'label/lh.aparc.annot', 'label/rh.aparc.annot']]
+    render_cache = RenderCache('surfparc', inputs=render_inputs,
+                               templates=[scene_file, affine_mat_atlas, __file__], params={'size': [2400, 1000]})
+    if render_cache.fetch(Surface_parc_savepath_svg):
+        print(f'>>> {Surface_parc_savepath_svg}')
+        return Surface_parc_savepath_svg
+
     subject_workdir = Path(subject_resultdir) / 'surfparc'
     subject_workdir.mkdir(parents=True, exist_ok=True)
     affine_mat = subject_workdir / 'affine.mat'
@@ -143,7 +136,30 @@ if __name__ == '__main__':
     if Surface_parc_scene.exists() is False:
         shutil.copyfile(scene_file, Surface_parc_scene)
     scene_plot(Surface_parc_scene, Surface_parc_savepath, 2400, 1000)
-    Surface_parc_savepath_svg = subject_resultdir / f'{subject_id}_desc-surfparc_T1w.svg'
     print(f'>>> {Surface_parc_savepath_svg}')
     write_single_svg(Surface_parc_savepath_svg, Surface_parc_savepath, 2400, 1000)
-    shutil.rmtree(subject_workdir)
\ No newline at end of file
+    render_cache.store(Surface_parc_savepath_svg)
+    shutil.rmtree(subject_workdir)
+    return Surface_parc_savepath_svg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="plot subject surf parc fig")
+    parser.add_argument('--subject_id', help='输入的subjects id', required=True)
+    parser.add_argument('--subjects_dir', help='输入的subjects dir文件', required=True)
+    parser.add_argument('--qc_result_path', help='QC result path', required=True)
+    parser.add_argument('--affine_mat', help='surf转换格式配准的affine', required=True)
+    parser.add_argument('--scene_file', help='画图所需要的scene文件', required=True)
+    parser.add_argument('--svg_outpath', help='输出的svg图片保存路径', required=True)
+    parser.add_argument('--freesurfer_home', help='freesurfer 的环境变量', default="/usr/local/freesurfer720",
+                        required=False)
+    args = parser.parse_args()
+
+    subject_id = args.subject_id
+    subjects_dir = args.subjects_dir
+    affine_mat_atlas = args.affine_mat
+    scene_file = args.scene_file
+    freesurfer_home = args.freesurfer_home
+    set_environ(freesurfer_home)
+
+    plot_surfparc(subject_id, subjects_dir, args.qc_result_path, affine_mat_atlas, scene_file)
@@ -6,10 +6,9 @@ from pathlib import Path
 import base64
 from wand.image import Image
 import nibabel as nib
-from nipype.algorithms.confounds import TSNR
-from nipype import Node
 import numpy as np
 from PIL import Image as image_plt
+from confound_signals import compute_tsnr
 
 
 svg_img_head = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" viewBox="0 0 {view_height} {view_width}" preserveAspectRatio="xMidYMid meet">'
@@ -53,23 +52,14 @@ def encode_png(png_img):
     return pngdata
 
 
-def TSNR_test(inputs_file, output_file):
-    TSNR_node = Node(TSNR(), 'TSNR_node')
-
-    TSNR_node.inputs.in_file = inputs_file
-    TSNR_node.inputs.tsnr_file = output_file
-
-    TSNR_node.run()
-
-
-def rewrite_tsnr(output_path, mc_brainmask):
-    src_tsnr_data = nib.load(output_path).get_fdata()
-    brainmask_data = nib.load(mc_brainmask).get_fdata()
-
-    src_tsnr_data[brainmask_data == 0] = 0
-    trg_tsnr_img = nib.Nifti1Image(src_tsnr_data, affine=np.eye(4))
-
-    nib.save(trg_tsnr_img, output_path)
+def write_tsnr(bold_file, output_path):
+    """
+    tSNR of the streamed bold, on the grid and header of the bold for vol2surf
+    """
+    tsnr_data, bold_img = compute_tsnr(bold_file)
+    header = bold_img.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(tsnr_data.astype(np.float32), bold_img.affine, header), output_path)
 
 
 def set_environ(freesurfer_home, subjects_dir):
@@ -165,7 +155,7 @@ if __name__ == '__main__':
     bold_mc = Path(cur_path) / bold_preprocess_dir / subject_id / 'func' / f'{bold_id}_skip_reorient_stc_mc.nii.gz'
     bbreg_dat = Path(cur_path) / bold_preprocess_dir / subject_id / 'func' / f'{bold_id}_skip_reorient_stc_mc_from_mc_to_fsnative_bbregister_rigid.dat'
     mc_tsnr_path = Path(cur_path) / str(subject_workdir) / 'mc_tsnr_vol.nii.gz'
-    TSNR_test(bold_mc, mc_tsnr_path)
+    write_tsnr(bold_mc, mc_tsnr_path)
     fs6_path = Path(freesurfer_home) / 'subjects' / 'fsaverage6'
     subject_workdir_fs6 = Path(subjects_dir) / 'fsaverage6'
     if subject_workdir_fs6.exists() is False:
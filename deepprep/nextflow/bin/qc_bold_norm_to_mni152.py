@@ -6,6 +6,7 @@ import os
 from pathlib import Path
 import base64
 from wand.image import Image
+from qc_render_cache import RenderCache
 
 svg_img_head = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" viewBox="0 0 {view_height} {view_width}" preserveAspectRatio="xMidYMid meet">'
 
@@ -56,6 +57,35 @@ def encode_png(png_img):
     return pngdata
 
 
+def plot_norm_to_mni152(subject_id, qc_result_path, norm_to_mni152, scene_file, mni152_norm_png):
+    subject_resultdir = Path(qc_result_path) / subject_id / 'figures'
+    subject_resultdir.mkdir(parents=True, exist_ok=True)
+    combine_svg_savepath = subject_resultdir / f'{subject_id}_desc-T1toMNI152_combine.svg'
+    render_cache = RenderCache('T1toMNI152', inputs=[norm_to_mni152],
+                               templates=[scene_file, mni152_norm_png, __file__], params={'size': [2400, 1000]})
+    if render_cache.fetch(combine_svg_savepath):
+        print(f'>>> {combine_svg_savepath}')
+        return combine_svg_savepath
+
+    subject_workdir = Path(subject_resultdir) / 'norm2mni152'
+    subject_workdir.mkdir(parents=True, exist_ok=True)
+
+    norm_to_mni152nii_tmp = subject_workdir / 'norm_to_mni152nii.nii.gz'
+    shutil.copyfile(norm_to_mni152, norm_to_mni152nii_tmp)
+
+    NormtoMNI152_savepath = subject_workdir / 'NormtoMNI152.png'
+    NormtoMNI152_scene = subject_workdir / 'NormtoMNI152.scene'
+    if NormtoMNI152_scene.exists() is False:
+        shutil.copyfile(scene_file, NormtoMNI152_scene)
+    scene_plot(NormtoMNI152_scene, NormtoMNI152_savepath, 2400, 1000)
+    print(f'>>> {combine_svg_savepath}')
+    write_combine_svg(combine_svg_savepath, mni152_norm_png, NormtoMNI152_savepath, 2400, 1000)
+    render_cache.store(combine_svg_savepath)
+    if subject_workdir.exists():
+        shutil.rmtree(subject_workdir)
+    return combine_svg_savepath
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="plot subject norm to mni152 fig")
     parser.add_argument('--subject_id', help='输入的subjects id', required=True)
@@ -73,21 +103,4 @@ if __name__ == '__main__':
     mni152_norm_png = args.mni152_norm_png
     savepath_svg = args.svg_outpath
 
-    subject_resultdir = Path(args.qc_result_path) / subject_id / 'figures'
-    subject_resultdir.mkdir(parents=True, exist_ok=True)
-    subject_workdir = Path(subject_resultdir) / 'norm2mni152'
-    subject_workdir.mkdir(parents=True, exist_ok=True)
-
-    norm_to_mni152nii_tmp = subject_workdir / 'norm_to_mni152nii.nii.gz'
-    shutil.copyfile(args.norm_to_mni152, norm_to_mni152nii_tmp)
-
-    NormtoMNI152_savepath = subject_workdir / 'NormtoMNI152.png'
-    NormtoMNI152_scene = subject_workdir / 'NormtoMNI152.scene'
-    if NormtoMNI152_scene.exists() is False:
-        shutil.copyfile(scene_file, NormtoMNI152_scene)
-    scene_plot(NormtoMNI152_scene, NormtoMNI152_savepath, 2400, 1000)
-    combine_svg_savepath = subject_resultdir / f'{subject_id}_desc-T1toMNI152_combine.svg'
-    print(f'>>> {combine_svg_savepath}')
-    write_combine_svg(combine_svg_savepath, mni152_norm_png, NormtoMNI152_savepath, 2400, 1000)
-    if subject_workdir.exists():
-        shutil.rmtree(subject_workdir)
+    plot_norm_to_mni152(subject_id, args.qc_result_path, args.norm_to_mni152, scene_file, mni152_norm_png)
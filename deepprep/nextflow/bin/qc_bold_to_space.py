@@ -6,6 +6,8 @@ import os
 from pathlib import Path
 import base64
 from wand.image import Image
+from qc_render_cache import RenderCache
+from qc_render_pool import stage_qc_tool, link_file
 
 svg_img_head = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" viewBox="0 0 {view_height} {view_width}" preserveAspectRatio="xMidYMid meet">'
 
@@ -57,42 +59,23 @@ def encode_png(png_img):
 
 
 def get_space_t1w_bold(bids_orig, bids_preproc, bold_orig_file, space_template):
-    from bids import BIDSLayout
-    layout_orig = BIDSLayout(bids_orig, validate=False)
-    layout_preproc = BIDSLayout(bids_preproc, validate=False)
-    info = layout_orig.parse_file_entities(bold_orig_file)
+    from bids_index import get_file_entities, find_files
+    info = get_file_entities(bids_orig, bold_orig_file)
 
     space_template_t1w_info = info.copy()
     space_template_t1w_info['suffix'] = 'boldref'
     space_template_t1w_info['space'] = space_template
     space_template_t1w_info['extension'] = 'nii.gz'
-    space_template_file = layout_preproc.get(**space_template_t1w_info)[0]
+    space_template_file = find_files(bids_preproc, **space_template_t1w_info)[0]
 
-    return space_template_file.path
+    return str(space_template_file)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="plot subject bold space fig")
-    parser.add_argument('--subject_id', help='输入的subjects id', required=True)
-    parser.add_argument('--bold_id', help='输入的bold id', required=True)
-    parser.add_argument('--bids_dir', required=True)
-    parser.add_argument("--bold_file", required=True)
-    parser.add_argument('--bold_preprocess_path', required=True)
-    parser.add_argument('--space_template', help='space_mni152_bold_path', required=True)
-    parser.add_argument('--qc_result_path', help='QC result path', required=True)
-    parser.add_argument('--qc_tool_package', help='qc画图的辅助文件包', required=True)
-    parser.add_argument('--work_dir', required=True)
-    args = parser.parse_args()
-
-    subject_id = args.subject_id
-    bold_id = args.bold_id
-    qc_tool_package = args.qc_tool_package
-    space_template = args.space_template
-
-    subject_resultdir = Path(args.qc_result_path) / subject_id / 'figures'
+def plot_bold_to_space(subject_id, bold_id, bids_dir, bold_file, bold_preprocess_path, space_template, qc_result_path,
+                       qc_tool_package, work_dir):
+    subject_resultdir = Path(qc_result_path) / subject_id / 'figures'
     subject_resultdir.mkdir(parents=True, exist_ok=True)
-    subject_bold2mni152_workdir = Path(args.work_dir) / f'{bold_id}_bold2{space_template}' / subject_id
-    subject_bold2mni152_workdir.mkdir(parents=True, exist_ok=True)
+    subject_bold2mni152_workdir = Path(work_dir) / f'{bold_id}_bold2{space_template}' / subject_id
 
     if 'MNI152NLin6Asym' in space_template:
         lh_MNI152_white_gii = Path(qc_tool_package) / 'lh.MNI152.white.surf.gii'
@@ -103,6 +86,25 @@ if __name__ == '__main__':
         mni152_scene = Path(qc_tool_package) / 'plot_MNI152.scene'
         bold2mni152_scene = Path(qc_tool_package) / 'plot_bold2MNI152.scene'
 
+        with open(bold_file, 'r') as f:
+            data = f.readlines()
+        data = [i.strip() for i in data]
+        bold_orig_file = data[1]
+
+        bold_space_template_file = get_space_t1w_bold(bids_dir, bold_preprocess_path, bold_orig_file,
+                                                      space_template)
+        combine_svg_savepath = subject_resultdir / f'{bold_id}_desc-reg2MNI152_bold.svg'
+        render_cache = RenderCache('reg2MNI152', inputs=[bold_space_template_file],
+                                   templates=[lh_MNI152_white_gii, rh_MNI152_white_gii, lh_MNI152_pial_gii,
+                                              rh_MNI152_pial_gii, mni152_norm, mni152_scene, bold2mni152_scene,
+                                              __file__],
+                                   params={'space': space_template, 'size': [2400, 1000]})
+        if render_cache.fetch(combine_svg_savepath):
+            print(f'>>> {combine_svg_savepath}')
+            return combine_svg_savepath
+
+        subject_bold2mni152_workdir.mkdir(parents=True, exist_ok=True)
+
         lh_MNI152_white_gii_tmp = subject_bold2mni152_workdir / 'lh.MNI152_tmp.white.surf.gii'
         rh_MNI152_white_gii_tmp = subject_bold2mni152_workdir / 'rh.MNI152_tmp.white.surf.gii'
         lh_MNI152_pial_gii_tmp = subject_bold2mni152_workdir / 'lh.MNI152_tmp.pial.surf.gii'
@@ -111,32 +113,47 @@ if __name__ == '__main__':
         mni152_scene_tmp = subject_bold2mni152_workdir / 'plot_MNI152_tmp.scene'
         bold2mni152_scene_tmp = subject_bold2mni152_workdir / 'plot_bold2MNI152_tmp.scene'
 
-        shutil.copyfile(lh_MNI152_white_gii, lh_MNI152_white_gii_tmp)
-        shutil.copyfile(rh_MNI152_white_gii, rh_MNI152_white_gii_tmp)
-        shutil.copyfile(lh_MNI152_pial_gii, lh_MNI152_pial_gii_tmp)
-        shutil.copyfile(rh_MNI152_pial_gii, rh_MNI152_pial_gii_tmp)
-        shutil.copyfile(mni152_norm, MNI152_norm_tmp)
+        link_file(lh_MNI152_white_gii, lh_MNI152_white_gii_tmp)
+        link_file(rh_MNI152_white_gii, rh_MNI152_white_gii_tmp)
+        link_file(lh_MNI152_pial_gii, lh_MNI152_pial_gii_tmp)
+        link_file(rh_MNI152_pial_gii, rh_MNI152_pial_gii_tmp)
+        link_file(mni152_norm, MNI152_norm_tmp)
         shutil.copyfile(mni152_scene, mni152_scene_tmp)
         shutil.copyfile(bold2mni152_scene, bold2mni152_scene_tmp)
 
-        with open(args.bold_file, 'r') as f:
-            data = f.readlines()
-        data = [i.strip() for i in data]
-        bold_orig_file = data[1]
-
-        bold_space_template_file = get_space_t1w_bold(args.bids_dir, args.bold_preprocess_path, bold_orig_file,
-                                                      space_template)
-
         bold2mni152_trg = subject_bold2mni152_workdir / f'bold2MNI152_tmp_bold.nii.gz'
-        shutil.copyfile(bold_space_template_file, bold2mni152_trg)
+        link_file(bold_space_template_file, bold2mni152_trg)
 
         bold2MNI152_savepath = subject_bold2mni152_workdir / f'{bold_id}_bold_to_MNI152_moved.png'
         MNI152_savepath = subject_bold2mni152_workdir / f'{bold_id}_MNI152_atlas_fixed.png'
 
         scene_plot(bold2mni152_scene_tmp, bold2MNI152_savepath, 2400, 1000)
         scene_plot(mni152_scene_tmp, MNI152_savepath, 2400, 1000)
-        combine_svg_savepath = subject_resultdir / f'{bold_id}_desc-reg2MNI152_bold.svg'
         print(f'>>> {combine_svg_savepath}')
         write_combine_svg(combine_svg_savepath, bold2MNI152_savepath, MNI152_savepath, 2400,
                           1000)
+        render_cache.store(combine_svg_savepath)
         shutil.rmtree(subject_bold2mni152_workdir)
+        return combine_svg_savepath
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="plot subject bold space fig")
+    parser.add_argument('--subject_id', help='输入的subjects id', required=True)
+    parser.add_argument('--bold_id', help='输入的bold id', required=True)
+    parser.add_argument('--bids_dir', required=True)
+    parser.add_argument("--bold_file", required=True)
+    parser.add_argument('--bold_preprocess_path', required=True)
+    parser.add_argument('--space_template', help='space_mni152_bold_path', required=True)
+    parser.add_argument('--qc_result_path', help='QC result path', required=True)
+    parser.add_argument('--qc_tool_package', help='qc画图的辅助文件包', required=True)
+    parser.add_argument('--work_dir', required=True)
+    args = parser.parse_args()
+
+    subject_id = args.subject_id
+    bold_id = args.bold_id
+    qc_tool_package = stage_qc_tool(args.qc_tool_package)
+    space_template = args.space_template
+
+    plot_bold_to_space(subject_id, bold_id, args.bids_dir, args.bold_file, args.bold_preprocess_path, space_template,
+                       args.qc_result_path, qc_tool_package, args.work_dir)
@@ -2,15 +2,16 @@
 import argparse
 import shutil
 import os
+import inspect
 from pathlib import Path
 import base64
 from wand.image import Image
+from qc_render_cache import RenderCache
 import nibabel as nib
-from nipype.algorithms.confounds import TSNR
-from nipype import Node
 import numpy as np
 from PIL import Image as image_plt
 import bids
+from confound_signals import compute_tsnr
 
 
 svg_img_head = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" viewBox="0 0 {view_height} {view_width}" preserveAspectRatio="xMidYMid meet">'
@@ -54,21 +55,15 @@ def encode_png(png_img):
     return pngdata
 
 
-def TSNR_test(inputs_file, output_file):
-    TSNR_node = Node(TSNR(), 'TSNR_node')
-
-    TSNR_node.inputs.in_file = inputs_file
-    TSNR_node.inputs.tsnr_file = output_file
-
-    TSNR_node.run()
-
-
-def rewrite_tsnr(output_path, mc_brainmask):
-    src_tsnr_data = nib.load(output_path).get_fdata()
+def write_tsnr(bold_file, output_path, mc_brainmask):
+    """
+    tSNR of the streamed bold, 0 outside the brain mask, in the identity space of the scene
+    """
+    tsnr_data, _ = compute_tsnr(bold_file)
     brainmask_data = nib.load(mc_brainmask).get_fdata()
 
-    src_tsnr_data[brainmask_data == 0] = 0
-    trg_tsnr_img = nib.Nifti1Image(src_tsnr_data, affine=np.eye(4))
+    tsnr_data[brainmask_data == 0] = 0
+    trg_tsnr_img = nib.Nifti1Image(tsnr_data, affine=np.eye(4))
 
     nib.save(trg_tsnr_img, output_path)
 
@@ -90,56 +85,45 @@ def combine_bar(output_tsnr_savepath, color_bar_png):
     image2.close()
 
 def get_space_t1w_bold(bids_orig, bids_preproc, bold_orig_file):
-    from bids import BIDSLayout
-    layout_orig = BIDSLayout(bids_orig, validate=False)
-    layout_preproc = BIDSLayout(bids_preproc, validate=False)
-    info = layout_orig.parse_file_entities(bold_orig_file)
+    from bids_index import get_file_entities, find_files
+    info = get_file_entities(bids_orig, bold_orig_file)
 
     bold_t1w_info = info.copy()
     bold_t1w_info['space'] = 'T1w'
-    bold_t1w_file = layout_preproc.get(**bold_t1w_info)[0]
+    bold_t1w_file = find_files(bids_preproc, **bold_t1w_info)[0]
 
     boldmask_t1w_info = info.copy()
     boldmask_t1w_info['suffix'] = 'mask'
-    boldmask_t1w_file = layout_preproc.get(**boldmask_t1w_info)[0]
+    boldmask_t1w_file = find_files(bids_preproc, **boldmask_t1w_info)[0]
 
     return bold_t1w_file, boldmask_t1w_file
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="plot subject mc tsnr fig")
-    parser.add_argument('--bids_dir', required=True)
-    parser.add_argument('--subject_id', required=True)
-    parser.add_argument('--bold_file_txt', required=True)
-    parser.add_argument('--bold_preprocess_path', required=True)
-    parser.add_argument('--qc_result_path', required=True)
-    parser.add_argument('--scene_file', required=True)
-    parser.add_argument('--color_bar_png', required=True)
-    parser.add_argument('--svg_outpath', required=True)
-    args = parser.parse_args()
-
-    with open(args.bold_file_txt, 'r') as f:
+def plot_tsnr(bids_dir, subject_id, bold_file_txt, bold_preprocess_path, qc_result_path, scene_file, color_bar_png):
+    with open(bold_file_txt, 'r') as f:
         data = f.readlines()
     data = [i.strip() for i in data]
     bold_file = data[1]
     bold_name = os.path.basename(bold_file).split('.')[0]
 
-    bids_bold, brainmask = get_space_t1w_bold(args.bids_dir, args.bold_preprocess_path, bold_file)
-
-    qc_result_path = args.qc_result_path
-    scene_file = args.scene_file
-    color_bar_png = args.color_bar_png
-    savepath_svg = args.svg_outpath
+    bids_bold, brainmask = get_space_t1w_bold(bids_dir, bold_preprocess_path, bold_file)
 
-    subject_resultdir = Path(args.qc_result_path) / args.subject_id / 'figures'
+    subject_resultdir = Path(qc_result_path) / subject_id / 'figures'
     subject_resultdir.mkdir(parents=True, exist_ok=True)
+    mctsnr_savepath_svg = subject_resultdir / f'{bold_name}_desc-tsnr_bold.svg'
+    render_cache = RenderCache('tsnr', inputs=[bids_bold, brainmask],
+                               templates=[scene_file, color_bar_png, __file__, inspect.getfile(compute_tsnr)],
+                               params={'size': [2000, 815]})
+    if render_cache.fetch(mctsnr_savepath_svg):
+        print(f'>>> {mctsnr_savepath_svg}')
+        return mctsnr_savepath_svg
+
     subject_workdir = Path(subject_resultdir) / f'{bold_name}_mctsnr'
     subject_workdir.mkdir(parents=True, exist_ok=True)
 
-    mc_tsnr_path = Path(args.qc_result_path) / str(subject_workdir) / 'mc_tsnr.nii.gz'
+    mc_tsnr_path = Path(qc_result_path) / str(subject_workdir) / 'mc_tsnr.nii.gz'
 
-    TSNR_test(bids_bold, mc_tsnr_path)
-    rewrite_tsnr(mc_tsnr_path, brainmask)
+    write_tsnr(bids_bold, mc_tsnr_path, brainmask)
 
     output_tsnr_savepath = subject_workdir / f'{bold_name}_mc_tsnr.png'
     McTSNR_scene = subject_workdir / 'McTSNR.scene'
@@ -147,7 +131,24 @@ if __name__ == '__main__':
         shutil.copyfile(scene_file, McTSNR_scene)
     scene_plot(McTSNR_scene, output_tsnr_savepath, 2000, 815)
     combine_bar(str(output_tsnr_savepath), str(color_bar_png))
-    mctsnr_savepath_svg = subject_resultdir / f'{bold_name}_desc-tsnr_bold.svg'
     print(f'>>> {mctsnr_savepath_svg}')
     write_single_svg(mctsnr_savepath_svg, output_tsnr_savepath, 2000, 815)
+    render_cache.store(mctsnr_savepath_svg)
     shutil.rmtree(subject_workdir)
+    return mctsnr_savepath_svg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="plot subject mc tsnr fig")
+    parser.add_argument('--bids_dir', required=True)
+    parser.add_argument('--subject_id', required=True)
+    parser.add_argument('--bold_file_txt', required=True)
+    parser.add_argument('--bold_preprocess_path', required=True)
+    parser.add_argument('--qc_result_path', required=True)
+    parser.add_argument('--scene_file', required=True)
+    parser.add_argument('--color_bar_png', required=True)
+    parser.add_argument('--svg_outpath', required=True)
+    args = parser.parse_args()
+
+    plot_tsnr(args.bids_dir, args.subject_id, args.bold_file_txt, args.bold_preprocess_path, args.qc_result_path,
+              args.scene_file, args.color_bar_png)
@@ -8,7 +8,7 @@ from time import strftime
 from reports.reports_node import SubjectSummary, TemplateDimensions, AboutSummary
 from nipype import Node
 import shutil
-import bids
+from bids_index import get_layout
 import json
 
 
@@ -18,7 +18,7 @@ def is_deepprep_recon(subjects_dir, subject_id):
 
 
 def get_t1w_and_bold(bids_dir, subject_id, bold_task_type):
-    layout = bids.BIDSLayout(bids_dir, derivatives=False)
+    layout = get_layout(bids_dir, derivatives=False)
     t1w_files = []
     bold_files = []
 
@@ -31,7 +31,7 @@ def get_t1w_and_bold(bids_dir, subject_id, bold_task_type):
     return t1w_files, bold_files
 
 def get_t1w(bids_dir, subject_id):
-    layout = bids.BIDSLayout(bids_dir, derivatives=False)
+    layout = get_layout(bids_dir, derivatives=False)
     t1w_files = []
 
     for t1w_file in layout.get(return_type='filename', subject=subject_id.split('-')[1], suffix="T1w", extension='.nii.gz'):
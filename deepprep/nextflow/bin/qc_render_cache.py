@@ -0,0 +1,111 @@
+#! /usr/bin/env python3
+"""
+Content-addressed cache of the rendered QC figures.
+
+Every QC script converts its inputs (mri_convert, wb_command), renders the
+scene with wb_command -show-scene and base64-encodes the PNGs into an SVG,
+even when nothing has changed since the last run. Here the SVG is stored
+under $DEEPPREP_QC_CACHE, keyed by the sha256 of the input images, of the
+templates (scene files, color bars, the QC script itself) and of the render
+parameters. On a hit the stored SVG is copied to the result path and all
+external rendering is skipped, so reruns and report regeneration are cheap.
+
+    render_cache = RenderCache('volparc', inputs=[T1_mgz, aseg_mgz], templates=[scene_file, __file__],
+                               params={'size': [2400, 1000]})
+    if render_cache.fetch(svg_file):
+        exit(0)
+    ...  # render svg_file
+    render_cache.store(svg_file)
+
+Input hashes are reused while a file keeps its path, size and mtime (as in
+deepprep_manifest.py), so the BOLD series are not read again on a rerun.
+Without $DEEPPREP_QC_CACHE (or cache_dir) fetch always misses and store does nothing.
+"""
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+
+from deepprep_manifest import hash_file_stamped
+
+QC_CACHE_VERSION = 1
+
+
+def get_cache_dir(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.environ.get('DEEPPREP_QC_CACHE')
+    return None if cache_dir in [None, ''] else Path(cache_dir)
+
+
+def atomic_copy(src, dst: Path):
+    # 先写临时文件再 rename，并行的 task 不会读到写了一半的文件
+    tmp_file = dst.parent / f'{dst.name}.{os.getpid()}.tmp'
+    shutil.copyfile(src, tmp_file)
+    tmp_file.replace(dst)
+
+
+class RenderCache(object):
+    def __init__(self, name, inputs, templates=None, params=None, cache_dir=None):
+        self.name = name
+        self.inputs = [Path(i) for i in inputs]
+        self.templates = [Path(i) for i in templates or []]
+        self.params = params or dict()
+        self.cache_dir = get_cache_dir(cache_dir)
+        self._key = None
+
+    def hash_file(self, file_path: Path):
+        return hash_file_stamped(file_path, self.cache_dir / 'stamps')
+
+    @property
+    def key(self):
+        # 只用内容的 hash，不用路径：移动数据集后仍能命中
+        if self._key is None:
+            content = {
+                'version': QC_CACHE_VERSION,
+                'name': self.name,
+                'inputs': [self.hash_file(i) for i in self.inputs],
+                'templates': [self.hash_file(i) for i in self.templates],
+                'params': self.params,
+            }
+            self._key = hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+        return self._key
+
+    @property
+    def cache_file(self):
+        return self.cache_dir / self.key[:2] / f'{self.key}.svg'
+
+    def fetch(self, svg_file):
+        """
+        Copy the cached figure to svg_file, False on a miss
+        """
+        if self.cache_dir is None or not self.cache_file.exists():
+            return False
+        svg_file = Path(svg_file)
+        svg_file.parent.mkdir(parents=True, exist_ok=True)
+        atomic_copy(self.cache_file, svg_file)
+        print(f'INFO: QC cache hit, skip rendering: {self.cache_file}')
+        return True
+
+    def store(self, svg_file):
+        if self.cache_dir is None:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        atomic_copy(svg_file, self.cache_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="DeepPrep: size of the QC render cache"
+    )
+    parser.add_argument("--cache_dir", help="directory of the cache, default is $DEEPPREP_QC_CACHE")
+    args = parser.parse_args()
+
+    cache_dir = get_cache_dir(args.cache_dir)
+    if cache_dir is None or not cache_dir.exists():
+        print('QC cache: not configured or empty')
+    else:
+        figures = [i for i in cache_dir.glob('??/*.svg')]
+        size = sum(i.stat().st_size for i in figures)
+        print(f'QC cache {cache_dir}: {len(figures)} figures, {size / 2 ** 20:.1f} MB')
@@ -0,0 +1,215 @@
+#! /usr/bin/env python3
+"""
+Worker pool for the QC figures of one or several subjects.
+
+Every QC figure used to be a process of its own: it imported numpy / nibabel /
+Wand (ImageMagick), copied the qc_tool templates into its workdir and rendered
+with wb_command. Here the figures are jobs of a pool. The workers are started
+once, set up the FreeSurfer / Workbench environment, import the plot functions
+and load ImageMagick, then render figure after figure. The static qc_tool
+assets (scenes, MNI152 surfaces and volume, color bars) are staged once per
+node into a node-local directory ($DEEPPREP_QC_STAGE, default under the
+system temp dir); qc_bold_to_space.py links them into its workdir instead of
+copying them for every BOLD run. The time of every figure is reported and can
+be written to --timing_file.
+
+wb_command has no server mode, it is still started once per scene.
+
+    qc_render_pool.py --subject_id sub-01 sub-02 --subjects_dir <subjects_dir> --qc_result_path <QC> \
+        --qc_tool_package <qc_tool> --workers 4
+    qc_render_pool.py --jobs jobs.json --qc_tool_package <qc_tool> --workers 8
+
+jobs.json is a list of {"figure": <name in FIGURES>, "kwargs": {<arguments of the plot function>}};
+"{qc_tool}" in a string argument is replaced by the staged qc_tool directory.
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import argparse
+import tempfile
+import importlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from deepprep_manifest import get_stamp
+
+# figure: (module, plot function)
+FIGURES = {
+    'volparc': ('qc_anat_aparc_aseg', 'plot_volparc'),
+    'volsurf': ('qc_anat_vol_surface', 'plot_volsurf'),
+    'surfparc': ('qc_anat_surface_parc', 'plot_surfparc'),
+    'T1toMNI152': ('qc_bold_norm_to_mni152', 'plot_norm_to_mni152'),
+    'tsnr': ('qc_bold_tsnr', 'plot_tsnr'),
+    'reg2MNI152': ('qc_bold_to_space', 'plot_bold_to_space'),
+}
+TIMING_COLUMNS = ['subject_id', 'figure', 'seconds', 'worker', 'svg', 'error']
+
+
+def get_stage_dir(stage_dir=None):
+    if stage_dir is None:
+        stage_dir = os.environ.get('DEEPPREP_QC_STAGE')
+    if stage_dir in [None, '']:
+        stage_dir = Path(tempfile.gettempdir()) / f'deepprep_qc_tool_{os.getuid()}'
+    return Path(stage_dir)
+
+
+def stage_qc_tool(qc_tool_package, stage_dir=None):
+    """
+    Node-local copy of qc_tool_package, made once per node and version (path, size and mtime of its files)
+    """
+    qc_tool_package = Path(qc_tool_package).absolute()
+    key = f'{os.path.realpath(qc_tool_package)}:{get_stamp(qc_tool_package)}'
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    stage_dir = get_stage_dir(stage_dir)
+    staged_dir = stage_dir / key
+    if staged_dir.exists():
+        return staged_dir
+
+    stage_dir.mkdir(parents=True, exist_ok=True)
+    with open(stage_dir / f'{key}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not staged_dir.exists():
+                # rename 后其他进程才能看到，不会用到拷贝了一半的目录
+                tmp_dir = stage_dir / f'{key}.{os.getpid()}.tmp'
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                shutil.copytree(qc_tool_package, tmp_dir)
+                tmp_dir.rename(staged_dir)
+                print(f'stage QC assets: {qc_tool_package} >>> {staged_dir}')
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return staged_dir
+
+
+def link_file(src, dst: Path):
+    # 静态文件只读，软链接代替每个 figure 的拷贝
+    if dst.is_symlink() or dst.exists():
+        dst.unlink()
+    os.symlink(os.path.abspath(src), dst)
+
+
+def anat_jobs(subject_id, subjects_dir, qc_result_path):
+    return [
+        {'figure': 'volparc',
+         'kwargs': {'subject_id': subject_id, 'subjects_dir': subjects_dir, 'qc_result_path': qc_result_path,
+                    'dlabel_info_txt': '{qc_tool}/FreeSurferAllLut.txt',
+                    'scene_file': '{qc_tool}/Volume_parc.scene'}},
+        {'figure': 'volsurf',
+         'kwargs': {'subject_id': subject_id, 'subjects_dir': subjects_dir, 'qc_result_path': qc_result_path,
+                    'affine_mat_atlas': '{qc_tool}/affine.mat', 'scene_file': '{qc_tool}/Vol_Surface.scene'}},
+        {'figure': 'surfparc',
+         'kwargs': {'subject_id': subject_id, 'subjects_dir': subjects_dir, 'qc_result_path': qc_result_path,
+                    'affine_mat_atlas': '{qc_tool}/affine.mat', 'scene_file': '{qc_tool}/Surface_parc.scene'}},
+    ]
+
+
+def resolve_job(job, staged_dir):
+    if job['figure'] not in FIGURES:
+        raise ValueError(f'unknown QC figure: {job["figure"]}, expect one of {list(FIGURES.keys())}')
+    kwargs = {k: v.replace('{qc_tool}', str(staged_dir)) if isinstance(v, str) else v
+              for k, v in job['kwargs'].items()}
+    return {'figure': job['figure'], 'kwargs': kwargs}
+
+
+def init_worker(freesurfer_home, threads, modules):
+    from qc_anat_aparc_aseg import set_environ
+    from wand.image import Image
+
+    set_environ(freesurfer_home)
+    # 多个 wb_command 同时运行，每个只用分到的线程数
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    for module in modules:
+        importlib.import_module(module)
+    # 预先加载 ImageMagick 的 PNG coder
+    with Image(width=1, height=1) as img:
+        img.make_blob(format='png')
+
+
+def render(job):
+    module, function = FIGURES[job['figure']]
+    plot = getattr(importlib.import_module(module), function)
+    tic = time.time()
+    svg, error = None, ''
+    try:
+        svg = plot(**job['kwargs'])
+    except Exception as e:
+        error = ' '.join(f'{type(e).__name__}: {e}'.split())
+    return {'subject_id': job['kwargs'].get('subject_id', ''), 'figure': job['figure'],
+            'seconds': round(time.time() - tic, 2), 'worker': os.getpid(), 'svg': '' if svg is None else str(svg),
+            'error': error}
+
+
+def get_cpus():
+    # 容器 / cgroup 限制了 CPU 时 os.cpu_count() 仍是整个节点的核数
+    return len(os.sched_getaffinity(0))
+
+
+def run_jobs(jobs, workers, freesurfer_home, cpus=None):
+    threads = max(1, (cpus or get_cpus()) // workers)
+    modules = sorted({FIGURES[job['figure']][0] for job in jobs})
+    timings = list()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(freesurfer_home, threads, modules)) as executor:
+        futures = [executor.submit(render, job) for job in jobs]
+        for future in as_completed(futures):
+            timing = future.result()
+            timings.append(timing)
+            status = f'ERROR {timing["error"]}' if timing['error'] else timing['svg']
+            print(f'QC {timing["subject_id"]} {timing["figure"]}: {timing["seconds"]:.1f}s '
+                  f'(worker {timing["worker"]}) {status}')
+    return timings
+
+
+def write_timing(timings, timing_file):
+    timing_file = Path(timing_file)
+    timing_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(timing_file, 'w') as f:
+        f.write('\t'.join(TIMING_COLUMNS) + '\n')
+        for timing in sorted(timings, key=lambda i: (i['subject_id'], i['figure'])):
+            f.write('\t'.join(str(timing[i]) for i in TIMING_COLUMNS) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="DeepPrep: render the QC figures of one or several subjects in a worker pool"
+    )
+    parser.add_argument("--subject_id", nargs='+', default=[], help="subjects of the anat figures")
+    parser.add_argument("--subjects_dir", help="subjects dir of the anat figures")
+    parser.add_argument("--qc_result_path", help="QC result path of the anat figures")
+    parser.add_argument("--jobs", help="json list of {figure, kwargs} to render in addition")
+    parser.add_argument("--qc_tool_package", required=True, help="qc画图的辅助文件包")
+    parser.add_argument("--freesurfer_home", default="/usr/local/freesurfer720", help="freesurfer 的环境变量")
+    parser.add_argument("--workers", type=int, default=get_cpus(), help="number of worker processes")
+    parser.add_argument("--cpus", type=int, default=get_cpus(),
+                        help="CPUs of the task, split among the workers for wb_command (OMP_NUM_THREADS)")
+    parser.add_argument("--stage_dir", help="node-local directory of the staged qc_tool, default is $DEEPPREP_QC_STAGE")
+    parser.add_argument("--timing_file", help="tsv of the time of every figure")
+    args = parser.parse_args()
+
+    jobs = list()
+    if args.subject_id:
+        if args.subjects_dir is None or args.qc_result_path is None:
+            parser.error('--subject_id needs --subjects_dir and --qc_result_path')
+        for subject_id in args.subject_id:
+            jobs.extend(anat_jobs(subject_id, args.subjects_dir, args.qc_result_path))
+    if args.jobs is not None:
+        with open(args.jobs) as f:
+            jobs.extend(json.load(f))
+    if len(jobs) == 0:
+        parser.error('no QC figure to render, set --subject_id or --jobs')
+
+    staged_dir = stage_qc_tool(args.qc_tool_package, args.stage_dir)
+    jobs = [resolve_job(job, staged_dir) for job in jobs]
+    workers = min(args.workers, len(jobs))
+    tic = time.time()
+    timings = run_jobs(jobs, workers, args.freesurfer_home, args.cpus)
+    print(f'QC: {len(timings)} figures in {time.time() - tic:.1f}s with {workers} workers')
+    if args.timing_file is not None:
+        write_timing(timings, args.timing_file)
+        print(f'>>> {args.timing_file}')
+    failed = [i for i in timings if i['error']]
+    if failed:
+        exit(1)
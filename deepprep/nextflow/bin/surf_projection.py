@@ -0,0 +1,116 @@
+"""
+Cached volume -> surface projection (sparse replacement for nilearn ``vol_to_surf``).
+
+For a (white, pial, BOLD grid) combination the projection is linear in the
+voxel values: each vertex is the mean of trilinear samples taken at
+``n_samples`` depths between the pial and white surfaces, as in
+``nilearn.surface.vol_to_surf(img, pial, inner_mesh=white)``. The weights are
+stored once as a sparse (n_vertex x n_voxel) matrix keyed by the geometry hash
+and every run/frame of the subject is projected with a sparse product,
+streaming frames so the 4D series is never fully loaded.
+"""
+import os
+import hashlib
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from scipy.sparse import coo_matrix, save_npz, load_npz
+
+from surf_resample import file_sha1
+
+
+def get_grid_key(img):
+    """
+    Hash of the voxel grid (shape + affine) of a BOLD image.
+    """
+    grid = np.concatenate([np.asarray(img.shape[:3], dtype=np.float64), img.affine.ravel()])
+    return hashlib.sha1(grid.tobytes()).hexdigest()
+
+
+def sample_locations_between(pial_xyz, white_xyz, affine, n_samples=10):
+    """
+    (n_vertex, n_samples, 3) voxel-space sample locations from pial to white.
+    """
+    steps = np.linspace(0, 1, n_samples)[None, :, None]
+    locations = pial_xyz[:, None, :] + steps * (white_xyz - pial_xyz)[:, None, :]
+    inv_affine = np.linalg.inv(affine)
+    return locations @ inv_affine[:3, :3].T + inv_affine[:3, 3]
+
+
+def build_projection_matrix(pial_xyz, white_xyz, affine, grid_shape, n_samples=10):
+    """
+    Sparse (n_vertex x n_voxel) trilinear projection matrix.
+
+    Samples outside the grid are dropped and each vertex averages its valid
+    samples (nanmean); vertices without a valid sample get an empty row (0).
+    Linear extrapolation in the last half voxel matches scipy's
+    RegularGridInterpolator(fill_value=None) used by nilearn.
+    """
+    grid_shape = np.asarray(grid_shape[:3])
+    n_vertex = pial_xyz.shape[0]
+    locations = sample_locations_between(pial_xyz, white_xyz, affine, n_samples).reshape(-1, 3)
+    vertex_index = np.repeat(np.arange(n_vertex), n_samples)
+
+    valid = np.all((locations >= 0) & (locations < grid_shape), axis=1)
+    locations = locations[valid]
+    vertex_index = vertex_index[valid]
+    n_valid = np.bincount(vertex_index, minlength=n_vertex).astype(np.float32)
+
+    base = np.clip(np.floor(locations).astype(int), 0, grid_shape - 2)
+    frac = locations - base
+
+    rows, cols, values = [], [], []
+    for corner in range(8):
+        offset = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+        weight = np.prod(np.where(offset == 1, frac, 1 - frac), axis=1)
+        voxel = np.ravel_multi_index(tuple((base + offset).T), tuple(grid_shape))
+        rows.append(vertex_index)
+        cols.append(voxel)
+        values.append(weight / n_valid[vertex_index])
+
+    matrix = coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                        shape=(n_vertex, int(np.prod(grid_shape))))
+    return matrix.tocsr().astype(np.float32)
+
+
+def get_projection_matrix(hemi_pial, hemi_white, bold_img, cache_dir=None, n_samples=10):
+    """
+    Projection matrix for (pial, white, BOLD grid), cached in cache_dir by geometry hash.
+    """
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha1(f'{file_sha1(hemi_pial)}{file_sha1(hemi_white)}{get_grid_key(bold_img)}{n_samples}'
+                           .encode()).hexdigest()[:16]
+        cache_file = Path(cache_dir) / f'{Path(hemi_pial).name}.vol2surf.{key}.npz'
+        if cache_file.exists():
+            return load_npz(cache_file)
+
+    pial_xyz, _ = nib.freesurfer.read_geometry(str(hemi_pial))
+    white_xyz, _ = nib.freesurfer.read_geometry(str(hemi_white))
+    matrix = build_projection_matrix(pial_xyz, white_xyz, bold_img.affine, bold_img.shape, n_samples)
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.parent / f'{cache_file.stem}.{os.getpid()}.tmp.npz'
+        save_npz(tmp_file, matrix)
+        tmp_file.replace(cache_file)
+    return matrix
+
+
+def project_bold(matrix, bold_img, chunk_size=64):
+    """
+    Project a 4D BOLD image to the surface, reading chunk_size frames at a time.
+    return: (n_vertex, n_frame) float32
+    """
+    n_frame = bold_img.shape[3] if len(bold_img.shape) > 3 else 1
+    surf_data = np.zeros((matrix.shape[0], n_frame), dtype=np.float32)
+    for start in range(0, n_frame, chunk_size):
+        stop = min(start + chunk_size, n_frame)
+        if len(bold_img.shape) > 3:
+            frames = np.asarray(bold_img.dataobj[..., start:stop], dtype=np.float32)
+        else:
+            frames = np.asarray(bold_img.dataobj, dtype=np.float32)[..., None]
+        frames = np.nan_to_num(frames.reshape(-1, stop - start))
+        surf_data[:, start:stop] = matrix @ frames
+    return surf_data
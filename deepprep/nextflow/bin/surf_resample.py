@@ -0,0 +1,110 @@
+"""
+In-process replacement for ``mri_surf2surf`` (fsnative -> fsaverageN).
+
+The fsnative -> fsaverageN correspondence only depends on the subject's
+``sphere.reg`` and the target's ``sphere.reg``, so it is built once per
+subject and hemisphere as a sparse (n_target x n_source) matrix, cached
+on disk, and applied to the whole vertex x time series in one product.
+"""
+import os
+import hashlib
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix, save_npz, load_npz
+from scipy.spatial import cKDTree
+
+# 矩阵的构建方式改变时递增，旧的 cache 不再命中
+RESAMPLE_VERSION = 2
+
+
+def file_sha1(file_path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def read_sphere(sphere_file):
+    xyz, _ = nib.freesurfer.read_geometry(str(sphere_file))
+    return xyz
+
+
+def average_radius(xyz):
+    # MRISaverageRadius: 顶点到质心的平均距离
+    return np.linalg.norm(xyz - xyz.mean(axis=0), axis=1).mean()
+
+
+def nn_resample_matrix(src_xyz, trg_xyz, mapmethod='nnfr'):
+    """
+    Build the sparse surf2surf matrix, following mri_surf2surf --mapmethod.
+
+    As mri_surf2surf, the target sphere is first scaled to the radius of the source sphere.
+
+    nnf:  each target vertex takes the value of its nearest source vertex (forward hit).
+    nnfr: in addition, every source vertex without a forward hit is added to its nearest
+          target vertex (reverse hit), and each target vertex averages its hits,
+          so no source vertex is dropped when downsampling.
+    """
+    n_src = src_xyz.shape[0]
+    n_trg = trg_xyz.shape[0]
+    trg_xyz = trg_xyz * (average_radius(src_xyz) / average_radius(trg_xyz))
+
+    _, forward = cKDTree(src_xyz).query(trg_xyz)
+    rows = [np.arange(n_trg)]
+    cols = [forward]
+    if mapmethod == 'nnfr':
+        not_hit = np.ones(n_src, dtype=bool)
+        not_hit[forward] = False
+        not_hit = np.flatnonzero(not_hit)
+        _, reverse = cKDTree(trg_xyz).query(src_xyz[not_hit])
+        rows.append(reverse)
+        cols.append(not_hit)
+    elif mapmethod != 'nnf':
+        raise ValueError(f'Unsupported mapmethod: {mapmethod}')
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    hits = np.ones(len(rows), dtype=np.float32)
+    matrix = coo_matrix((hits, (rows, cols)), shape=(n_trg, n_src)).tocsr()  # duplicates are summed
+    n_hits = np.asarray(matrix.sum(axis=1)).ravel()
+    n_hits[n_hits == 0] = 1
+    matrix = csr_matrix(matrix.multiply(1. / n_hits[:, None]))
+    return matrix.astype(np.float32)
+
+
+def get_surf2surf_matrix(subjects_dir, subject_id, hemi, trgsubject, cache_dir=None, mapmethod='nnfr'):
+    """
+    Sparse fsnative -> trgsubject matrix for one subject and hemisphere.
+
+    Cached in ``cache_dir`` keyed by the content hash of both sphere.reg files,
+    so a re-run surface registration never reuses a stale matrix.
+    """
+    src_sphere = Path(subjects_dir) / subject_id / 'surf' / f'{hemi}.sphere.reg'
+    trg_sphere = Path(subjects_dir) / trgsubject / 'surf' / f'{hemi}.sphere.reg'
+
+    cache_file = None
+    if cache_dir is not None:
+        key = f'{file_sha1(src_sphere)}{file_sha1(trg_sphere)}{mapmethod}{RESAMPLE_VERSION}'
+        key = hashlib.sha1(key.encode()).hexdigest()[:16]
+        cache_file = Path(cache_dir) / f'{hemi}.fsnative_to_{trgsubject}.{mapmethod}.{key}.npz'
+        if cache_file.exists():
+            return load_npz(cache_file)
+
+    matrix = nn_resample_matrix(read_sphere(src_sphere), read_sphere(trg_sphere), mapmethod)
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.parent / f'{cache_file.stem}.{os.getpid()}.tmp.npz'
+        save_npz(tmp_file, matrix)
+        tmp_file.replace(cache_file)
+    return matrix
+
+
+def surf2surf(matrix, surf_data):
+    """
+    surf_data: (n_source_vertex, n_frame) -> (n_target_vertex, n_frame)
+    """
+    return matrix @ np.asarray(surf_data, dtype=np.float32)
@@ -111,6 +111,7 @@ process deepprep_init {
     script_py = "gpu_schedule_lock.py"
     deepprep_init_py = "deepprep_init.py"
     input_bids_validator_py = "input_bids_validator.py"
+    bids_index_py = "bids_index.py"
     gpu_lock = "create-lock"
 
     if (participant_label != '') {
@@ -135,6 +136,10 @@ process deepprep_init {
     --subjects_dir ${subjects_dir} \
     --bold_spaces ${bold_spaces} \
     --bold_only ${bold_only}
+
+    ${bids_index_py} \
+    --bids_dir ${bids_dir} \
+    --index_dir ${output_dir}/WorkDir/bids_index
     """
 }
 
@@ -563,8 +568,15 @@ process anat_fastcsr_levelset {
     script:
     gpu_script_py = "gpu_schedule_run.py"
     script_py = "${fastcsr_home}/fastcsr_model_infer.py"
+    manifest_py = "deepprep_manifest.py"
 
     """
+    ${manifest_py} --manifest ${subjects_dir}/${subject_id}/scripts/manifest/fastcsr_levelset.${hemi}.json \
+    --input orig=${orig_mgz} --input filled=${filled_mgz} \
+    --script script=${script_py} --tool model=${fastcsr_model_path}/${hemi}_model.pth \
+    --param hemi=${hemi} --param deepprep_version=${params.deepprep_version} \
+    --output levelset=${subjects_dir}/${subject_id}/mri/${hemi}_levelset.nii.gz \
+    -- \
     ${gpu_script_py} ${device} double executor ${script_py} \
     --fastcsr_subjects_dir ${subjects_dir} \
     --subj ${subject_id} \
@@ -574,6 +586,24 @@ process anat_fastcsr_levelset {
 }
 
 
+process anat_fastcsr_levelset_cleanup {
+    // 两个半球的 levelset 都完成后，删除 fastcsr_model_infer.py 在半球间共享的预处理结果
+    tag "${subject_id}"
+
+    cpus 1
+    memory '20 MB'
+
+    input:
+    val(subjects_dir)
+    tuple(val(subject_id), val(hemis), val(levelset_nii))
+
+    script:
+    """
+    rm -rf ${subjects_dir}/${subject_id}/tmp/preprocess_cache
+    """
+}
+
+
 process anat_fastcsr_mksurface {
     tag "${subject_id}"
 
@@ -592,8 +622,16 @@ process anat_fastcsr_mksurface {
 
     script:
     script_py = "${fastcsr_home}/levelset2surf.py"
+    manifest_py = "deepprep_manifest.py"
 
     """
+    ${manifest_py} --manifest ${subjects_dir}/${subject_id}/scripts/manifest/fastcsr_mksurface.${hemi}.json \
+    --input levelset=${levelset_nii} --input orig=${orig_mgz} --input brainmask=${brainmask_mgz} \
+    --input aseg_presurf=${aseg_presurf_mgz} \
+    --script script=${script_py} \
+    --param hemi=${hemi} --param deepprep_version=${params.deepprep_version} \
+    --output orig_surf=${subjects_dir}/${subject_id}/surf/${hemi}.orig \
+    -- \
     python3 ${script_py} \
     --fastcsr_subjects_dir ${subjects_dir} \
     --subj ${subject_id} \
@@ -831,9 +869,23 @@ process anat_sphere_register {
     script:
     gpu_script_py = "gpu_schedule_run.py"
     script_py = "${surfreg_home}/predict.py"
+    manifest_py = "deepprep_manifest.py"
     threads = 1
-
-    """
+    // SUGAR 配准到的 fsaverage 模板: sphere、sulc、curv 与 aparc.annot
+    fixed_inputs = ['fsaverage3', 'fsaverage4', 'fsaverage5', 'fsaverage6'].collect { fsaverage ->
+        def fixed_dir = "${freesurfer_home}/subjects/${fsaverage}"
+        "--input ${fsaverage}_sphere=${fixed_dir}/surf/${hemi}.sphere --input ${fsaverage}_sulc=${fixed_dir}/surf/${hemi}.sulc " +
+        "--input ${fsaverage}_curv=${fixed_dir}/surf/${hemi}.curv --input ${fsaverage}_annot=${fixed_dir}/label/${hemi}.aparc.annot"
+    }.join(' ')
+
+    """
+    ${manifest_py} --manifest ${subjects_dir}/${subject_id}/scripts/manifest/sugar_sphere_reg.${hemi}.json \
+    --input curv=${curv_surf} --input sulc=${sulc_surf} --input sphere=${sphere_surf} \
+    ${fixed_inputs} \
+    --script script=${script_py} --tool auxi_data=${surfreg_home}/utils/auxi_data --tool model=${surfreg_model_path} \
+    --param hemi=${hemi} --param deepprep_version=${params.deepprep_version} \
+    --output sphere_reg=${subjects_dir}/${subject_id}/surf/${hemi}.sphere.reg \
+    -- \
     ${gpu_script_py} ${device} double executor ${script_py} --sd ${subjects_dir} --sid ${subject_id} --fsd ${freesurfer_home} \
     --hemi ${hemi} --model_path ${surfreg_model_path} --device ${device}
     """
@@ -1572,8 +1624,19 @@ process bold_sdc {
     tuple(val(subject_id), val(bold_id), val("${sdc_file}")) // emit: sdc
     script:
     script_py = "bold_sdc.py"
+    sdc_inputs_py = "bold_sdc_inputs.py"
+    manifest_py = "deepprep_manifest.py"
     sdc_file = "${bold_preprocess_path}/${subject_id}/func/${bold_id}_space-sdc_bold.nii.gz"
     """
+    fmap_inputs=\$(${sdc_inputs_py} --bids_dir ${bids_dir} --subject_id ${subject_id} --bold_file ${mc_nii} \
+    --metadata_file ${bold_preprocess_path}/${subject_id}/.manifest/${bold_id}_sdc_fmap.json)
+
+    ${manifest_py} --manifest ${bold_preprocess_path}/${subject_id}/.manifest/${bold_id}_sdc.json \
+    --input bold=${mc_nii} --input hmc_xfm=${mcdat} --input boldref=${mc_boldref} \${fmap_inputs} \
+    --script script=\$(which ${script_py}) \
+    --param subject_id=${subject_id} --param bold_id=${bold_id} --param deepprep_version=${params.deepprep_version} \
+    --output sdc=${sdc_file} \
+    -- \
     ${script_py} \
     --bids_dir ${bids_dir} \
     --bold_preprocess_dir ${bold_preprocess_path} \
@@ -2055,114 +2118,39 @@ process qc_plot_carpet {
 }
 
 
-process qc_plot_aparc_aseg {
+process qc_plot_anat {
     tag "${subject_id}"
 
     cpus 5
-    memory '1 GB'
+    memory '3 GB'
 
     input:
     val(subjects_dir)
-    tuple(val(subject_id), val(norm_mgz), val(aparc_aseg))
+    tuple(val(subject_id), val(anat_files))
 
     val(qc_utils_path)
     val(qc_result_path)
+    val(work_dir)
     val(freesurfer_home)
 
     output:
     tuple(val(subject_id), val("${aparc_aseg_svg}"))
 
     script:
+    // volparc, volsurf and surfparc of the subject in one worker pool
     aparc_aseg_svg = "${qc_result_path}/${subject_id}/figures/${subject_id}_desc-volparc_T1w.svg"
 
-    script_py = "qc_anat_aparc_aseg.py"
-    freesurfer_AllLut = "${qc_utils_path}/FreeSurferAllLut.txt"
-    volume_parc_scene = "${qc_utils_path}/Volume_parc.scene"
-    """
-    ${script_py} \
-    --subject_id ${subject_id} \
-    --subjects_dir ${subjects_dir} \
-    --qc_result_path ${qc_result_path} \
-    --dlabel_info ${freesurfer_AllLut} \
-    --scene_file ${volume_parc_scene} \
-    --svg_outpath ${aparc_aseg_svg} \
-    --freesurfer_home ${freesurfer_home}
-
-    """
-}
-
-
-process qc_plot_volsurf {
-    tag "${subject_id}"
-
-    cpus 5
-    memory '1.5 GB'
-
-    input:
-    val(subjects_dir)
-    tuple(val(subject_id), val(lh_white_surf), val(lh_pial_surf), val(rh_white_surf), val(rh_pial_surf), val(t1_mgz))
-
-    val(qc_utils_path)
-    val(qc_result_path)
-    val(freesurfer_home)
-
-    output:
-    tuple(val(subject_id), val("${qc_plot_aseg_fig_path}"))
-
-    script:
-    qc_plot_aseg_fig_path = "${qc_result_path}/${subject_id}/figures/${subject_id}_desc-volsurf_T1w.svg"
-
-    script_py = "qc_anat_vol_surface.py"
-    vol_Surface_scene = "${qc_utils_path}/Vol_Surface.scene"
-    affine_mat = "${qc_utils_path}/affine.mat"
-
-    """
-    ${script_py} \
-    --subject_id ${subject_id} \
-    --subjects_dir ${subjects_dir} \
-    --qc_result_path ${qc_result_path} \
-    --affine_mat ${affine_mat} \
-    --scene_file ${vol_Surface_scene} \
-    --svg_outpath ${qc_plot_aseg_fig_path} \
-    --freesurfer_home ${freesurfer_home}
-
-    """
-}
-
-
-process qc_plot_surfparc {
-    tag "${subject_id}"
-
-    cpus 1
-    memory '1 GB'
-
-    input:
-    val(subjects_dir)
-    tuple(val(subject_id), val(lh_aparc_annot), val(lh_white_surf), val(lh_pial_surf), val(rh_aparc_annot),val(rh_white_surf), val(rh_pial_surf))
-
-    val(qc_utils_path)
-    val(qc_result_path)
-    val(freesurfer_home)
-
-    output:
-    tuple(val(subject_id), val("${qc_plot_aseg_fig_path}"))
-
-    script:
-    qc_plot_aseg_fig_path = "${qc_result_path}/${subject_id}/figures/${subject_id}_desc-surfparc_T1w.svg"
-
-    script_py = "qc_anat_surface_parc.py"
-    surface_parc_scene = "${qc_utils_path}/Surface_parc.scene"
-    affine_mat = "${qc_utils_path}/affine.mat"
-
+    script_py = "qc_render_pool.py"
     """
     ${script_py} \
     --subject_id ${subject_id} \
     --subjects_dir ${subjects_dir} \
     --qc_result_path ${qc_result_path} \
-    --affine_mat ${affine_mat} \
-    --scene_file ${surface_parc_scene} \
-    --svg_outpath ${qc_plot_aseg_fig_path} \
-    --freesurfer_home ${freesurfer_home}
+    --qc_tool_package ${qc_utils_path} \
+    --freesurfer_home ${freesurfer_home} \
+    --workers ${task.cpus} \
+    --cpus ${task.cpus} \
+    --timing_file ${work_dir}/qc_plot_anat/${subject_id}_timing.tsv
 
     """
 }
@@ -2440,6 +2428,7 @@ workflow anat_wf {
     // hemi levelset_nii
     anat_fastcsr_levelset_input = orig_mgz.join(filled_mgz)
     levelset_nii = anat_fastcsr_levelset(subjects_dir, anat_fastcsr_levelset_input, fastcsr_home, fastcsr_model_path, hemis, device, gpu_lock)
+    anat_fastcsr_levelset_cleanup(subjects_dir, levelset_nii.groupTuple(size: 2))
 
     // hemi orig_surf, orig_premesh_surf
     anat_fastcsr_mksurface_input = levelset_nii.join(hemis_orig_mgz, by: [0, 1]).join(hemis_brainmask_mgz, by: [0, 1]).join(hemis_aseg_presurf_mgz, by: [0, 1])
@@ -2515,15 +2504,14 @@ workflow anat_wf {
     qc_plot_volsurf_input_lh = white_surf.join(pial_surf, by: [0, 1]).join(subject_id_lh, by: [0, 1]).map { tuple -> return tuple[0, 2, 3] }
     qc_plot_volsurf_input_rh = white_surf.join(pial_surf, by: [0, 1]).join(subject_id_rh, by: [0, 1]).map { tuple -> return tuple[0, 2, 3] }
     qc_plot_volsurf_input = qc_plot_volsurf_input_lh.join(qc_plot_volsurf_input_rh).join(t1_mgz)
-    vol_surface_svg = qc_plot_volsurf(subjects_dir, qc_plot_volsurf_input, qc_utils_path, qc_result_path, freesurfer_home)
 
     qc_plot_surfparc_input_lh = aparc_annot.join(white_surf, by: [0, 1]).join(pial_surf, by: [0, 1]).join(subject_id_lh, by: [0, 1]).map { tuple -> return tuple[0, 2, 3, 4] }
     qc_plot_surfparc_input_rh = aparc_annot.join(white_surf, by: [0, 1]).join(pial_surf, by: [0, 1]).join(subject_id_rh, by: [0, 1]).map { tuple -> return tuple[0, 2, 3, 4] }
     qc_plot_surfparc_input = qc_plot_surfparc_input_lh.join(qc_plot_surfparc_input_rh)
-    surface_parc_svg = qc_plot_surfparc(subjects_dir, qc_plot_surfparc_input, qc_utils_path, qc_result_path, freesurfer_home)
 
     qc_plot_aparc_aseg_input = norm_mgz.join(aparc_aseg_mgz)
-    aparc_aseg_svg = qc_plot_aparc_aseg(subjects_dir, qc_plot_aparc_aseg_input, qc_utils_path, qc_result_path, freesurfer_home)
+    qc_plot_anat_input = qc_plot_aparc_aseg_input.join(qc_plot_volsurf_input).join(qc_plot_surfparc_input).map { tuple -> return [tuple[0], tuple[1..-1]] }
+    aparc_aseg_svg = qc_plot_anat(subjects_dir, qc_plot_anat_input, qc_utils_path, qc_result_path, work_dir, freesurfer_home)
 
     qc_report = qc_anat_create_report(bids_dir, subjects_dir, qc_result_path, work_dir, aparc_aseg_svg, reports_utils_path, deepprep_version)
 